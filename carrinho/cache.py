@@ -0,0 +1,216 @@
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from os import environ
+from typing import Any, Hashable, Optional, Tuple
+
+from carrinho.db.dsn import dsn_asyncpg
+from carrinho.metrics import registrar_coletor
+
+logger = logging.getLogger(__name__)
+
+_AUSENTE = object()
+
+
+class LRUCache:
+    """LRU limitado por tamanho, com TTL por entrada."""
+
+    def __init__(self, max_itens: int = 1024, ttl: float = 60.0):
+        self.max_itens = max_itens
+        self.ttl = ttl
+        self._dados: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirados = 0
+
+    def __len__(self):
+        return len(self._dados)
+
+    def get(self, chave: Hashable, padrao: Any = None) -> Any:
+        item = self._dados.get(chave, _AUSENTE)
+        if item is _AUSENTE:
+            self.misses += 1
+            return padrao
+        expira_em, valor = item
+        if expira_em < time.monotonic():
+            del self._dados[chave]
+            self.expirados += 1
+            self.misses += 1
+            return padrao
+        self._dados.move_to_end(chave)
+        self.hits += 1
+        return valor
+
+    def set(self, chave: Hashable, valor: Any):
+        if self.max_itens <= 0:
+            return
+        self._dados[chave] = (time.monotonic() + self.ttl, valor)
+        self._dados.move_to_end(chave)
+        while len(self._dados) > self.max_itens:
+            self._dados.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, chave: Hashable):
+        self._dados.pop(chave, None)
+
+    def clear(self):
+        self._dados.clear()
+
+    def stats(self) -> dict:
+        return {
+            "itens": len(self._dados),
+            "max_itens": self.max_itens,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirados": self.expirados,
+        }
+
+
+class CacheBroker:
+    """Broker nulo: o cache só vale dentro do processo."""
+
+    async def start(self, callback):
+        pass
+
+    async def publish(self, mensagem: dict):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class PgNotifyBroker(CacheBroker):
+    """Espalha as invalidações entre workers via LISTEN/NOTIFY do Postgres."""
+
+    def __init__(self, dsn: str, canal: str = "cache_produto"):
+        self.dsn = dsn
+        self.canal = canal
+        self.conn = None
+
+    async def start(self, callback):
+        import asyncpg
+
+        self.conn = await asyncpg.connect(self.dsn)
+
+        def ao_notificar(conn, pid, canal, payload):
+            callback(json.loads(payload))
+
+        await self.conn.add_listener(self.canal, ao_notificar)
+
+    async def publish(self, mensagem: dict):
+        if self.conn is None:
+            return
+        await self.conn.execute(
+            "SELECT pg_notify($1, $2)", self.canal, json.dumps(mensagem)
+        )
+
+    async def stop(self):
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+
+
+class ProductCache:
+    """Cache read-through do ProductAdapter.
+
+    As entradas por id são invalidadas uma a uma; qualquer escrita pode mudar
+    o resultado de um filtro, então os filtros são descartados juntos.
+    """
+
+    def __init__(self, max_itens: int, ttl: float, broker: Optional[CacheBroker] = None):
+        self.produtos = LRUCache(max_itens, ttl)
+        self.filtros = LRUCache(max_itens, ttl)
+        self.broker = broker or CacheBroker()
+        self.origem = uuid.uuid4().hex
+        # incrementada a cada invalidação: uma leitura que começou antes de
+        # uma escrita não pode gravar o valor antigo depois dela
+        self.geracao = 0
+
+    def get(self, id: int) -> Any:
+        return self.produtos.get(id)
+
+    def set(self, id: int, produto: Any, geracao: int):
+        if geracao == self.geracao:
+            self.produtos.set(id, produto)
+
+    def get_filtro(self, filtro: dict) -> Any:
+        return self.filtros.get(self._chave_filtro(filtro))
+
+    def set_filtro(self, filtro: dict, resultado: Any, geracao: int):
+        if geracao == self.geracao:
+            self.filtros.set(self._chave_filtro(filtro), resultado)
+
+    def invalidar_local(self, id: Optional[int] = None):
+        self.geracao += 1
+        if id is not None:
+            self.produtos.invalidate(id)
+        self.filtros.clear()
+
+    def invalidar_tudo_local(self):
+        self.geracao += 1
+        self.produtos.clear()
+        self.filtros.clear()
+
+    async def invalidar(self, id: Optional[int] = None):
+        self.invalidar_local(id)
+        await self._publicar({"origem": self.origem, "id": id})
+
+    async def invalidar_tudo(self):
+        self.invalidar_tudo_local()
+        await self._publicar({"origem": self.origem, "tudo": True})
+
+    async def _publicar(self, mensagem: dict):
+        try:
+            await self.broker.publish(mensagem)
+        except Exception as e:
+            # sem broker os outros workers ainda expiram pelo TTL
+            logger.error(e)
+
+    def _ao_receber(self, mensagem: dict):
+        if mensagem.get("origem") == self.origem:
+            return
+        if mensagem.get("tudo"):
+            self.invalidar_tudo_local()
+        else:
+            self.invalidar_local(mensagem.get("id"))
+
+    async def start(self):
+        await self.broker.start(self._ao_receber)
+
+    async def stop(self):
+        await self.broker.stop()
+
+    def stats(self) -> dict:
+        return {"produtos": self.produtos.stats(), "filtros": self.filtros.stats()}
+
+    @staticmethod
+    def _chave_filtro(filtro: dict) -> tuple:
+        return tuple(sorted((k, str(v)) for k, v in filtro.items()))
+
+
+def _criar_broker() -> CacheBroker:
+    if environ.get("PRODUCT_CACHE_BROKER") == "postgres":
+        return PgNotifyBroker(dsn_asyncpg(environ.get("DATABASE_URI")))
+    return CacheBroker()
+
+
+product_cache = ProductCache(
+    max_itens=int(environ.get("PRODUCT_CACHE_SIZE", 1024)),
+    ttl=float(environ.get("PRODUCT_CACHE_TTL", 60)),
+    broker=_criar_broker(),
+)
+
+
+@registrar_coletor
+def _metricas_cache():
+    stats = product_cache.stats()
+    metricas = []
+    for nome in stats["produtos"]:
+        tipo = "gauge" if nome in ("itens", "max_itens") else "counter"
+        amostras = [({"cache": cache}, valores[nome]) for cache, valores in stats.items()]
+        metricas.append((f"product_cache_{nome}", tipo, f"Cache de produtos: {nome}", amostras))
+    return metricas
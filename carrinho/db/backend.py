@@ -0,0 +1,103 @@
+"""Escolha do banco por configuração (STORAGE_BACKEND=postgres|mongo).
+
+Só o módulo do backend escolhido é importado: o do Postgres cria o engine
+no import e o do Mongo precisa do motor instalado. Os dois expõem os mesmos
+adapters e dependências, com o contrato de BaseAdapter.
+
+`preparar` aplica as migrações (Postgres) ou cria os índices (Mongo). Com um worker só ela roda no startup; o
+carrinho.server roda uma vez antes de subir os workers e desliga
+DB_SETUP_ON_STARTUP para eles.
+"""
+from importlib import import_module
+from os import environ
+
+BACKENDS = ("postgres", "mongo")
+
+STORAGE_BACKEND = environ.get("STORAGE_BACKEND", "postgres").lower()
+DB_SETUP_ON_STARTUP = environ.get("DB_SETUP_ON_STARTUP", "1").lower() in (
+    "1", "true", "yes", "sim"
+)
+
+if STORAGE_BACKEND not in BACKENDS:
+    raise RuntimeError(
+        f"STORAGE_BACKEND inválido: {STORAGE_BACKEND!r} (use um de {', '.join(BACKENDS)})"
+    )
+
+_adapters = import_module(f"carrinho.db.{STORAGE_BACKEND}_adapter")
+
+UserAdapter = _adapters.UserAdapter
+AddressAdapter = _adapters.AddressAdapter
+ProductAdapter = _adapters.ProductAdapter
+CartAdapter = _adapters.CartAdapter
+StockAdapter = _adapters.StockAdapter
+
+get_user_adapter = _adapters.get_user_adapter
+get_address_adapter = _adapters.get_address_adapter
+get_product_adapter = _adapters.get_product_adapter
+get_cart_adapter = _adapters.get_cart_adapter
+get_stock_adapter = _adapters.get_stock_adapter
+
+# devolve ao estoque as reservas vencidas, em segundo plano
+varredor = _adapters.varredor
+
+
+if STORAGE_BACKEND == "postgres":
+    from carrinho.db.outbox import despachante
+    from carrinho.db.postgres_adapter import limpeza_idempotencia
+    from carrinho.db.postgres_db import (InstrumentedPool, agrupador,
+                                         aplicar_migracoes, engine,
+                                         pool_status, replicas,
+                                         warm_up_pool)
+
+    # espera recente por conexão, em segundos (controle de admissão)
+    espera_pool = InstrumentedPool.estatisticas.espera_recente
+
+    async def preparar():
+        await aplicar_migracoes()
+        # o processo que prepara não atende requisições
+        await engine.dispose()
+
+    async def on_startup():
+        if DB_SETUP_ON_STARTUP:
+            await aplicar_migracoes()
+        await warm_up_pool()
+        if replicas is not None:
+            await replicas.start()
+        await varredor.start()
+        await limpeza_idempotencia.start()
+        if despachante is not None:
+            await despachante.start()
+
+    async def on_shutdown():
+        await varredor.stop()
+        await limpeza_idempotencia.stop()
+        if despachante is not None:
+            await despachante.stop()
+        if replicas is not None:
+            await replicas.stop()
+        if agrupador is not None:
+            await agrupador.parar()
+
+else:
+    from carrinho.db.mondo_db import (connect_db, disconnect_db,
+                                      ensure_indexes)
+
+    async def preparar():
+        await connect_db()
+        await ensure_indexes()
+        await disconnect_db()
+
+    async def on_startup():
+        await connect_db()
+        if DB_SETUP_ON_STARTUP:
+            await ensure_indexes()
+        await varredor.start()
+
+    async def on_shutdown():
+        await varredor.stop()
+        await disconnect_db()
+
+    # o pool do Motor não expõe checkouts/esperas como o do SQLAlchemy
+    pool_status = None
+    espera_pool = None
+    replicas = None
@@ -1,9 +1,25 @@
-from typing import Any
+import inspect
+from typing import Any, AsyncIterator, Optional
 
 from pydantic import BaseModel
 
+from carrinho.metrics import cronometrar
+
+# filter() não pagina: devolve até MAX_FILTRO + 1 linhas, e a linha a mais só
+# avisa que o resultado foi cortado (a rota responde X-Result-Truncated).
+# Para percorrer tudo, GET /produtos/ com cursor.
+MAX_FILTRO = 100
+
 
 class BaseAdapter:
+    def __init_subclass__(cls, **kwargs):
+        # todo método público async dos adapters entra no histograma de latência
+        super().__init_subclass__(**kwargs)
+        backend = cls.__module__.rsplit(".", 1)[-1].replace("_adapter", "")
+        for nome, metodo in list(vars(cls).items()):
+            if not nome.startswith("_") and inspect.iscoroutinefunction(metodo):
+                setattr(cls, nome, cronometrar(backend, cls.__name__, metodo))
+
     async def create(self, data: BaseModel) -> BaseModel:
         pass
 
@@ -19,7 +35,12 @@ class BaseAdapter:
     async def get(self, id: Any, key: str) -> BaseModel:
         pass
 
-    async def get_all(self, skip: int = 0, limit: int = 10) -> list[BaseModel]:
+    async def get_all(
+        self, limit: int = 10, cursor: Optional[str] = None
+    ) -> tuple[list[BaseModel], Optional[str]]:
+        pass
+
+    def stream_all(self) -> AsyncIterator[BaseModel]:
         pass
 
     async def delete(self, id: Any, key: str):
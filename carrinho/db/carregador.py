@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import weakref
+from os import environ
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from carrinho.metrics import registrar_coletor
+
+logger = logging.getLogger(__name__)
+
+# instâncias ligadas, para o coletor de métricas
+ativos: list = []
+
+
+class CarregadorLote:
+    """Junta get(id) concorrentes numa busca só (SELECT ... IN / $in).
+
+    As chamadas que chegam dentro de `janela` segundos entram no mesmo lote
+    (janela 0: as do mesmo ciclo do event loop); ids repetidos no lote
+    compartilham o futuro. `buscar(ids)` devolve {id: objeto} e quem pediu
+    um id ausente recebe None.
+
+    Os lotes pendentes ficam por event loop, já que um futuro só pode ser
+    resolvido no loop que o criou.
+    """
+
+    def __init__(
+        self,
+        buscar: Callable[[list], Awaitable[dict]],
+        janela: float,
+        max_lote: int,
+    ):
+        self.buscar = buscar
+        self.janela = janela
+        self.max_lote = max_lote
+        self._pendentes = weakref.WeakKeyDictionary()
+        self._buscando = set()
+        self.lotes = 0
+        self.chaves = 0
+        self.repetidas = 0
+
+    @classmethod
+    def do_ambiente(cls, buscar: Callable[[list], Awaitable[dict]]) -> Optional["CarregadorLote"]:
+        # opcional (PRODUCT_GET_COALESCING=1), como o agrupador de escritas
+        if environ.get("PRODUCT_GET_COALESCING", "0").lower() not in ("1", "true", "yes", "sim"):
+            return None
+        carregador = cls(
+            buscar,
+            janela=float(environ.get("PRODUCT_GET_COALESCE_MS", 1)) / 1000,
+            max_lote=int(environ.get("PRODUCT_GET_COALESCE_MAX", 100)),
+        )
+        ativos.append(carregador)
+        return carregador
+
+    async def carregar(self, chave: Hashable) -> Any:
+        loop = asyncio.get_running_loop()
+        pendentes = self._pendentes.get(loop)
+        if pendentes is None:
+            pendentes = self._pendentes[loop] = {}
+            loop.call_later(self.janela, self._disparar, loop, pendentes)
+        futuro = pendentes.get(chave)
+        if futuro is None:
+            futuro = pendentes[chave] = loop.create_future()
+            if len(pendentes) >= self.max_lote:
+                self._disparar(loop, pendentes)
+        else:
+            self.repetidas += 1
+        # shield: um chamador cancelado não cancela o resultado dos outros
+        return await asyncio.shield(futuro)
+
+    def _disparar(self, loop, pendentes: dict):
+        # o timer de um lote que já saiu por max_lote não leva o lote seguinte
+        if self._pendentes.get(loop) is not pendentes:
+            return
+        del self._pendentes[loop]
+        tarefa = loop.create_task(self._buscar_lote(pendentes))
+        self._buscando.add(tarefa)
+        tarefa.add_done_callback(self._buscando.discard)
+
+    async def _buscar_lote(self, pendentes: dict):
+        self.lotes += 1
+        self.chaves += len(pendentes)
+        try:
+            encontrados = await self.buscar(list(pendentes))
+        except Exception as e:
+            logger.error(e)
+            for futuro in pendentes.values():
+                if not futuro.done():
+                    futuro.set_exception(e)
+            return
+        for chave, futuro in pendentes.items():
+            if not futuro.done():
+                futuro.set_result(encontrados.get(chave))
+
+    def stats(self) -> dict:
+        return {"lotes": self.lotes, "chaves": self.chaves, "repetidas": self.repetidas}
+
+
+@registrar_coletor
+def _metricas_carregador():
+    return [
+        (f"product_get_coalesced_{nome}", "counter", f"Gets de produto agrupados: {nome}",
+         [({}, valor)])
+        for carregador in ativos
+        for nome, valor in carregador.stats().items()
+    ]
@@ -0,0 +1,17 @@
+# URLs do Postgres: o SQLAlchemy quer o dialeto no esquema, o asyncpg não
+
+
+def async_url(url: str) -> str:
+    # o compose entrega "postgresql://", o driver async precisa do asyncpg
+    if url.startswith("postgresql://") or url.startswith("postgres://"):
+        return "postgresql+asyncpg://" + url.split("://", 1)[1]
+    return url
+
+
+def dsn_asyncpg(url: str) -> str:
+    # o contrário, para conexões asyncpg diretas (rate limit, LISTEN/NOTIFY):
+    # "postgresql+asyncpg://" é aceito no DATABASE_URI mas o asyncpg o recusa
+    esquema, resto = url.split("://", 1)
+    if esquema.startswith("postgresql+") or esquema.startswith("postgres+"):
+        return "postgresql://" + resto
+    return url
@@ -0,0 +1,268 @@
+import asyncio
+import hashlib
+import json
+import logging
+from os import environ
+from typing import Any, Awaitable, Callable, Optional
+
+from carrinho.cache import LRUCache
+from carrinho.db.exception import ChaveReutilizada
+from carrinho.metrics import registrar_coletor
+
+logger = logging.getLogger(__name__)
+
+
+class Idempotencia:
+    """Guarda o resultado de cada escrita pela Idempotency-Key do cliente.
+
+    Uma repetição com a mesma chave (ou uma que chega enquanto a primeira
+    ainda roda) recebe o mesmo resultado, sem escrever de novo. Este cache é
+    por processo; no Postgres a chave também é gravada na mesma transação da
+    escrita (tabela idempotencia), o que cobre a repetição que cai em outro
+    worker ou chega depois de um restart.
+
+    A chave guarda também a assinatura do pedido (`pedido`, o que a escrita
+    recebe além do que já está no escopo); a mesma chave com outro pedido
+    levanta ChaveReutilizada em vez de devolver a resposta do primeiro.
+    """
+
+    def __init__(self, max_itens: int, ttl: float):
+        self.respostas = LRUCache(max_itens, ttl)
+        self.ttl = ttl
+        self.repetidas = 0
+
+    @staticmethod
+    def assinatura(pedido: Any) -> str:
+        bruto = json.dumps(pedido, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(bruto.encode()).hexdigest()
+
+    async def executar(
+        self,
+        escopo: str,
+        chave: Optional[str],
+        funcao: Callable[[], Awaitable[Any]],
+        pedido: Any = None,
+    ) -> Any:
+        if chave is None:
+            return await funcao()
+        chave = (escopo, chave)
+        assinatura = self.assinatura(pedido)
+        anterior = self.respostas.get(chave)
+        if anterior is not None:
+            assinatura_anterior, futuro = anterior
+            if assinatura_anterior != assinatura:
+                raise ChaveReutilizada(escopo)
+            self.repetidas += 1
+            return await asyncio.shield(futuro)
+
+        futuro = asyncio.get_running_loop().create_future()
+        self.respostas.set(chave, (assinatura, futuro))
+        try:
+            resultado = await funcao()
+        except Exception as e:
+            # falhou: a próxima tentativa tem que poder escrever
+            self.respostas.invalidate(chave)
+            futuro.set_exception(e)
+            futuro.exception()  # marca como lida: quem não repetiu não vai esperar
+            raise
+        except BaseException:
+            self.respostas.invalidate(chave)
+            futuro.cancel()
+            raise
+        futuro.set_result(resultado)
+        return resultado
+
+
+class Varredura:
+    """Roda `limpar(lote)` a cada `intervalo` segundos; enquanto o lote vem
+    cheio, roda de novo sem esperar. `limpar` devolve quantas linhas apagou.
+
+    Serve às reservas vencidas, às chaves de idempotência e ao rate limit;
+    o nome vira o label `tabela` das métricas.
+    """
+
+    def __init__(self, nome: str, limpar: Callable[[int], Awaitable[int]], intervalo: float, lote: int):
+        self.nome = nome
+        self.limpar = limpar
+        self.intervalo = intervalo
+        self.lote = lote
+        self._tarefa = None
+        self.apagadas = 0
+        self.falhas = 0
+        varreduras.append(self)
+
+    async def start(self):
+        if self._tarefa is None and self.intervalo > 0:
+            self._tarefa = asyncio.create_task(self._varrer())
+
+    async def stop(self):
+        if self._tarefa is None:
+            return
+        self._tarefa.cancel()
+        await asyncio.gather(self._tarefa, return_exceptions=True)
+        self._tarefa = None
+
+    async def _varrer(self):
+        while True:
+            await asyncio.sleep(self.intervalo)
+            try:
+                # lote cheio: provavelmente sobrou mais, varre de novo sem esperar
+                while True:
+                    apagadas = await self.limpar(self.lote)
+                    self.apagadas += apagadas
+                    if apagadas < self.lote:
+                        break
+            except Exception as e:
+                self.falhas += 1
+                logger.error(e)
+
+
+# instâncias criadas, para o coletor de métricas
+varreduras: list = []
+
+
+class AgrupadorEscritas:
+    """Junta escritas concorrentes numa só transação.
+
+    Cada operação é uma função async que recebe a sessão do lote. O lote fecha
+    depois de `janela` segundos ou `max_lote` operações, roda as operações
+    ordenadas pela chave de trava (`ordem`, para dois lotes nunca travarem
+    linhas em ordens opostas) e faz um único commit; o futuro de cada chamador
+    só resolve depois dele. Se uma operação falha, o lote é refeito com um
+    savepoint por operação e só ela recebe o erro.
+    """
+
+    def __init__(
+        self,
+        fabrica_sessao: Callable,
+        janela: float,
+        max_lote: int,
+        concorrencia: int,
+    ):
+        self.fabrica_sessao = fabrica_sessao
+        self.janela = janela
+        self.max_lote = max_lote
+        self.concorrencia = concorrencia
+        self._fila = None
+        self._tarefa = None
+        self._vagas = None
+        self._gravando = set()
+        self.lotes = 0
+        self.operacoes = 0
+        self.lotes_refeitos = 0
+
+    async def enviar(self, operacao: Callable[[Any], Awaitable[Any]], ordem: tuple = ()) -> Any:
+        if self._tarefa is None:
+            self._fila = asyncio.Queue()
+            self._vagas = asyncio.Semaphore(self.concorrencia)
+            self._tarefa = asyncio.create_task(self._agrupar())
+        futuro = asyncio.get_running_loop().create_future()
+        await self._fila.put((ordem, operacao, futuro))
+        return await futuro
+
+    async def _agrupar(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            lote = [await self._fila.get()]
+            fim = loop.time() + self.janela
+            while len(lote) < self.max_lote:
+                restante = fim - loop.time()
+                if restante <= 0:
+                    break
+                try:
+                    lote.append(await asyncio.wait_for(self._fila.get(), restante))
+                except asyncio.TimeoutError:
+                    break
+            # no máximo `concorrencia` transações abertas; as demais esperam aqui
+            await self._vagas.acquire()
+            tarefa = asyncio.create_task(self._gravar(lote))
+            self._gravando.add(tarefa)
+            tarefa.add_done_callback(self._gravando.discard)
+
+    async def _gravar(self, lote: list):
+        try:
+            lote.sort(key=lambda item: item[0])
+            self.lotes += 1
+            self.operacoes += len(lote)
+            try:
+                resultados = await self._executar(lote, savepoints=False)
+            except _FalhaNoLote:
+                self.lotes_refeitos += 1
+                resultados = await self._executar(lote, savepoints=True)
+        except Exception as e:
+            logger.error(e)
+            resultados = [(False, e)] * len(lote)
+        finally:
+            self._vagas.release()
+        for (_, _, futuro), (ok, valor) in zip(lote, resultados):
+            if futuro.done():  # chamador desistiu (ex.: requisição cancelada)
+                continue
+            if ok:
+                futuro.set_result(valor)
+            else:
+                futuro.set_exception(valor)
+
+    async def _executar(self, lote: list, savepoints: bool) -> list:
+        resultados = []
+        async with self.fabrica_sessao() as session:
+            for _, operacao, _ in lote:
+                if not savepoints:
+                    try:
+                        resultados.append((True, await operacao(session)))
+                    except Exception as e:
+                        raise _FalhaNoLote from e
+                    continue
+                try:
+                    async with session.begin_nested():
+                        resultados.append((True, await operacao(session)))
+                except Exception as e:
+                    resultados.append((False, e))
+            await session.commit()
+        return resultados
+
+    async def parar(self):
+        if self._tarefa is None:
+            return
+        self._tarefa.cancel()
+        await asyncio.gather(self._tarefa, *self._gravando, return_exceptions=True)
+        self._tarefa = None
+
+    def stats(self) -> dict:
+        return {
+            "lotes": self.lotes,
+            "operacoes": self.operacoes,
+            "lotes_refeitos": self.lotes_refeitos,
+            "na_fila": self._fila.qsize() if self._fila else 0,
+        }
+
+
+class _FalhaNoLote(Exception):
+    pass
+
+
+idempotencia = Idempotencia(
+    max_itens=int(environ.get("IDEMPOTENCY_CACHE_SIZE", 10000)),
+    ttl=float(environ.get("IDEMPOTENCY_TTL", 600)),
+)
+
+
+@registrar_coletor
+def _metricas_idempotencia():
+    return [
+        ("idempotency_replays", "counter", "Escritas repetidas com a mesma Idempotency-Key",
+         [({}, idempotencia.repetidas)]),
+        ("idempotency_keys", "gauge", "Chaves de idempotência guardadas",
+         [({}, len(idempotencia.respostas))]),
+    ]
+
+
+@registrar_coletor
+def _metricas_varreduras():
+    if not varreduras:
+        return []
+    return [
+        ("purge_deleted_rows_total", "counter", "Linhas vencidas apagadas pelas varreduras",
+         [({"tabela": varredura.nome}, varredura.apagadas) for varredura in varreduras]),
+        ("purge_failures_total", "counter", "Varreduras que falharam",
+         [({"tabela": varredura.nome}, varredura.falhas) for varredura in varreduras]),
+    ]
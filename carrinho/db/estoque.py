@@ -0,0 +1,29 @@
+"""Reservas de estoque com validade.
+
+O estoque de um produto fica em uma ou mais fatias (linhas/documentos com
+parte da quantidade). Uma reserva baixa uma fatia só, com "decrementa se
+houver" atômico; com várias fatias as reservas concorrentes do mesmo SKU
+caem em linhas diferentes e não fazem fila no mesmo lock. A quantidade
+nunca fica negativa, então não há venda além do estoque.
+
+Reserva confirmada some e a baixa fica; reserva liberada ou vencida devolve
+as unidades. As vencidas são devolvidas por uma Varredura, que roda em
+todo worker (as varreduras de workers diferentes não pegam as mesmas linhas).
+"""
+from os import environ
+from typing import Awaitable, Callable
+
+from carrinho.db.escritas import Varredura
+
+# segundos até uma reserva não confirmada voltar para o estoque
+RESERVA_TTL = float(environ.get("RESERVA_TTL", 600))
+
+
+def varredor_de_reservas(liberar_expiradas: Callable[[int], Awaitable[int]]) -> Varredura:
+    """Devolve ao estoque as reservas vencidas, `lote` por vez."""
+    return Varredura(
+        "reserva",
+        liberar_expiradas,
+        intervalo=float(environ.get("RESERVA_VARREDURA_S", 5)),
+        lote=int(environ.get("RESERVA_VARREDURA_LOTE", 500)),
+    )
@@ -2,5 +2,25 @@ class ObjetoNaoEncontrado(Exception):
     """Quando for feito uma update e o matched_count == 0"""
 
 
+class ObjetoDuplicado(Exception):
+    """Quando o insert viola um índice único (ex.: email já cadastrado)"""
+
+
 class ObjetoNaoModificado(Exception):
     """Quando o update for igual a um existente"""
+
+
+class VersaoConflitante(Exception):
+    """Quando o update traz uma versão que não é mais a atual do objeto"""
+
+
+class CursorInvalido(ValueError):
+    """Quando o cursor recebido não foi gerado por encode_cursor"""
+
+
+class EstoqueInsuficiente(Exception):
+    """Quando a reserva pede mais unidades do que há disponíveis"""
+
+
+class ChaveReutilizada(Exception):
+    """Quando a Idempotency-Key já foi usada com um pedido diferente"""
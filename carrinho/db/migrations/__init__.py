@@ -0,0 +1,133 @@
+"""Migrações versionadas do Postgres.
+
+Cada módulo vNNNN_nome.py deste pacote é uma migração, aplicada em ordem e
+registrada em schema_migrations:
+
+    DESCRICAO = "..."
+    TRANSACIONAL = True   # False para CREATE INDEX CONCURRENTLY e afins
+
+    async def aplicar(conn): ...
+
+As transacionais rodam numa transação junto com o registro da versão. As
+não transacionais rodam em autocommit (CONCURRENTLY não roda dentro de
+transação) e precisam ser idempotentes: se caírem no meio, rodam de novo.
+
+Uso: `python -m carrinho.db.migrations [--status]`.
+"""
+import importlib
+import logging
+import pkgutil
+from typing import List, NamedTuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+TABELA = "schema_migrations"
+# pg_advisory_lock: dois processos migrando ao mesmo tempo esperam um pelo outro
+TRAVA = 80_312_018
+
+
+class Migracao(NamedTuple):
+    versao: int
+    nome: str
+    modulo: object
+
+
+def carregar() -> List[Migracao]:
+    migracoes = []
+    for info in pkgutil.iter_modules(__path__):
+        if not info.name.startswith("v"):
+            continue
+        versao = int(info.name[1:].split("_", 1)[0])
+        modulo = importlib.import_module(f"{__name__}.{info.name}")
+        migracoes.append(Migracao(versao, info.name, modulo))
+    return sorted(migracoes)
+
+
+async def versao_atual(conn: AsyncConnection) -> int:
+    existe = (await conn.execute(text(f"SELECT to_regclass('{TABELA}')"))).scalar()
+    if existe is None:
+        return 0
+    return (await conn.execute(text(f"SELECT coalesce(max(versao), 0) FROM {TABELA}"))).scalar()
+
+
+async def aplicadas(conn: AsyncConnection) -> set:
+    if (await conn.execute(text(f"SELECT to_regclass('{TABELA}')"))).scalar() is None:
+        return set()
+    return set((await conn.execute(text(f"SELECT versao FROM {TABELA}"))).scalars())
+
+
+async def _registrar(conn: AsyncConnection, migracao: Migracao):
+    await conn.execute(
+        text(f"INSERT INTO {TABELA} (versao, nome) VALUES (:versao, :nome)"),
+        {"versao": migracao.versao, "nome": migracao.nome},
+    )
+
+
+async def migrar(engine: AsyncEngine) -> List[str]:
+    """Aplica as migrações pendentes; devolve os nomes das que rodaram.
+
+    Banco em dia custa um SELECT, sem DDL nem trava.
+    """
+    async with engine.connect() as conn:
+        if await versao_atual(conn) >= ULTIMA:
+            return []
+
+    rodadas = []
+    async with engine.connect() as trava:
+        trava = await trava.execution_options(isolation_level="AUTOCOMMIT")
+        await trava.execute(text("SELECT pg_advisory_lock(:id)"), {"id": TRAVA})
+        try:
+            await trava.execute(
+                text(
+                    f"CREATE TABLE IF NOT EXISTS {TABELA} ("
+                    "versao integer PRIMARY KEY, "
+                    "nome varchar NOT NULL, "
+                    "aplicada_em timestamptz NOT NULL DEFAULT now())"
+                )
+            )
+            # relido depois da trava: outro processo pode ter migrado enquanto esperávamos
+            feitas = await aplicadas(trava)
+            for migracao in MIGRACOES:
+                if migracao.versao in feitas:
+                    continue
+                logger.info("aplicando migração %s", migracao.nome)
+                if getattr(migracao.modulo, "TRANSACIONAL", True):
+                    async with engine.begin() as conn:
+                        await migracao.modulo.aplicar(conn)
+                        await _registrar(conn, migracao)
+                else:
+                    await migracao.modulo.aplicar(trava)
+                    await _registrar(trava, migracao)
+                rodadas.append(migracao.nome)
+        finally:
+            await trava.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": TRAVA})
+    return rodadas
+
+
+async def criar_indice(conn: AsyncConnection, nome: str, definicao: str):
+    """CREATE INDEX CONCURRENTLY sem travar escritas na tabela.
+
+    Um CONCURRENTLY que falha deixa o índice INVALID com o mesmo nome, e o
+    IF NOT EXISTS passaria direto por ele; por isso o inválido é removido
+    antes de tentar de novo.
+    """
+    invalido = (
+        await conn.execute(
+            text(
+                "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = :nome AND NOT i.indisvalid"
+            ),
+            {"nome": nome},
+        )
+    ).first()
+    if invalido:
+        await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {nome}"))
+    await conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {nome} ON {definicao}"))
+
+
+# no fim: as migrações importam criar_indice deste módulo
+MIGRACOES = carregar()
+ULTIMA = MIGRACOES[-1].versao if MIGRACOES else 0
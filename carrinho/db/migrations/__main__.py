@@ -0,0 +1,28 @@
+import argparse
+import asyncio
+
+from carrinho.db.migrations import MIGRACOES, aplicadas, migrar
+from carrinho.db.postgres_db import engine
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--status", action="store_true", help="só lista, não aplica")
+    args = parser.parse_args()
+
+    try:
+        if args.status:
+            async with engine.connect() as conn:
+                feitas = await aplicadas(conn)
+            for migracao in MIGRACOES:
+                marca = "x" if migracao.versao in feitas else " "
+                print(f"[{marca}] {migracao.nome}: {migracao.modulo.DESCRICAO}")
+            return
+        rodadas = await migrar(engine)
+        print("\n".join(rodadas) if rodadas else "banco em dia")
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
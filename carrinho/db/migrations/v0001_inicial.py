@@ -0,0 +1,71 @@
+"""Esquema de partida: as tabelas como o create_all as criava.
+
+Tudo com IF NOT EXISTS, então um banco criado pelo create_all é adotado
+como está; o que mudou em tabela já existente vem depois (o CASCADE de
+endereco.usuario_id, por exemplo, na v0007). Os índices ficam na v0002, que
+os cria sem travar escritas.
+"""
+from sqlalchemy import text
+
+DESCRICAO = "tabelas iniciais"
+TRANSACIONAL = True
+
+COMANDOS = [
+    # os índices de trigrama de Produto dependem da extensão
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """
+    CREATE TABLE IF NOT EXISTS usuario (
+        id SERIAL PRIMARY KEY,
+        nome VARCHAR NOT NULL,
+        email VARCHAR NOT NULL UNIQUE,
+        senha VARCHAR NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS endereco (
+        id SERIAL PRIMARY KEY,
+        usuario_id INTEGER NOT NULL REFERENCES usuario (id) ON DELETE CASCADE,
+        rua VARCHAR NOT NULL,
+        cep VARCHAR NOT NULL,
+        cidade VARCHAR NOT NULL,
+        estado VARCHAR NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS produto (
+        id SERIAL PRIMARY KEY,
+        nome VARCHAR NOT NULL,
+        descricao VARCHAR NOT NULL,
+        marca VARCHAR NOT NULL,
+        tamanho INTEGER NOT NULL,
+        cor VARCHAR NOT NULL,
+        preco NUMERIC(10, 2) NOT NULL,
+        versao INTEGER NOT NULL DEFAULT 1
+    )
+    """,
+    # bancos criados antes da coluna de versão
+    "ALTER TABLE produto ADD COLUMN IF NOT EXISTS versao INTEGER NOT NULL DEFAULT 1",
+    """
+    CREATE TABLE IF NOT EXISTS carrinho (
+        id SERIAL PRIMARY KEY,
+        usuario_id INTEGER NOT NULL UNIQUE REFERENCES usuario (id) ON DELETE CASCADE,
+        quantidade_de_produtos INTEGER NOT NULL,
+        preco_total NUMERIC(12, 2) NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS itemcarrinho (
+        id SERIAL PRIMARY KEY,
+        carrinho_id INTEGER NOT NULL REFERENCES carrinho (id) ON DELETE CASCADE,
+        produto_id INTEGER NOT NULL REFERENCES produto (id),
+        quantidade INTEGER NOT NULL,
+        preco_unitario NUMERIC(10, 2) NOT NULL,
+        UNIQUE (carrinho_id, produto_id)
+    )
+    """,
+]
+
+
+async def aplicar(conn):
+    for comando in COMANDOS:
+        await conn.execute(text(comando))
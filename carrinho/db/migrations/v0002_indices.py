@@ -0,0 +1,28 @@
+"""Índices dos padrões de consulta dos adapters, criados com CONCURRENTLY.
+
+- endereco.usuario_id: AddressAdapter.delete filtra os endereços do usuário
+  e o ON DELETE CASCADE de usuario procura por ele
+- itemcarrinho.produto_id: a FK de produto; sem ele apagar um produto varre
+  itemcarrinho inteira
+- produto: (preco, id) e (nome, id) da paginação por cursor e os GIN de
+  trigrama do ILIKE da busca
+"""
+from carrinho.db.migrations import criar_indice
+
+DESCRICAO = "índices de endereço, item de carrinho e produto"
+TRANSACIONAL = False
+
+INDICES = [
+    ("ix_endereco_usuario_id", "endereco (usuario_id)"),
+    ("ix_itemcarrinho_produto_id", "itemcarrinho (produto_id)"),
+    ("ix_produto_preco_id", "produto (preco, id)"),
+    ("ix_produto_nome_id", "produto (nome, id)"),
+    ("ix_produto_nome_trgm", "produto USING gin (nome gin_trgm_ops)"),
+    ("ix_produto_marca_trgm", "produto USING gin (marca gin_trgm_ops)"),
+    ("ix_produto_descricao_trgm", "produto USING gin (descricao gin_trgm_ops)"),
+]
+
+
+async def aplicar(conn):
+    for nome, definicao in INDICES:
+        await criar_indice(conn, nome, definicao)
@@ -0,0 +1,14 @@
+"""Versão do usuário, usada como ETag de GET /usuario/{email}/.
+
+ADD COLUMN com DEFAULT constante não reescreve a tabela (Postgres 11+).
+"""
+from sqlalchemy import text
+
+DESCRICAO = "coluna versao em usuario"
+TRANSACIONAL = True
+
+
+async def aplicar(conn):
+    await conn.execute(
+        text("ALTER TABLE usuario ADD COLUMN IF NOT EXISTS versao INTEGER NOT NULL DEFAULT 1")
+    )
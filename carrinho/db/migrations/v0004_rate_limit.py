@@ -0,0 +1,21 @@
+"""Tabela dos token buckets quando RATE_LIMIT_STORE=postgres.
+
+UNLOGGED: não passa pelo WAL (escrita bem mais barata) e é esvaziada num
+crash, o que para limite de taxa não faz falta.
+"""
+from sqlalchemy import text
+
+DESCRICAO = "tabela de rate limit"
+TRANSACIONAL = True
+
+
+async def aplicar(conn):
+    await conn.execute(
+        text(
+            "CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit ("
+            "chave varchar PRIMARY KEY, "
+            "tokens double precision NOT NULL, "
+            "atualizado timestamptz NOT NULL, "
+            "permitido boolean NOT NULL)"
+        )
+    )
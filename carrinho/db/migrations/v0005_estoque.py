@@ -0,0 +1,39 @@
+"""Estoque em fatias e reservas com validade (ver carrinho/db/estoque.py).
+
+Tabelas novas e vazias: os índices podem ser criados na mesma transação.
+fillfactor 50 em estoque deixa espaço na página para os UPDATE da
+quantidade serem HOT (sem nova entrada no índice a cada reserva).
+"""
+from sqlalchemy import text
+
+DESCRICAO = "estoque e reservas"
+TRANSACIONAL = True
+
+COMANDOS = [
+    """
+    CREATE TABLE IF NOT EXISTS estoque (
+        produto_id INTEGER NOT NULL REFERENCES produto (id) ON DELETE CASCADE,
+        fatia SMALLINT NOT NULL,
+        quantidade INTEGER NOT NULL,
+        PRIMARY KEY (produto_id, fatia),
+        CONSTRAINT ck_estoque_quantidade CHECK (quantidade >= 0)
+    ) WITH (fillfactor = 50)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS reserva (
+        id BIGSERIAL PRIMARY KEY,
+        produto_id INTEGER NOT NULL REFERENCES produto (id) ON DELETE CASCADE,
+        fatia SMALLINT NOT NULL,
+        quantidade INTEGER NOT NULL,
+        usuario_id INTEGER,
+        expira_em TIMESTAMPTZ NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_reserva_expira_em ON reserva (expira_em)",
+    "CREATE INDEX IF NOT EXISTS ix_reserva_produto_id ON reserva (produto_id)",
+]
+
+
+async def aplicar(conn):
+    for comando in COMANDOS:
+        await conn.execute(text(comando))
@@ -0,0 +1,43 @@
+"""Tabela outbox e o trigger que avisa o despachante (ver carrinho/db/outbox.py).
+
+O trigger é por comando (FOR EACH STATEMENT) e o Postgres junta NOTIFY
+iguais da mesma transação: uma escrita com vários eventos gera um aviso só.
+"""
+from sqlalchemy import text
+
+DESCRICAO = "outbox transacional"
+TRANSACIONAL = True
+
+COMANDOS = [
+    """
+    CREATE TABLE IF NOT EXISTS outbox (
+        id BIGSERIAL PRIMARY KEY,
+        topico VARCHAR NOT NULL,
+        carga JSONB NOT NULL,
+        criado_em TIMESTAMPTZ NOT NULL DEFAULT now(),
+        disponivel_em TIMESTAMPTZ NOT NULL DEFAULT now(),
+        tentativas INTEGER NOT NULL DEFAULT 0,
+        erro TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_outbox_disponivel_em ON outbox (disponivel_em, id)",
+    """
+    CREATE OR REPLACE FUNCTION outbox_notificar() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        PERFORM pg_notify('outbox', '');
+        RETURN NULL;
+    END
+    $$
+    """,
+    "DROP TRIGGER IF EXISTS outbox_notificar ON outbox",
+    """
+    CREATE TRIGGER outbox_notificar AFTER INSERT ON outbox
+    FOR EACH STATEMENT EXECUTE FUNCTION outbox_notificar()
+    """,
+]
+
+
+async def aplicar(conn):
+    for comando in COMANDOS:
+        await conn.execute(text(comando))
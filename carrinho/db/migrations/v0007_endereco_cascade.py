@@ -0,0 +1,22 @@
+"""ON DELETE CASCADE em endereco.usuario_id para bancos anteriores a ele.
+
+O create_all antigo criou a FK sem CASCADE e a v0001 (IF NOT EXISTS) não
+mexe em tabela existente; sem isto o DELETE único de UserAdapter.delete
+falha com violação de FK para usuários com endereço. Recriar a FK é
+idempotente: em banco novo ela só é trocada por uma igual.
+"""
+from sqlalchemy import text
+
+DESCRICAO = "FK de endereco com ON DELETE CASCADE"
+TRANSACIONAL = True
+
+
+async def aplicar(conn):
+    await conn.execute(
+        text(
+            "ALTER TABLE endereco "
+            "DROP CONSTRAINT IF EXISTS endereco_usuario_id_fkey, "
+            "ADD CONSTRAINT endereco_usuario_id_fkey FOREIGN KEY (usuario_id) "
+            "REFERENCES usuario (id) ON DELETE CASCADE"
+        )
+    )
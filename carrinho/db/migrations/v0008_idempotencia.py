@@ -0,0 +1,28 @@
+"""Chaves de idempotência gravadas junto com a escrita (ver _idempotente em
+postgres_adapter.py), para valerem entre workers e depois de um restart.
+
+As vencidas (IDEMPOTENCY_TTL) são apagadas em segundo plano pelo índice em
+criado.
+"""
+from sqlalchemy import text
+
+DESCRICAO = "tabela de chaves de idempotência"
+TRANSACIONAL = True
+
+COMANDOS = [
+    """
+    CREATE TABLE IF NOT EXISTS idempotencia (
+        escopo VARCHAR NOT NULL,
+        chave VARCHAR NOT NULL,
+        resposta JSONB,
+        criado TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (escopo, chave)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_idempotencia_criado ON idempotencia (criado)",
+]
+
+
+async def aplicar(conn):
+    for comando in COMANDOS:
+        await conn.execute(text(comando))
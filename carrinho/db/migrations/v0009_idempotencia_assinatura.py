@@ -0,0 +1,15 @@
+"""Assinatura do pedido ao lado da chave de idempotência: a mesma chave com
+outro pedido é recusada em vez de devolver a resposta do primeiro.
+
+Chaves gravadas antes desta coluna ficam com NULL e são aceitas até vencerem.
+"""
+from sqlalchemy import text
+
+DESCRICAO = "assinatura do pedido em idempotencia"
+TRANSACIONAL = True
+
+
+async def aplicar(conn):
+    await conn.execute(
+        text("ALTER TABLE idempotencia ADD COLUMN IF NOT EXISTS assinatura VARCHAR")
+    )
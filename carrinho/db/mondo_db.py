@@ -1,6 +1,43 @@
 from os import environ
 
+from decimal import Decimal
+
+from bson.codec_options import CodecOptions, TypeCodec, TypeRegistry
+from bson.decimal128 import Decimal128
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, ReturnDocument, monitoring
+
+from carrinho.metrics import registrar_query
+
+
+class ComandosMongo(monitoring.CommandListener):
+    # o equivalente do before/after_cursor_execute do Postgres
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        registrar_query("mongo", event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        registrar_query("mongo", event.command_name, event.duration_micros / 1e6)
+
+
+class DecimalCodec(TypeCodec):
+    # preco é Decimal nos models; no Mongo fica como Decimal128, sem perder centavos
+    python_type = Decimal
+    bson_type = Decimal128
+
+    def transform_python(self, value):
+        return Decimal128(value)
+
+    def transform_bson(self, value):
+        return value.to_decimal()
+
+
+codec_options = CodecOptions(type_registry=TypeRegistry([DecimalCodec()]))
+
+max_pool_size = int(environ.get("MONGO_MAX_POOL_SIZE", 100))
+min_pool_size = int(environ.get("MONGO_MIN_POOL_SIZE", 10))
 
 
 class DataBase:
@@ -11,31 +48,85 @@ class DataBase:
     product_collection = None
     order_collection = None
     order_items_collection = None
+    counters_collection = None
+    estoque_collection = None
+    reservas_collection = None
+
+
+# um único client por processo, aberto no startup e fechado no shutdown;
+# o pool de conexões do Motor é compartilhado por todas as requisições
+database = DataBase()
 
 
 async def get_db():
-    db = DataBase()
-    try:
-        await connect_db(db)
-        yield db
-    finally:
-        await disconnect_db(db)
+    if database.client is None:
+        raise RuntimeError("Mongo não conectado: chame connect_db no startup")
+    yield database
 
 
-async def connect_db(db: DataBase):
-    # conexao mongo, com no máximo 10 conexões async
+async def connect_db(db: DataBase = database):
     db.client = AsyncIOMotorClient(
         db.database_uri,
-        maxPoolSize=10,
-        minPoolSize=10,
+        maxPoolSize=max_pool_size,
+        minPoolSize=min_pool_size,
+        event_listeners=[ComandosMongo()],
     )
 
-    db.users_collection = db.client.shopping_cart.users
-    db.address_collection = db.client.shopping_cart.address
-    db.product_collection = db.client.shopping_cart.products
-    db.order_collection = db.client.shopping_cart.orders
-    db.order_items_collection = db.client.shopping_cart.order_items
+    shopping_cart = db.client.get_database("shopping_cart", codec_options=codec_options)
+    db.users_collection = shopping_cart.users
+    db.address_collection = shopping_cart.address
+    db.product_collection = shopping_cart.products
+    db.order_collection = shopping_cart.orders
+    db.order_items_collection = shopping_cart.order_items
+    db.counters_collection = shopping_cart.counters
+    db.estoque_collection = shopping_cart.stock
+    db.reservas_collection = shopping_cart.reservations
+
+
+async def ensure_indexes(db: DataBase = database):
+    # idempotente: o Mongo ignora índices que já existem com a mesma definição
+    await db.users_collection.create_index("email", unique=True)
+    await db.users_collection.create_index("id", unique=True)
+    await db.product_collection.create_index("id", unique=True)
+    # mesmas chaves de ordenação da busca paginada do Postgres
+    await db.product_collection.create_index([("preco", ASCENDING), ("id", ASCENDING)])
+    await db.product_collection.create_index([("nome", ASCENDING), ("id", ASCENDING)])
+    await db.order_collection.create_index("id_usuario", unique=True)
+    await db.order_items_collection.create_index(
+        [("id_usuario", ASCENDING), ("id_produto", ASCENDING)], unique=True
+    )
+    await db.estoque_collection.create_index(
+        [("produto_id", ASCENDING), ("fatia", ASCENDING)], unique=True
+    )
+    await db.reservas_collection.create_index("id", unique=True)
+    await db.reservas_collection.create_index("expira_em")
+    await db.reservas_collection.create_index("produto_id")
+
+
+async def proximo_id(nome: str, quantidade: int = 1, db: DataBase = database) -> int:
+    """Reserva `quantidade` ids sequenciais e devolve o primeiro.
+
+    O Mongo não tem SERIAL; os ids inteiros das rotas vêm de um contador.
+    """
+    contador = await db.counters_collection.find_one_and_update(
+        {"_id": nome},
+        {"$inc": {"seq": quantidade}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return contador["seq"] - quantidade + 1
+
+
+async def disconnect_db(db: DataBase = database):
+    if db.client is not None:
+        db.client.close()
+        db.client = None
+
+
+async def on_startup():
+    await connect_db()
+    await ensure_indexes()
 
 
-async def disconnect_db(db: DataBase):
-    db.client.close()
+async def on_shutdown():
+    await disconnect_db()
@@ -1,14 +1,53 @@
 import logging
-from typing import Any, List
+import random
+import re
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Any, AsyncIterator, List, Optional
 
-import models
 from fastapi import Depends
 from pydantic import BaseModel, EmailStr
-from pymongo.errors import DuplicateKeyError, PyMongoError
+from pymongo import ASCENDING, DESCENDING, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 
-from carrinho.db.base import BaseAdapter
-from carrinho.db.exception import ObjetoNaoEncontrado, ObjetoNaoModificado
-from carrinho.db.mondo_db import DataBase, get_db
+from carrinho import models
+from carrinho.cache import ProductCache, product_cache
+from carrinho.db.base import MAX_FILTRO, BaseAdapter
+from carrinho.db.carregador import CarregadorLote
+from carrinho.db.escritas import idempotencia
+from carrinho.db.estoque import RESERVA_TTL, varredor_de_reservas
+from carrinho.db.exception import (CursorInvalido, EstoqueInsuficiente,
+                                   ObjetoDuplicado, ObjetoNaoEncontrado,
+                                   ObjetoNaoModificado, VersaoConflitante)
+from carrinho.db.mondo_db import DataBase, database, get_db, proximo_id
+from carrinho.db.pagination import decode_cursor, encode_cursor
+
+MAX_LIMITE = 100
+
+# ordem -> (campo, direção); (preco, id) e (nome, id) têm índice (ensure_indexes)
+ORDENS_PRODUTO = {
+    "id": ("id", ASCENDING),
+    "-id": ("id", DESCENDING),
+    "preco": ("preco", ASCENDING),
+    "-preco": ("preco", DESCENDING),
+    "nome": ("nome", ASCENDING),
+    "-nome": ("nome", DESCENDING),
+}
+
+SEM_ID = {"_id": 0}
+
+
+async def _produtos_por_id(collection, ids: list) -> dict:
+    produtos = await collection.find({"id": {"$in": ids}}, SEM_ID).to_list(length=None)
+    return {produto["id"]: produto for produto in produtos}
+
+
+async def _buscar_produtos(ids: list) -> dict:
+    return await _produtos_por_id(database.product_collection, ids)
+
+
+carregador = CarregadorLote.do_ambiente(_buscar_produtos)
 
 
 class MongoBaseAdapter(BaseAdapter):
@@ -21,7 +60,7 @@ class MongoBaseAdapter(BaseAdapter):
             return data
         except DuplicateKeyError as e:
             logging.error(e)
-            raise
+            raise ObjetoDuplicado from e
 
     async def update(
         self,
@@ -39,84 +78,658 @@ class MongoBaseAdapter(BaseAdapter):
             raise ObjetoNaoModificado
         return data
 
-    async def get(self, id: Any, key: str) -> BaseModel:
+    async def get(self, id: Any, key: str) -> dict:
+        data = await self.collection.find_one({key: id}, SEM_ID)
+        if data is None:
+            raise ObjetoNaoEncontrado
+        return data
+
+    async def get_all(
+        self, limit: int = 10, cursor: Optional[str] = None, key: str = "id"
+    ) -> tuple[List[dict], Optional[str]]:
+        # keyset sobre `key` (precisa de índice): o custo não cresce com a página
+        filtro = {}
+        ultimo = decode_cursor(cursor, 1)
+        if ultimo is not None:
+            filtro = {key: {"$gt": ultimo[0]}}
+        limit = min(limit, MAX_LIMITE)
+        data = await self.collection.find(filtro, SEM_ID).sort(key).limit(
+            limit + 1
+        ).to_list(length=limit + 1)
+        proximo = None
+        if len(data) > limit:
+            data = data[:limit]
+            proximo = encode_cursor([data[-1][key]])
+        return data, proximo
+
+    async def stream_all(self, key: str = "id") -> AsyncIterator[dict]:
+        async for doc in self.collection.find({}, SEM_ID).sort(key).batch_size(1000):
+            yield doc
+
+    async def bulk_insert(self, docs: List[dict]) -> List[tuple[int, str]]:
+        """Insere tudo de uma vez; devolve (índice no lote, erro) das que falharam."""
+        if not docs:
+            return []
         try:
-            data = await self.collection.find_one({key: id})
-            return data
-        except Exception as e:
-            logging.error(e)
-            return
+            await self.collection.insert_many(docs, ordered=False)
+            return []
+        except BulkWriteError as e:
+            return [(erro["index"], erro["errmsg"]) for erro in e.details["writeErrors"]]
 
-    async def get_all(self, skip: int = 0, limit: int = 10) -> List[BaseModel]:
+    async def bulk_upsert(self, docs: List[dict], key: str) -> List[tuple[int, str]]:
+        if not docs:
+            return []
+        operacoes = [ReplaceOne({key: doc[key]}, doc, upsert=True) for doc in docs]
+        return await self._bulk_write(operacoes)
+
+    async def _bulk_write(self, operacoes: list) -> List[tuple[int, str]]:
         try:
-            cursor = self.collection.find().skip(skip).limit(limit)
-            data = await cursor.to_list(length=limit)
-            return data
-        except Exception as e:
-            logging.error(e)
-            return
+            await self.collection.bulk_write(operacoes, ordered=False)
+            return []
+        except BulkWriteError as e:
+            return [(erro["index"], erro["errmsg"]) for erro in e.details["writeErrors"]]
 
     async def delete(self, id: Any, key: str):
         try:
             data = await self.collection.delete_one({key: id})
             if data.deleted_count == 0:
-                return False
-            return True
+                raise ObjetoNaoEncontrado
         except PyMongoError as e:
             logging.error(e)
             raise
 
 
 class UserAdapter(MongoBaseAdapter):
-    async def create(self, data: models.Usuario) -> models.Usuario:
-        return await super().create(data)
-
-    async def create_addr(
-        self,
-        email: EmailStr,
-        endereco: models.Endereco,
-    ) -> models.Usuario:
-        return await super().update(endereco, email, "email", update_key="endereco")
+    async def create(self, data: BaseModel) -> dict:
+        usuario = data.dict(exclude_none=True, exclude={"id", "enderecos"})
+        usuario["id"] = await proximo_id("usuarios")
+        usuario["enderecos"] = []
+        usuario["versao"] = 1
+        try:
+            await self.collection.insert_one(usuario)
+        except DuplicateKeyError as e:
+            raise ObjetoDuplicado from e
+        usuario.pop("_id")
+        return usuario
 
-    async def get(self, email: EmailStr) -> models.Usuario:
+    async def get(self, email: EmailStr) -> dict:
         return await super().get(email, key="email")
 
-    async def get_all(self, skip: int = 0, limit: int = 10) -> List[models.Usuario]:
-        return await super().get_all(skip=skip, limit=limit)
+    async def get_all(
+        self, limit: int = 10, cursor: Optional[str] = None
+    ) -> tuple[List[dict], Optional[str]]:
+        return await super().get_all(limit=limit, cursor=cursor)
+
+    async def get_senha(self, email: EmailStr) -> str:
+        usuario = await self.collection.find_one({"email": email}, {"senha": 1})
+        if usuario is None:
+            raise ObjetoNaoEncontrado
+        return usuario["senha"]
+
+    async def atualizar_senha(self, email: EmailStr, senha: str):
+        updated = await self.collection.update_one(
+            {"email": email}, {"$set": {"senha": senha}}
+        )
+        if updated.matched_count == 0:
+            raise ObjetoNaoEncontrado
 
     async def delete(self, email: EmailStr):
-        return await super().delete(email, key="email")
+        usuario = await self.collection.find_one_and_delete({"email": email}, {"id": 1})
+        if usuario is None:
+            raise ObjetoNaoEncontrado
+        return usuario
+
+    async def stream_all(self) -> AsyncIterator[models.UsuarioResposta]:
+        async for doc in super().stream_all():
+            yield models.UsuarioResposta(**doc)
+
 
-    async def remover_endereco(self, endereco: models.Endereco, email):
+class AddressAdapter(MongoBaseAdapter):
+    # os endereços ficam embutidos no documento do usuário
+    async def create(self, email: EmailStr, endereco: models.Endereco) -> models.Endereco:
         updated = await self.collection.update_one(
             {"email": email},
+            {"$push": {"enderecos": endereco.dict()}, "$inc": {"versao": 1}},
+        )
+        if updated.matched_count == 0:
+            raise ObjetoNaoEncontrado
+        return endereco
+
+    async def delete(self, email: EmailStr, endereco: models.Endereco):
+        # mesmo critério do Postgres: cep, cidade e estado
+        updated = await self.collection.update_one(
+            {
+                "email": email,
+                "enderecos": {
+                    "$elemMatch": {
+                        "cep": endereco.cep,
+                        "cidade": endereco.cidade,
+                        "estado": endereco.estado,
+                    }
+                },
+            },
             {
                 "$pull": {
-                    "endereco": {
-                        "rua": endereco.rua,
+                    "enderecos": {
                         "cep": endereco.cep,
                         "cidade": endereco.cidade,
                         "estado": endereco.estado,
                     }
-                }
+                },
+                "$inc": {"versao": 1},
             },
         )
         if updated.matched_count == 0:
             raise ObjetoNaoEncontrado
-        if updated.modified_count == 0:
-            raise ObjetoNaoModificado
-        return endereco
 
 
 class ProductAdapter(MongoBaseAdapter):
-    async def create(self, data: models.Produto) -> models.Produto:
-        return await super().create(data)
+    def __init__(self, collection, cache: ProductCache = None, carregador=None):
+        self.collection = collection
+        self.cache = cache
+        self.carregador = carregador
+
+    async def create(self, data: BaseModel) -> dict:
+        produto = data.dict(exclude_none=True)
+        produto["id"] = await proximo_id("produtos")
+        produto["versao"] = 1
+        await self.collection.insert_one(produto)
+        produto.pop("_id")
+        if self.cache:
+            await self.cache.invalidar(produto["id"])
+        return produto
 
-    async def get(self, id_produto: int) -> models.Produto:
-        return await super().get(id_produto, key="id")
+    async def get(self, id_produto: int) -> dict:
+        if self.cache:
+            produto = self.cache.get(id_produto)
+            if produto is not None:
+                return produto
+            geracao = self.cache.geracao
+        if self.carregador:
+            produto = await self.carregador.carregar(id_produto)
+            if produto is None:
+                raise ObjetoNaoEncontrado
+        else:
+            produto = await super().get(id_produto, key="id")
+        if self.cache:
+            self.cache.set(id_produto, produto, geracao)
+        return produto
+
+    async def get_many(self, ids: List[int]) -> dict:
+        """Os produtos de `ids` que existem, num único find com $in."""
+        encontrados = {}
+        faltando = list(ids)
+        if self.cache:
+            geracao = self.cache.geracao
+            faltando = []
+            for id_produto in ids:
+                produto = self.cache.get(id_produto)
+                if produto is None:
+                    faltando.append(id_produto)
+                else:
+                    encontrados[id_produto] = produto
+        if faltando:
+            lidos = await _produtos_por_id(self.collection, faltando)
+            if self.cache:
+                for id_produto, produto in lidos.items():
+                    self.cache.set(id_produto, produto, geracao)
+            encontrados.update(lidos)
+        return encontrados
+
+    async def filter(self, **kwargs: dict[str, str]) -> List[dict]:
+        if self.cache:
+            produtos = self.cache.get_filtro(kwargs)
+            if produtos is not None:
+                return produtos
+            geracao = self.cache.geracao
+        produtos = await self.collection.find(kwargs, SEM_ID).sort("id").limit(
+            MAX_FILTRO + 1
+        ).to_list(length=MAX_FILTRO + 1)
+        if not produtos:
+            raise ObjetoNaoEncontrado
+        if self.cache:
+            self.cache.set_filtro(kwargs, produtos, geracao)
+        return produtos
+
+    async def search(
+        self,
+        nome: Optional[str] = None,
+        marca: Optional[str] = None,
+        descricao: Optional[str] = None,
+        preco_min: Optional[Decimal] = None,
+        preco_max: Optional[Decimal] = None,
+        ordem: str = "id",
+        limite: int = 20,
+        cursor: Optional[str] = None,
+    ) -> tuple[List[dict], Optional[str]]:
+        campo, direcao = ORDENS_PRODUTO[ordem]
+        limite = min(limite, MAX_LIMITE)
+        filtro = _filtrar_produtos(nome, marca, descricao, preco_min, preco_max)
+        ultimo = decode_cursor(cursor, 1 if campo == "id" else 2)
+        if ultimo is not None:
+            filtro = {"$and": [filtro, _depois_de(campo, direcao, ultimo, cursor)]}
+        produtos = await self.collection.find(filtro, SEM_ID).sort(
+            _ordenacao(campo, direcao)
+        ).limit(limite + 1).to_list(length=limite + 1)
+        proximo = None
+        if len(produtos) > limite:
+            produtos = produtos[:limite]
+            chaves = [campo, "id"] if campo != "id" else ["id"]
+            proximo = encode_cursor([produtos[-1][chave] for chave in chaves])
+        return produtos, proximo
+
+    async def stream_search(
+        self,
+        nome: Optional[str] = None,
+        marca: Optional[str] = None,
+        descricao: Optional[str] = None,
+        preco_min: Optional[Decimal] = None,
+        preco_max: Optional[Decimal] = None,
+        ordem: str = "id",
+    ) -> AsyncIterator[models.Produto]:
+        campo, direcao = ORDENS_PRODUTO[ordem]
+        filtro = _filtrar_produtos(nome, marca, descricao, preco_min, preco_max)
+        cursor = self.collection.find(filtro, SEM_ID).sort(_ordenacao(campo, direcao))
+        async for doc in cursor.batch_size(1000):
+            yield models.Produto(**doc)
+
+    async def get_all(
+        self, limit: int = 10, cursor: Optional[str] = None
+    ) -> tuple[List[dict], Optional[str]]:
+        return await super().get_all(limit=limit, cursor=cursor, key="id")
+
+    async def update(
+        self,
+        id: int,
+        data: models.ProdutoFilter,
+        chave_idempotencia: Optional[str] = None,
+        versao: Optional[int] = None,
+    ) -> dict:
+        filtro = {"id": id}
+        if versao is not None:
+            filtro["versao"] = versao
+        produto = await idempotencia.executar(
+            f"produto.update.{id}",
+            chave_idempotencia,
+            lambda: self.collection.find_one_and_update(
+                filtro,
+                {"$set": data.dict(exclude_none=True), "$inc": {"versao": 1}},
+                projection=SEM_ID,
+                return_document=ReturnDocument.AFTER,
+            ),
+            {"dados": data.dict(exclude_none=True), "versao": versao},
+        )
+        if produto is None:
+            if versao is not None and await self.collection.find_one({"id": id}, {"_id": 1}):
+                raise VersaoConflitante(id)
+            raise ObjetoNaoEncontrado
+        if self.cache:
+            await self.cache.invalidar(id)
+        return produto
 
     async def delete(self, id_produto: int):
-        return await super().delete(id_produto, key="id")
+        await super().delete(id_produto, key="id")
+        if self.cache:
+            await self.cache.invalidar(id_produto)
+
+    async def bulk_create(
+        self, linhas: List[tuple[int, dict]], upsert: bool = False
+    ) -> tuple[int, List[tuple[int, str]]]:
+        sem_id = [dados for _, dados in linhas if "id" not in dados]
+        if sem_id:
+            primeiro = await proximo_id("produtos", len(sem_id))
+            for deslocamento, dados in enumerate(sem_id):
+                dados["id"] = primeiro + deslocamento
+        docs = [dados for _, dados in linhas]
+        if upsert:
+            # $inc cria a versão 1 nos novos e avança a dos que já existiam
+            falhas = await self._bulk_write(
+                [
+                    UpdateOne(
+                        {"id": doc["id"]},
+                        {"$set": doc, "$inc": {"versao": 1}},
+                        upsert=True,
+                    )
+                    for doc in docs
+                ]
+            )
+        else:
+            for doc in docs:
+                doc["versao"] = 1
+            falhas = await self.bulk_insert(docs)
+        erros = [(linhas[indice][0], erro) for indice, erro in falhas]
+        if self.cache:
+            await self.cache.invalidar_tudo()
+        return len(linhas) - len(erros), erros
+
+    async def stream_all(self) -> AsyncIterator[models.Produto]:
+        async for doc in super().stream_all():
+            yield models.Produto(**doc)
+
+
+def _filtrar_produtos(
+    nome: Optional[str],
+    marca: Optional[str],
+    descricao: Optional[str],
+    preco_min: Optional[Decimal],
+    preco_max: Optional[Decimal],
+) -> dict:
+    filtro = {}
+    for campo, termo in (("nome", nome), ("marca", marca), ("descricao", descricao)):
+        if termo:
+            # equivalente ao ILIKE '%termo%' do Postgres
+            filtro[campo] = {"$regex": re.escape(termo), "$options": "i"}
+    preco = {}
+    if preco_min is not None:
+        preco["$gte"] = preco_min
+    if preco_max is not None:
+        preco["$lte"] = preco_max
+    if preco:
+        filtro["preco"] = preco
+    return filtro
+
+
+def _ordenacao(campo: str, direcao: int) -> list:
+    if campo == "id":
+        return [("id", direcao)]
+    return [(campo, direcao), ("id", direcao)]
+
+
+def _depois_de(campo: str, direcao: int, ultimo: list, cursor: str) -> dict:
+    # keyset: (campo, id) estritamente depois da última linha da página
+    operador = "$gt" if direcao == ASCENDING else "$lt"
+    try:
+        if campo == "id":
+            (ultimo_id,) = ultimo
+            return {"id": {operador: int(ultimo_id)}}
+        valor, ultimo_id = ultimo
+        if campo == "preco":
+            valor = Decimal(valor)
+        return {
+            "$or": [
+                {campo: {operador: valor}},
+                {campo: valor, "id": {operador: int(ultimo_id)}},
+            ]
+        }
+    except (ArithmeticError, TypeError, ValueError):
+        raise CursorInvalido(cursor)
+
+
+class CartAdapter(MongoBaseAdapter):
+    # collection: carrinhos ({id_usuario, preco_total, quantidade_de_produtos})
+    # itens: um documento por (id_usuario, id_produto)
+    def __init__(self, collection, itens, produtos, usuarios):
+        self.collection = collection
+        self.itens = itens
+        self.produtos = produtos
+        self.usuarios = usuarios
+
+    async def add_item(
+        self, id_usuario: int, id_produto: int, chave_idempotencia: Optional[str] = None
+    ) -> models.TotalCarrinho:
+        return await idempotencia.executar(
+            f"carrinho.add_item.{id_usuario}.{id_produto}",
+            chave_idempotencia,
+            lambda: self._add_item(id_usuario, id_produto),
+        )
+
+    async def _add_item(self, id_usuario: int, id_produto: int) -> models.TotalCarrinho:
+        if not await self.usuarios.find_one({"id": id_usuario}, {"_id": 1}):
+            raise ObjetoNaoEncontrado
+        produto = await self.produtos.find_one({"id": id_produto}, {"preco": 1})
+        if not produto:
+            raise ObjetoNaoEncontrado
+        item = await self.itens.find_one_and_update(
+            {"id_usuario": id_usuario, "id_produto": id_produto},
+            {
+                "$inc": {"quantidade": 1},
+                "$setOnInsert": {"preco_unitario": produto["preco"]},
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return await self._somar(id_usuario, 1, item["preco_unitario"])
+
+    async def remove_item(
+        self, id_usuario: int, id_produto: int, chave_idempotencia: Optional[str] = None
+    ) -> models.TotalCarrinho:
+        return await idempotencia.executar(
+            f"carrinho.remove_item.{id_usuario}.{id_produto}",
+            chave_idempotencia,
+            lambda: self._remove_item(id_usuario, id_produto),
+        )
+
+    async def _remove_item(self, id_usuario: int, id_produto: int) -> models.TotalCarrinho:
+        # só baixa item com quantidade: dois removes do último item não
+        # deixam -1 nem descontam o total duas vezes
+        item = await self.itens.find_one_and_update(
+            {"id_usuario": id_usuario, "id_produto": id_produto, "quantidade": {"$gt": 0}},
+            {"$inc": {"quantidade": -1}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if not item:
+            raise ObjetoNaoEncontrado
+        if item["quantidade"] <= 0:
+            await self.itens.delete_one({"_id": item["_id"], "quantidade": {"$lte": 0}})
+        # sem upsert: um remove que cruza com o delete do carrinho não o recria
+        return await self._somar(id_usuario, -1, -item["preco_unitario"], upsert=False)
+
+    async def _somar(
+        self, id_usuario: int, quantidade: int, valor: Decimal, upsert: bool = True
+    ) -> models.TotalCarrinho:
+        carrinho = await self.collection.find_one_and_update(
+            {"id_usuario": id_usuario},
+            {"$inc": {"quantidade_de_produtos": quantidade, "preco_total": valor}},
+            upsert=upsert,
+            return_document=ReturnDocument.AFTER,
+        )
+        if not carrinho:
+            raise ObjetoNaoEncontrado
+        return _total(carrinho)
+
+    async def get(self, id_usuario: int) -> models.CarrinhoDeCompras:
+        carrinho = await self.collection.find_one({"id_usuario": id_usuario})
+        if not carrinho:
+            raise ObjetoNaoEncontrado
+        itens = await self.itens.find({"id_usuario": id_usuario}).to_list(length=None)
+        return models.CarrinhoDeCompras(
+            id_usuario=id_usuario,
+            itens=[
+                models.ItemCarrinho(
+                    id_produto=item["id_produto"],
+                    quantidade=item["quantidade"],
+                    preco_unitario=item["preco_unitario"],
+                )
+                for item in itens
+            ],
+            **_total(carrinho).dict(),
+        )
+
+    async def get_total(self, id_usuario: int) -> models.TotalCarrinho:
+        carrinho = await self.collection.find_one(
+            {"id_usuario": id_usuario},
+            {"preco_total": 1, "quantidade_de_produtos": 1},
+        )
+        if not carrinho:
+            raise ObjetoNaoEncontrado
+        return _total(carrinho)
+
+    async def delete(self, id_usuario: int):
+        apagado = await self.collection.delete_one({"id_usuario": id_usuario})
+        if apagado.deleted_count == 0:
+            raise ObjetoNaoEncontrado
+        await self.itens.delete_many({"id_usuario": id_usuario})
+
+
+def _total(carrinho: dict) -> models.TotalCarrinho:
+    return models.TotalCarrinho(
+        preco_total=carrinho["preco_total"],
+        quantidade_de_produtos=carrinho["quantidade_de_produtos"],
+    )
+
+
+class StockAdapter(MongoBaseAdapter):
+    # collection: um documento por fatia ({produto_id, fatia, quantidade})
+    # reservas: {id, produto_id, fatia, quantidade, usuario_id, expira_em}
+    def __init__(self, collection, reservas, produtos):
+        self.collection = collection
+        self.reservas = reservas
+        self.produtos = produtos
+
+    async def definir(self, id_produto: int, quantidade: int, fatias: int = 1) -> models.Estoque:
+        if not await self.produtos.find_one({"id": id_produto}, {"_id": 1}):
+            raise ObjetoNaoEncontrado
+        base, resto = divmod(quantidade, fatias)
+        await self.collection.bulk_write(
+            [
+                UpdateOne(
+                    {"produto_id": id_produto, "fatia": fatia},
+                    {"$set": {"quantidade": base + (fatia < resto)}},
+                    upsert=True,
+                )
+                for fatia in range(fatias)
+            ]
+        )
+        await self.collection.delete_many({"produto_id": id_produto, "fatia": {"$gte": fatias}})
+        await self.reservas.update_many(
+            {"produto_id": id_produto, "fatia": {"$gte": fatias}},
+            [{"$set": {"fatia": {"$mod": ["$fatia", fatias]}}}],
+        )
+        return await self.get(id_produto)
+
+    async def get(self, id_produto: int) -> models.Estoque:
+        fatias = await self.collection.find(
+            {"produto_id": id_produto}, {"quantidade": 1}
+        ).to_list(length=None)
+        if not fatias:
+            raise ObjetoNaoEncontrado
+        reservado = await self.reservas.aggregate(
+            [
+                {"$match": {"produto_id": id_produto}},
+                {"$group": {"_id": None, "total": {"$sum": "$quantidade"}}},
+            ]
+        ).to_list(length=1)
+        return models.Estoque(
+            produto_id=id_produto,
+            disponivel=sum(fatia["quantidade"] for fatia in fatias),
+            reservado=reservado[0]["total"] if reservado else 0,
+            fatias=len(fatias),
+        )
+
+    async def reservar(
+        self,
+        id_produto: int,
+        quantidade: int,
+        id_usuario: Optional[int] = None,
+        chave_idempotencia: Optional[str] = None,
+    ) -> dict:
+        return await idempotencia.executar(
+            f"estoque.reservar.{id_produto}",
+            chave_idempotencia,
+            lambda: self._reservar(id_produto, quantidade, id_usuario),
+            {"quantidade": quantidade, "usuario_id": id_usuario},
+        )
+
+    async def _reservar(self, id_produto: int, quantidade: int, id_usuario: Optional[int]) -> dict:
+        # $inc condicionado a quantidade >= pedido: a baixa é atômica no
+        # documento. Começa numa fatia sorteada para espalhar as escritas.
+        filtro = {"produto_id": id_produto, "quantidade": {"$gte": quantidade}}
+        baixa = {"$inc": {"quantidade": -quantidade}}
+        fatia = await self.collection.find_one_and_update(
+            {**filtro, "fatia": {"$gte": random.randrange(64)}}, baixa, {"fatia": 1}
+        ) or await self.collection.find_one_and_update(filtro, baixa, {"fatia": 1})
+        if fatia is not None:
+            baixas = {fatia["fatia"]: quantidade}
+        else:
+            baixas = await self._reservar_juntando(id_produto, quantidade)
+        reserva = {
+            "id": await proximo_id("reservas"),
+            "produto_id": id_produto,
+            "fatia": max(baixas, key=baixas.get),
+            "quantidade": quantidade,
+            "usuario_id": id_usuario,
+            "expira_em": datetime.now(timezone.utc) + timedelta(seconds=RESERVA_TTL),
+        }
+        await self.reservas.insert_one(reserva)
+        reserva.pop("_id")
+        return reserva
+
+    async def _reservar_juntando(self, id_produto: int, quantidade: int) -> dict:
+        # nenhuma fatia tem a quantidade inteira: baixa de várias, cada uma
+        # com o mesmo $inc condicional, e devolve tudo se não fechar o pedido
+        fatias = await self.collection.find(
+            {"produto_id": id_produto, "quantidade": {"$gt": 0}}
+        ).sort("quantidade", DESCENDING).to_list(length=None)
+        if not fatias and not await self.collection.find_one({"produto_id": id_produto}):
+            raise ObjetoNaoEncontrado
+        baixas, falta = {}, quantidade
+        for fatia in fatias:
+            baixa = min(falta, fatia["quantidade"])
+            if await self.collection.find_one_and_update(
+                {"_id": fatia["_id"], "quantidade": {"$gte": baixa}},
+                {"$inc": {"quantidade": -baixa}},
+            ):
+                baixas[fatia["fatia"]] = baixa
+                falta -= baixa
+                if not falta:
+                    return baixas
+        if baixas:
+            await self.collection.bulk_write(
+                [
+                    UpdateOne({"produto_id": id_produto, "fatia": f}, {"$inc": {"quantidade": q}})
+                    for f, q in baixas.items()
+                ]
+            )
+        raise EstoqueInsuficiente
+
+    async def confirmar(self, id_reserva: int):
+        # confirmar e vencer apagam o mesmo documento: só um dos dois acontece
+        apagada = await self.reservas.find_one_and_delete(
+            {"id": id_reserva, "expira_em": {"$gt": datetime.now(timezone.utc)}}
+        )
+        if apagada is None:
+            raise ObjetoNaoEncontrado
+
+    async def liberar(self, id_reserva: int):
+        reserva = await self.reservas.find_one_and_delete({"id": id_reserva})
+        if reserva is None:
+            raise ObjetoNaoEncontrado
+        await _devolver(self.collection, [reserva])
+
+
+async def _devolver(estoque, reservas: list):
+    # sem transação: se cair entre apagar a reserva e devolver, as unidades
+    # se perdem (sobra estoque parado), mas nunca há venda a mais
+    devolver = defaultdict(int)
+    for reserva in reservas:
+        devolver[(reserva["produto_id"], reserva["fatia"])] += reserva["quantidade"]
+    if devolver:
+        await estoque.bulk_write(
+            [
+                UpdateOne({"produto_id": p, "fatia": f}, {"$inc": {"quantidade": q}})
+                for (p, f), q in devolver.items()
+            ]
+        )
+
+
+async def liberar_expiradas(lote: int) -> int:
+    agora = datetime.now(timezone.utc)
+    candidatas = await database.reservas_collection.find(
+        {"expira_em": {"$lte": agora}}, {"id": 1}
+    ).sort("expira_em", ASCENDING).limit(lote).to_list(length=lote)
+    liberadas = []
+    for candidata in candidatas:
+        # outro worker (ou a confirmação) pode ter levado a mesma reserva
+        reserva = await database.reservas_collection.find_one_and_delete(
+            {"_id": candidata["_id"], "expira_em": {"$lte": agora}}
+        )
+        if reserva is not None:
+            liberadas.append(reserva)
+    await _devolver(database.estoque_collection, liberadas)
+    return len(liberadas)
+
+
+varredor = varredor_de_reservas(liberar_expiradas)
 
 
 async def get_user_adapter(db: DataBase = Depends(get_db)) -> UserAdapter:
@@ -124,6 +737,28 @@ async def get_user_adapter(db: DataBase = Depends(get_db)) -> UserAdapter:
     return user_adapter
 
 
-async def get_produto_adapter(db: DataBase = Depends(get_db)) -> ProductAdapter:
-    product_adapter = ProductAdapter(db.product_collection)
+async def get_address_adapter(db: DataBase = Depends(get_db)) -> AddressAdapter:
+    address_adapter = AddressAdapter(db.users_collection)
+    return address_adapter
+
+
+async def get_product_adapter(db: DataBase = Depends(get_db)) -> ProductAdapter:
+    product_adapter = ProductAdapter(db.product_collection, product_cache, carregador)
     return product_adapter
+
+
+async def get_cart_adapter(db: DataBase = Depends(get_db)) -> CartAdapter:
+    cart_adapter = CartAdapter(
+        db.order_collection,
+        db.order_items_collection,
+        db.product_collection,
+        db.users_collection,
+    )
+    return cart_adapter
+
+
+async def get_stock_adapter(db: DataBase = Depends(get_db)) -> StockAdapter:
+    stock_adapter = StockAdapter(
+        db.estoque_collection, db.reservas_collection, db.product_collection
+    )
+    return stock_adapter
@@ -0,0 +1,199 @@
+"""Outbox transacional (Postgres).
+
+Os adapters gravam o evento na tabela outbox na mesma transação da escrita:
+ficam os dois ou nenhum. Um trigger faz NOTIFY no canal outbox, que só é
+entregue no commit, e o DespachanteOutbox de cada worker acorda, pega um
+lote com FOR UPDATE SKIP LOCKED (workers diferentes pegam lotes diferentes),
+chama os consumidores e apaga o lote na mesma transação.
+
+Se o processo cair no meio, a transação volta e o lote é entregue de novo:
+a entrega é pelo menos uma vez, então o consumidor precisa tolerar
+repetição (o id do evento serve de chave). O evento que falha volta com
+backoff e, depois de OUTBOX_MAX_TENTATIVAS, fica parado na tabela com o erro.
+
+    from carrinho.db.outbox import assinar
+
+    @assinar("usuario.criado")
+    async def boas_vindas(evento): ...
+"""
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from os import environ
+from typing import Any, Awaitable, Callable, NamedTuple
+
+from sqlalchemy import insert
+
+from carrinho.db.dsn import dsn_asyncpg
+from carrinho.metrics import registrar_coletor
+from carrinho.schemas import Outbox
+
+logger = logging.getLogger(__name__)
+
+CANAL = "outbox"
+
+
+class Evento(NamedTuple):
+    id: int
+    topico: str
+    carga: Any
+    tentativas: int
+
+
+# topico -> consumidores; "*" recebe todos os tópicos
+consumidores: dict = defaultdict(list)
+
+
+def assinar(topico: str):
+    def registrar(consumidor: Callable[[Evento], Awaitable[None]]):
+        consumidores[topico].append(consumidor)
+        return consumidor
+
+    return registrar
+
+
+async def publicar(session, topico: str, carga: dict):
+    # na sessão da escrita: o INSERT entra na transação dela
+    await session.execute(insert(Outbox).values(topico=topico, carga=carga))
+
+
+SELECIONAR = """
+    SELECT id, topico, carga, tentativas FROM outbox
+    WHERE disponivel_em <= now()
+    ORDER BY disponivel_em, id
+    LIMIT $1
+    FOR UPDATE SKIP LOCKED
+"""
+
+ADIAR = """
+    UPDATE outbox SET
+        tentativas = tentativas + 1,
+        erro = $2,
+        disponivel_em = CASE
+            WHEN tentativas + 1 >= $3 THEN 'infinity'
+            ELSE now() + make_interval(secs => least(power(2, tentativas), 300))
+        END
+    WHERE id = $1
+"""
+
+
+class DespachanteOutbox:
+    def __init__(
+        self,
+        dsn: str,
+        lote: int,
+        espera_max: float,
+        timeout: float,
+        max_tentativas: int,
+    ):
+        self.dsn = dsn
+        self.lote = lote
+        # sem NOTIFY (conexão caiu, evento adiado vencendo) varre nesse intervalo
+        self.espera_max = espera_max
+        self.timeout = timeout
+        self.max_tentativas = max_tentativas
+        self.pool = None
+        self.conn = None
+        self._acordar = None
+        self._tarefa = None
+        self.entregues = 0
+        self.falhas = 0
+        self.parados = 0
+
+    async def start(self):
+        import asyncpg
+
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=1)
+        self.conn = await asyncpg.connect(self.dsn)
+        self._acordar = asyncio.Event()
+        await self.conn.add_listener(CANAL, lambda *_: self._acordar.set())
+        self._tarefa = asyncio.create_task(self._despachar())
+
+    async def stop(self):
+        if self._tarefa is not None:
+            self._tarefa.cancel()
+            await asyncio.gather(self._tarefa, return_exceptions=True)
+            self._tarefa = None
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def _despachar(self):
+        while True:
+            # limpo antes de drenar: um NOTIFY que chega durante a drenagem
+            # faz a próxima volta começar na hora
+            self._acordar.clear()
+            try:
+                processados = await self.drenar()
+            except Exception as e:
+                logger.error(e)
+                processados = 0
+            if processados < self.lote:
+                try:
+                    await asyncio.wait_for(self._acordar.wait(), self.espera_max)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def drenar(self) -> int:
+        async with self.pool.acquire() as conn, conn.transaction():
+            linhas = await conn.fetch(SELECIONAR, self.lote)
+            if not linhas:
+                return 0
+            eventos = [
+                Evento(linha["id"], linha["topico"], json.loads(linha["carga"]), linha["tentativas"])
+                for linha in linhas
+            ]
+            erros = await asyncio.gather(
+                *(self._entregar(evento) for evento in eventos), return_exceptions=True
+            )
+            entregues = [evento.id for evento, erro in zip(eventos, erros) if erro is None]
+            falhas = [
+                (evento.id, repr(erro), self.max_tentativas)
+                for evento, erro in zip(eventos, erros)
+                if erro is not None
+            ]
+            if entregues:
+                await conn.execute("DELETE FROM outbox WHERE id = any($1::bigint[])", entregues)
+            if falhas:
+                await conn.executemany(ADIAR, falhas)
+        self.entregues += len(entregues)
+        self.falhas += len(falhas)
+        for evento, erro in zip(eventos, erros):
+            if erro is not None:
+                logger.error("evento %s (%s) falhou: %r", evento.id, evento.topico, erro)
+                if evento.tentativas + 1 >= self.max_tentativas:
+                    self.parados += 1
+        return len(linhas)
+
+    async def _entregar(self, evento: Evento):
+        for consumidor in consumidores[evento.topico] + consumidores["*"]:
+            await asyncio.wait_for(consumidor(evento), self.timeout)
+
+    def stats(self) -> dict:
+        return {"entregues": self.entregues, "falhas": self.falhas, "parados": self.parados}
+
+
+# um por worker; desligue com OUTBOX_DISPATCHER=0 para despachar em outro processo
+despachante = None
+if environ.get("OUTBOX_DISPATCHER", "1").lower() in ("1", "true", "yes", "sim"):
+    despachante = DespachanteOutbox(
+        dsn_asyncpg(environ.get("DATABASE_URI")),
+        lote=int(environ.get("OUTBOX_LOTE", 100)),
+        espera_max=float(environ.get("OUTBOX_ESPERA_MAX_S", 5)),
+        timeout=float(environ.get("OUTBOX_TIMEOUT_S", 10)),
+        max_tentativas=int(environ.get("OUTBOX_MAX_TENTATIVAS", 10)),
+    )
+
+
+@registrar_coletor
+def _metricas_outbox():
+    if despachante is None:
+        return []
+    return [
+        (f"outbox_events_{nome}", "counter", f"Eventos do outbox: {nome}", [({}, valor)])
+        for nome, valor in despachante.stats().items()
+    ]
@@ -0,0 +1,27 @@
+import base64
+import json
+from decimal import Decimal
+from typing import Any, Optional
+
+from carrinho.db.exception import CursorInvalido
+
+
+# o cursor é opaco para o cliente: só carrega a última chave de ordenação lida
+def encode_cursor(valores: list[Any]) -> str:
+    bruto = json.dumps([str(v) if isinstance(v, Decimal) else v for v in valores])
+    return base64.urlsafe_b64encode(bruto.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str], tamanho: int) -> Optional[list[Any]]:
+    """Os `tamanho` valores do cursor; qualquer outra coisa é CursorInvalido."""
+    if not cursor:
+        return None
+    try:
+        preenchido = cursor + "=" * (-len(cursor) % 4)
+        valores = json.loads(base64.urlsafe_b64decode(preenchido.encode()))
+    except ValueError:
+        raise CursorInvalido(cursor)
+    # JSON válido mas não é a lista que encode_cursor gera (ex.: base64 de "5")
+    if not isinstance(valores, list) or len(valores) != tamanho:
+        raise CursorInvalido(cursor)
+    return valores
@@ -1,24 +1,225 @@
-from typing import Any
+import functools
+import json
+from os import environ
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Any, AsyncIterator, Optional
 
+from asyncpg import PostgresError
 from fastapi import Depends
+from fastapi.encoders import jsonable_encoder
 from pydantic import EmailStr
-from sqlmodel import Session, SQLModel, select
+from sqlalchemy import delete, func, literal, text, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DBAPIError, NoResultFound
+from sqlalchemy.orm import selectinload
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from carrinho import models
-from carrinho.db.base import BaseAdapter
-from carrinho.db.postgres_db import get_session
-from carrinho.schemas import Endereco, Produto, Usuario
+from carrinho.cache import ProductCache, product_cache
+from carrinho.db.base import MAX_FILTRO, BaseAdapter
+from carrinho.db.carregador import CarregadorLote
+from carrinho.db.escritas import Varredura, idempotencia
+from carrinho.db.estoque import RESERVA_TTL, varredor_de_reservas
+from carrinho.db.exception import (ChaveReutilizada, CursorInvalido,
+                                   EstoqueInsuficiente, VersaoConflitante)
+from carrinho.db.outbox import publicar
+from carrinho.db.pagination import decode_cursor, encode_cursor
+from carrinho.db.postgres_db import (agrupador, async_session, get_session,
+                                     replicas)
+from carrinho.schemas import (Carrinho, Endereco, Estoque, ItemCarrinho,
+                              Produto, Reserva, Usuario)
+
+MAX_LIMITE = 100
+
+COLUNAS_PRODUTO = ["nome", "descricao", "marca", "tamanho", "cor", "preco"]
+
+# ordem -> (coluna, decrescente); cada uma tem índice (coluna, id) em Produto
+ORDENS_PRODUTO = {
+    "id": (Produto.id, False),
+    "-id": (Produto.id, True),
+    "preco": (Produto.preco, False),
+    "-preco": (Produto.preco, True),
+    "nome": (Produto.nome, False),
+    "-nome": (Produto.nome, True),
+}
+
+# valor do cursor (JSON) -> tipo de cada coluna de ordenação; explícito porque
+# o AutoString do sqlmodel (nome) não implementa type.python_type
+def _texto(valor) -> str:
+    if not isinstance(valor, str):
+        raise TypeError(valor)
+    return valor
+
+
+CONVERSORES_CURSOR = {"id": int, "preco": Decimal, "nome": _texto}
+
+
+async def _produtos_por_id(session, ids: list) -> dict:
+    results = await session.exec(select(Produto).where(Produto.id.in_(ids)))
+    return {produto.id: produto for produto in results}
+
+
+async def _buscar_produtos(ids: list) -> dict:
+    # sessão própria: o lote atende várias requisições, cada uma com a sua
+    async with async_session() as session:
+        session.info["replica"] = True
+        return await _produtos_por_id(session, ids)
+
+
+carregador = CarregadorLote.do_ambiente(_buscar_produtos)
+
+# INSERT da chave: só uma transação consegue; quem chega depois espera o
+# commit dela e lê a resposta. Chave vencida (e ainda não apagada) é retomada.
+RESERVAR_CHAVE = text(
+    """
+    INSERT INTO idempotencia (escopo, chave, assinatura)
+    VALUES (:escopo, :chave, :assinatura)
+    ON CONFLICT (escopo, chave) DO UPDATE
+    SET criado = now(), resposta = NULL, assinatura = EXCLUDED.assinatura
+    WHERE idempotencia.criado < now() - make_interval(secs => :ttl)
+    RETURNING 1
+    """
+)
+# comando separado: em READ COMMITTED é ele que enxerga a linha recém-commitada
+RESPOSTA_GUARDADA = text(
+    "SELECT resposta, assinatura FROM idempotencia "
+    "WHERE escopo = :escopo AND chave = :chave"
+)
+GRAVAR_RESPOSTA = text(
+    "UPDATE idempotencia SET resposta = CAST(:resposta AS jsonb) "
+    "WHERE escopo = :escopo AND chave = :chave"
+)
+APAGAR_CHAVES_VENCIDAS = text(
+    """
+    DELETE FROM idempotencia WHERE ctid IN (
+        SELECT ctid FROM idempotencia
+        WHERE criado < now() - make_interval(secs => :ttl)
+        LIMIT :lote
+    )
+    """
+)
+
+
+def _idempotente(escopo: str, chave: Optional[str], tipo, operacao, pedido: Any = None):
+    """`operacao(session)` com a chave gravada na mesma transação.
+
+    A repetição com a mesma chave, em qualquer worker, recebe `tipo` montado
+    da resposta guardada e não escreve de novo; com outro `pedido`, levanta
+    ChaveReutilizada. Se a escrita falha, a chave sai junto no rollback e a
+    próxima tentativa escreve.
+    """
+    if chave is None:
+        return operacao
+
+    async def executar(session):
+        parametros = {
+            "escopo": escopo,
+            "chave": chave,
+            "assinatura": idempotencia.assinatura(pedido),
+            "ttl": idempotencia.ttl,
+        }
+        if (await session.execute(RESERVAR_CHAVE, parametros)).first() is None:
+            resposta, assinatura = (await session.execute(RESPOSTA_GUARDADA, parametros)).one()
+            # NULL: chave gravada antes da coluna existir
+            if assinatura is not None and assinatura != parametros["assinatura"]:
+                raise ChaveReutilizada(escopo)
+            return tipo(**resposta)
+        resultado = await operacao(session)
+        # Decimal como string: preço volta sem perda
+        resposta = jsonable_encoder(resultado, custom_encoder={Decimal: str})
+        await session.execute(GRAVAR_RESPOSTA, {**parametros, "resposta": json.dumps(resposta)})
+        return resultado
+
+    return executar
+
+
+async def apagar_chaves_vencidas(lote: int) -> int:
+    async with async_session() as session:
+        apagadas = (
+            await session.execute(
+                APAGAR_CHAVES_VENCIDAS, {"ttl": idempotencia.ttl, "lote": lote}
+            )
+        ).rowcount
+        await session.commit()
+    return apagadas
+
+
+limpeza_idempotencia = Varredura(
+    "idempotencia",
+    apagar_chaves_vencidas,
+    intervalo=float(environ.get("IDEMPOTENCY_PURGE_S", 60)),
+    lote=int(environ.get("IDEMPOTENCY_PURGE_LOTE", 1000)),
+)
+
+
+def _escape_like(termo: str) -> str:
+    return termo.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _filtrar_produtos(
+    nome: Optional[str],
+    marca: Optional[str],
+    descricao: Optional[str],
+    preco_min: Optional[Decimal],
+    preco_max: Optional[Decimal],
+):
+    statement = select(Produto)
+    for campo, termo in (("nome", nome), ("marca", marca), ("descricao", descricao)):
+        if termo:
+            statement = statement.where(
+                getattr(Produto, campo).ilike(f"%{_escape_like(termo)}%", escape="\\")
+            )
+    if preco_min is not None:
+        statement = statement.where(Produto.preco >= preco_min)
+    if preco_max is not None:
+        statement = statement.where(Produto.preco <= preco_max)
+    return statement
+
+
+def da_replica(metodo):
+    """Leitura que pode ir para uma réplica (DATABASE_REPLICA_URIS).
+
+    Sem réplicas, ou com a sessão presa ao primário, não muda nada.
+    """
+
+    @functools.wraps(metodo)
+    async def ler(self, *args, **kwargs):
+        info = self.session.info
+        anterior = info.get("replica")
+        info["replica"] = True
+        try:
+            return await metodo(self, *args, **kwargs)
+        finally:
+            info["replica"] = anterior
+
+    return ler
 
 
 class PostgresBaseAdapter(BaseAdapter):
+    agrupador = None
+
     def __init__(self, session):
         self.session = session
         self.type = SQLModel
 
+    async def _escrever(self, operacao, ordem: tuple = ()):
+        """Roda `operacao(session)` e faz o commit.
+
+        Com um agrupador (WRITE_BATCHING) a operação vai para o lote e usa a
+        sessão dele; `ordem` é a linha que ela trava, para ordenar o lote.
+        """
+        if self.agrupador is not None:
+            return await self.agrupador.enviar(operacao, ordem)
+        resultado = await operacao(self.session)
+        await self.session.commit()
+        return resultado
+
     async def create(self, data: SQLModel) -> SQLModel:
         self.session.add(data.dict(exclude_none=True))
 
-        self.session.commit()
+        await self.session.commit()
 
     async def update(
         self,
@@ -31,11 +232,60 @@ class PostgresBaseAdapter(BaseAdapter):
 
     async def get(self, id: Any, key: str) -> SQLModel:
         statement = select(self.type).where(self.type)
-        results = self.session.exec(statement)
+        results = await self.session.exec(statement)
         usuario = results.one()
 
-    async def get_all(self, skip: int = 0, limit: int = 10) -> list[SQLModel]:
-        pass
+    @da_replica
+    async def get_all(
+        self, limit: int = 10, cursor: Optional[str] = None
+    ) -> tuple[list[SQLModel], Optional[str]]:
+        return await self._pagina(select(self.type), (self.type.id,), False, limit, cursor)
+
+    async def stream_all(self) -> AsyncIterator[SQLModel]:
+        # cursor do lado do servidor: a memória não cresce com a tabela
+        statement = select(self.type).order_by(self.type.id)
+        async for item in self._stream(statement):
+            yield item
+
+    async def _stream(self, statement) -> AsyncIterator[SQLModel]:
+        results = await self.session.stream(statement.execution_options(yield_per=1000))
+        async for item in results.scalars():
+            yield item
+
+    async def _pagina(
+        self, statement, chaves: tuple, decrescente: bool, limite: int, cursor: Optional[str]
+    ) -> tuple[list[SQLModel], Optional[str]]:
+        """Paginação por cursor (keyset) sobre as colunas de `chaves`.
+
+        O cursor guarda os valores de `chaves` da última linha da página; a
+        próxima página continua do ponto seguinte a ela na ordem do índice,
+        sem OFFSET.
+        """
+        limite = min(limite, MAX_LIMITE)
+        ultimo = decode_cursor(cursor, len(chaves))
+        if ultimo is not None:
+            try:
+                valores = tuple_(
+                    *(
+                        literal(CONVERSORES_CURSOR[c.key](v), c.type)
+                        for c, v in zip(chaves, ultimo)
+                    )
+                )
+            except (ArithmeticError, TypeError, ValueError):
+                raise CursorInvalido(cursor)
+            linha = tuple_(*chaves)
+            statement = statement.where(linha < valores if decrescente else linha > valores)
+        statement = statement.order_by(
+            *(c.desc() if decrescente else c.asc() for c in chaves)
+        ).limit(limite + 1)
+
+        results = await self.session.exec(statement)
+        itens = results.all()
+        proximo = None
+        if len(itens) > limite:
+            itens = itens[:limite]
+            proximo = encode_cursor([getattr(itens[-1], c.key) for c in chaves])
+        return itens, proximo
 
     async def delete(self, id: Any, key: str):
         pass
@@ -47,40 +297,61 @@ class UserAdapter(PostgresBaseAdapter):
         self.type = Usuario
 
     async def create(self, data: Usuario) -> Usuario:
-        usuario = Usuario(**data.dict(exclude_none=True))
+        usuario = Usuario(**data.dict(exclude_none=True, exclude={"versao"}))
+        # usuário novo não tem endereços: evita um lazy load ao serializar
+        usuario.enderecos = []
         self.session.add(usuario)
 
-        self.session.commit()
-        self.session.refresh(usuario)
+        # o INSERT já devolve o id (RETURNING); não precisa de refresh
+        await self.session.flush()
+        await publicar(
+            self.session,
+            "usuario.criado",
+            {"id": usuario.id, "nome": usuario.nome, "email": usuario.email},
+        )
+        await self.session.commit()
         return usuario
 
+    @da_replica
     async def get(self, email: EmailStr) -> Usuario:
-        statement = select(Usuario).where(Usuario.email == email)
-        results = self.session.exec(statement)
+        statement = (
+            select(Usuario)
+            .where(Usuario.email == email)
+            .options(selectinload(Usuario.enderecos))
+        )
+        results = await self.session.exec(statement)
         usuario = results.one()
         return usuario
 
-    async def get_all(self) -> list[Usuario]:
-        statement = select(Usuario)
-        results = self.session.exec(statement)
-        usuarios = results.all()
-        return usuarios
+    @da_replica
+    async def get_all(
+        self, limit: int = 10, cursor: Optional[str] = None
+    ) -> tuple[list[Usuario], Optional[str]]:
+        # uma query para a página e uma (IN) para os endereços de toda a página
+        statement = select(Usuario).options(selectinload(Usuario.enderecos))
+        return await self._pagina(statement, (Usuario.id,), False, limit, cursor)
+
+    async def get_senha(self, email: EmailStr) -> str:
+        statement = select(Usuario.senha).where(Usuario.email == email)
+        return (await self.session.exec(statement)).one()
+
+    async def atualizar_senha(self, email: EmailStr, senha: str):
+        statement = (
+            update(Usuario)
+            .where(Usuario.email == email)
+            .values(senha=senha)
+            .returning(Usuario.id)
+        )
+        (await self.session.execute(statement)).one()
+        await self.session.commit()
 
     async def delete(self, email: EmailStr):
-        statement = select(Usuario).where(Usuario.email == email)
-        results = self.session.exec(statement)
-        usuario = results.one()
+        # um único DELETE; os endereços e o carrinho saem pelo ON DELETE CASCADE
         statement = (
-            select(Endereco)
-            .where(
-                Endereco.usuario_id == usuario.id,
-            ))
-        results = self.session.exec(statement)
-        enderecos = results.all()
-        for endereco in enderecos:
-            self.session.delete(endereco)
-        self.session.delete(usuario)
-        self.session.commit()
+            delete(Usuario).where(Usuario.email == email).returning(Usuario.id)
+        )
+        (await self.session.execute(statement)).one()
+        await self.session.commit()
 
 
 class AddressAdapter(PostgresBaseAdapter):
@@ -88,25 +359,23 @@ class AddressAdapter(PostgresBaseAdapter):
         self.session = session
 
     async def create(self, email: EmailStr, endereco: models.Endereco) -> Endereco:
-        statement = select(Usuario).where(Usuario.email == email)
-        results = self.session.exec(statement)  # roda o select
-        usuario = results.one()
+        # o mesmo comando acha o usuário e muda a versão (ETag) dele
+        usuario_id = (await self.session.execute(self._nova_versao(email))).scalar_one()
         endereco = Endereco(
-            usuario_id=usuario.id,
+            usuario_id=usuario_id,
             rua=endereco.rua,
             cep=endereco.cep,
             cidade=endereco.cidade,
             estado=endereco.estado,
         )  # ou endereco = Endereco(usuario_id=usuario.id, **endereco.dict())
         self.session.add(endereco)
-        self.session.commit()
-        self.session.refresh(endereco)
+        await self.session.commit()
+        await self.session.refresh(endereco)
         return endereco
 
     async def delete(self, email: EmailStr, endereco: models.Endereco):
         statement = (
-            select(Endereco)
-            .join(Usuario)
+            delete(Endereco)
             .where(
                 Endereco.cep == endereco.cep,
                 Endereco.cidade == endereco.cidade,
@@ -114,80 +383,703 @@ class AddressAdapter(PostgresBaseAdapter):
                 Endereco.usuario_id == Usuario.id,
                 Usuario.email == email,
             )
+            .returning(Endereco.id)
         )
-        results = self.session.exec(statement)
-        endereco = results.one()
+        # DELETE ... USING usuario: um só comando, sem o SELECT antes
+        if not (await self.session.execute(statement)).all():
+            raise NoResultFound("Endereço não encontrado")
+        await self.session.execute(self._nova_versao(email))
+        await self.session.commit()
 
-        self.session.delete(endereco)
-        self.session.commit()
+    @staticmethod
+    def _nova_versao(email: EmailStr):
+        return (
+            update(Usuario)
+            .where(Usuario.email == email)
+            .values(versao=Usuario.versao + 1)
+            .returning(Usuario.id)
+        )
 
 
 class ProductAdapter(PostgresBaseAdapter):
-    def __init__(self, session):
+    def __init__(
+        self, session, cache: ProductCache = None, agrupador=None, carregador=None
+    ):
         self.session = session
         self.type = Produto
+        self.cache = cache
+        self.agrupador = agrupador
+        self.carregador = carregador
+
+    def _cache(self) -> Optional[ProductCache]:
+        # presa ao primário (ler o que escreveu): o cache pode estar atrás da
+        # escrita, então a leitura vai direto na sessão
+        if self.session.info.get("primario"):
+            return None
+        return self.cache
+
+    def _leu_da_replica(self) -> bool:
+        # réplica pode estar atrasada: o que veio dela não entra no cache
+        return self.session.info.get("engine_replica") is not None
 
     async def create(self, data: Produto) -> Produto:
-        produto = Produto(**data.dict(exclude_none=True))
+        # a versão é controlada pelo servidor: todo produto novo começa na 1
+        produto = Produto(**data.dict(exclude_none=True, exclude={"versao"}))
         self.session.add(produto)
 
-        self.session.commit()
-        self.session.refresh(produto)
+        await self.session.flush()
+        await self.session.refresh(produto)
+        await publicar(self.session, "produto.criado", jsonable_encoder(produto))
+        await self.session.commit()
+        if self.cache:
+            await self.cache.invalidar(produto.id)
         return produto
 
+    @da_replica
     async def get(self, id: int) -> Produto:
-        statement = select(Produto).where(Produto.id == id)
-        results = self.session.exec(statement)
-        produto = results.one()
+        cache = self._cache()
+        if cache:
+            produto = cache.get(id)
+            if produto is not None:
+                return produto
+            geracao = cache.geracao
+        # o lote lê da réplica; requisição presa ao primário lê na própria sessão
+        if self.carregador and not self.session.info.get("primario"):
+            produto = await self.carregador.carregar(id)
+            if produto is None:
+                raise NoResultFound
+            da_replica = replicas is not None
+        else:
+            statement = select(Produto).where(Produto.id == id)
+            results = await self.session.exec(statement)
+            produto = results.one()
+            da_replica = self._leu_da_replica()
+        if cache and not da_replica:
+            cache.set(id, produto, geracao)
         return produto
 
-    async def filter(self, **kwargs: dict[str, str]) -> Produto:
+    @da_replica
+    async def get_many(self, ids: list[int]) -> dict[int, Produto]:
+        """Os produtos de `ids` que existem, num único SELECT ... IN."""
+        encontrados = {}
+        faltando = list(ids)
+        cache = self._cache()
+        if cache:
+            geracao = cache.geracao
+            faltando = []
+            for id in ids:
+                produto = cache.get(id)
+                if produto is None:
+                    faltando.append(id)
+                else:
+                    encontrados[id] = produto
+        if faltando:
+            lidos = await _produtos_por_id(self.session, faltando)
+            if cache and not self._leu_da_replica():
+                for id, produto in lidos.items():
+                    cache.set(id, produto, geracao)
+            encontrados.update(lidos)
+        return encontrados
+
+    @da_replica
+    async def filter(self, **kwargs: dict[str, str]) -> list[Produto]:
+        cache = self._cache()
+        if cache:
+            produto = cache.get_filtro(kwargs)
+            if produto is not None:
+                return produto
+            geracao = cache.geracao
         statement = select(Produto)
         for key, value in kwargs.items():
             statement = statement.where(
                 getattr(Produto, key) == value
             )  # where(Produto.key == value)
-        results = self.session.exec(statement)
-        produto = results.one()
-        return produto
+        statement = statement.order_by(Produto.id).limit(MAX_FILTRO + 1)
+        results = await self.session.exec(statement)
+        produtos = results.all()
+        if not produtos:
+            raise NoResultFound
+        if cache and not self._leu_da_replica():
+            cache.set_filtro(kwargs, produtos, geracao)
+        return produtos
+
+    @da_replica
+    async def search(
+        self,
+        nome: Optional[str] = None,
+        marca: Optional[str] = None,
+        descricao: Optional[str] = None,
+        preco_min: Optional[Decimal] = None,
+        preco_max: Optional[Decimal] = None,
+        ordem: str = "id",
+        limite: int = 20,
+        cursor: Optional[str] = None,
+    ) -> tuple[list[Produto], Optional[str]]:
+        coluna, decrescente = ORDENS_PRODUTO[ordem]
+        chaves = (coluna, Produto.id) if coluna is not Produto.id else (Produto.id,)
+        statement = _filtrar_produtos(nome, marca, descricao, preco_min, preco_max)
+        return await self._pagina(statement, chaves, decrescente, limite, cursor)
+
+    async def stream_search(
+        self,
+        nome: Optional[str] = None,
+        marca: Optional[str] = None,
+        descricao: Optional[str] = None,
+        preco_min: Optional[Decimal] = None,
+        preco_max: Optional[Decimal] = None,
+        ordem: str = "id",
+    ) -> AsyncIterator[Produto]:
+        coluna, decrescente = ORDENS_PRODUTO[ordem]
+        chaves = (coluna, Produto.id) if coluna is not Produto.id else (Produto.id,)
+        statement = _filtrar_produtos(nome, marca, descricao, preco_min, preco_max)
+        statement = statement.order_by(
+            *(c.desc() if decrescente else c.asc() for c in chaves)
+        )
+        async for produto in self._stream(statement):
+            yield produto
     
     async def delete(self, id: int):
-        statement = select(Produto).where(Produto.id == id)
-        results = self.session.exec(statement)
-        produto = results.one()
-    
-        self.session.delete(produto)
-        self.session.commit()
+        statement = delete(Produto).where(Produto.id == id).returning(Produto.id)
+        (await self.session.execute(statement)).one()
+        await publicar(self.session, "produto.removido", {"id": id})
+        await self.session.commit()
+        if self.cache:
+            await self.cache.invalidar(id)
 
+    async def bulk_create(
+        self, linhas: list[tuple[int, dict]], upsert: bool = False
+    ) -> tuple[int, list[tuple[int, str]]]:
+        # caminho rápido: o lote inteiro de uma vez; se falhar, grava linha a
+        # linha para descobrir quais linhas têm problema
+        try:
+            if upsert:
+                await self._upsert(linhas)
+            else:
+                await self._copy(linhas)
+            await self.session.commit()
+            gravados, erros = len(linhas), []
+        except (DBAPIError, PostgresError):
+            await self.session.rollback()
+            gravados, erros = await self._gravar_um_a_um(linhas, upsert)
+        if self.cache:
+            await self.cache.invalidar_tudo()
+        return gravados, erros
 
-    async def update(self, id: int, data: models.ProdutoFilter) -> Produto: # data = aos produtos novos
-        statement = select(Produto).where(Produto.id == id)
-        results = self.session.exec(statement)
-        produto = results.one()
-        update_data = data.dict(exclude_none=True)
-        for key, value in update_data.items():
-            setattr(produto, key, value)
-        self.session.add(produto)
-        self.session.commit()
+    async def _copy(self, linhas: list[tuple[int, dict]]):
+        conn = await self.session.connection()
+        bruta = await conn.get_raw_connection()
+        await bruta.driver_connection.copy_records_to_table(
+            Produto.__tablename__,
+            records=[tuple(dados[c] for c in COLUNAS_PRODUTO) for _, dados in linhas],
+            columns=COLUNAS_PRODUTO,
+        )
+
+    async def _upsert(self, linhas: list[tuple[int, dict]]):
+        com_id = [dados for _, dados in linhas if "id" in dados]
+        sem_id = [dados for _, dados in linhas if "id" not in dados]
+        if com_id:
+            statement = insert(Produto).values(com_id)
+            statement = statement.on_conflict_do_update(
+                index_elements=[Produto.id],
+                set_={
+                    **{c: getattr(statement.excluded, c) for c in COLUNAS_PRODUTO},
+                    "versao": Produto.versao + 1,
+                },
+            )
+            await self.session.execute(statement)
+            await self._avancar_sequencia()
+        if sem_id:
+            await self.session.execute(insert(Produto).values(sem_id))
+
+    async def _avancar_sequencia(self):
+        # ids explícitos não avançam a sequence do SERIAL
+        await self.session.execute(
+            text(
+                "SELECT setval(pg_get_serial_sequence('produto', 'id'), "
+                "(SELECT max(id) FROM produto))"
+            )
+        )
+
+    async def _gravar_um_a_um(
+        self, linhas: list[tuple[int, dict]], upsert: bool
+    ) -> tuple[int, list[tuple[int, str]]]:
+        gravados, erros = 0, []
+        for numero, dados in linhas:
+            try:
+                async with self.session.begin_nested():
+                    if upsert:
+                        await self._upsert([(numero, dados)])
+                    else:
+                        # sem upsert, id que já existe é erro da linha, não sobrescrita
+                        await self.session.execute(insert(Produto).values(dados))
+                gravados += 1
+            except DBAPIError as e:
+                erros.append((numero, str(e.orig)))
+        await self.session.commit()
+        return gravados, erros
+
+    async def update(
+        self,
+        id: int,
+        data: models.ProdutoFilter,  # data = aos produtos novos
+        chave_idempotencia: Optional[str] = None,
+        versao: Optional[int] = None,
+    ) -> Produto:
+        async def atualizar(session) -> Produto:
+            # UPDATE ... RETURNING: grava e devolve a linha nova num só comando
+            statement = update(Produto).where(Produto.id == id)
+            if versao is not None:
+                statement = statement.where(Produto.versao == versao)
+            statement = statement.values(
+                **data.dict(exclude_none=True), versao=Produto.versao + 1
+            ).returning(*Produto.__table__.columns)
+            linha = (await session.execute(statement)).one_or_none()
+            if linha is None:
+                # só no caminho de erro: distingue produto inexistente de versão velha
+                existe = select(Produto.id).where(Produto.id == id)
+                if versao is not None and (await session.execute(existe)).first():
+                    raise VersaoConflitante(id)
+                raise NoResultFound("Produto não encontrado")
+            produto = Produto(**linha._mapping)
+            # na mesma sessão: com o agrupador, no mesmo savepoint do UPDATE
+            await publicar(session, "produto.atualizado", jsonable_encoder(produto))
+            return produto
 
-        self.session.refresh(produto)
+        escopo = f"produto.update.{id}"
+        pedido = {"dados": data.dict(exclude_none=True), "versao": versao}
+        produto = await idempotencia.executar(
+            escopo,
+            chave_idempotencia,
+            lambda: self._escrever(
+                _idempotente(escopo, chave_idempotencia, Produto, atualizar, pedido),
+                ("produto", id),
+            ),
+            pedido,
+        )
+        if self.cache:
+            await self.cache.invalidar(id)
         return produto
-        
 
-async def get_user_adapter(session: Session = Depends(get_session)) -> UserAdapter:
+
+class CartAdapter(PostgresBaseAdapter):
+    def __init__(self, session, agrupador=None):
+        self.session = session
+        self.type = Carrinho
+        self.agrupador = agrupador
+
+    async def add_item(
+        self, id_usuario: int, id_produto: int, chave_idempotencia: Optional[str] = None
+    ) -> models.TotalCarrinho:
+        escopo = f"carrinho.add_item.{id_usuario}.{id_produto}"
+        return await idempotencia.executar(
+            escopo,
+            chave_idempotencia,
+            lambda: self._escrever(
+                _idempotente(
+                    escopo,
+                    chave_idempotencia,
+                    models.TotalCarrinho,
+                    lambda session: self._add_item(session, id_usuario, id_produto),
+                ),
+                ("carrinho", id_usuario),
+            ),
+        )
+
+    async def _add_item(
+        self, session, id_usuario: int, id_produto: int
+    ) -> models.TotalCarrinho:
+        # garante o carrinho (a linha fica travada até o commit)
+        novo = insert(Carrinho).values(
+            usuario_id=id_usuario, quantidade_de_produtos=0, preco_total=0
+        )
+        statement = novo.on_conflict_do_update(
+            index_elements=[Carrinho.usuario_id],
+            set_={"usuario_id": novo.excluded.usuario_id},
+        ).returning(Carrinho.id)
+        carrinho_id = (await session.execute(statement)).scalar_one()
+
+        item = insert(ItemCarrinho).from_select(
+            ["carrinho_id", "produto_id", "quantidade", "preco_unitario"],
+            select(literal(carrinho_id), Produto.id, literal(1), Produto.preco).where(
+                Produto.id == id_produto
+            ),
+        )
+        statement = item.on_conflict_do_update(
+            index_elements=[ItemCarrinho.carrinho_id, ItemCarrinho.produto_id],
+            set_={"quantidade": ItemCarrinho.quantidade + 1},
+        ).returning(ItemCarrinho.preco_unitario)
+        preco = (await session.execute(statement)).scalar_one()  # sem produto
+
+        return await self._somar(session, carrinho_id, 1, preco)
+
+    async def remove_item(
+        self, id_usuario: int, id_produto: int, chave_idempotencia: Optional[str] = None
+    ) -> models.TotalCarrinho:
+        escopo = f"carrinho.remove_item.{id_usuario}.{id_produto}"
+        return await idempotencia.executar(
+            escopo,
+            chave_idempotencia,
+            lambda: self._escrever(
+                _idempotente(
+                    escopo,
+                    chave_idempotencia,
+                    models.TotalCarrinho,
+                    lambda session: self._remove_item(session, id_usuario, id_produto),
+                ),
+                ("carrinho", id_usuario),
+            ),
+        )
+
+    async def _remove_item(
+        self, session, id_usuario: int, id_produto: int
+    ) -> models.TotalCarrinho:
+        # trava o carrinho antes do item, na mesma ordem do _add_item; na
+        # ordem inversa um add e um remove concorrentes se travam em ciclo
+        statement = (
+            select(Carrinho.id)
+            .where(Carrinho.usuario_id == id_usuario)
+            .with_for_update()
+        )
+        carrinho_id = (await session.execute(statement)).scalar_one()
+
+        statement = (
+            update(ItemCarrinho)
+            .where(
+                ItemCarrinho.carrinho_id == carrinho_id,
+                ItemCarrinho.produto_id == id_produto,
+            )
+            .values(quantidade=ItemCarrinho.quantidade - 1)
+            .returning(
+                ItemCarrinho.id,
+                ItemCarrinho.quantidade,
+                ItemCarrinho.preco_unitario,
+            )
+        )
+        item = (await session.execute(statement)).one()
+        if item.quantidade <= 0:
+            await session.execute(
+                delete(ItemCarrinho).where(ItemCarrinho.id == item.id)
+            )
+
+        return await self._somar(session, carrinho_id, -1, -item.preco_unitario)
+
+    async def _somar(
+        self, session, carrinho_id: int, quantidade: int, valor: Decimal
+    ) -> models.TotalCarrinho:
+        statement = (
+            update(Carrinho)
+            .where(Carrinho.id == carrinho_id)
+            .values(
+                quantidade_de_produtos=Carrinho.quantidade_de_produtos + quantidade,
+                preco_total=Carrinho.preco_total + valor,
+            )
+            .returning(Carrinho.preco_total, Carrinho.quantidade_de_produtos)
+        )
+        linha = (await session.execute(statement)).one()
+        return models.TotalCarrinho(**linha._mapping)
+
+    async def get(self, id_usuario: int) -> models.CarrinhoDeCompras:
+        statement = (
+            select(Carrinho)
+            .where(Carrinho.usuario_id == id_usuario)
+            .options(selectinload(Carrinho.itens))
+        )
+        results = await self.session.exec(statement)
+        carrinho = results.one()
+        return models.CarrinhoDeCompras(
+            id_usuario=carrinho.usuario_id,
+            preco_total=carrinho.preco_total,
+            quantidade_de_produtos=carrinho.quantidade_de_produtos,
+            itens=[
+                models.ItemCarrinho(
+                    id_produto=item.produto_id,
+                    quantidade=item.quantidade,
+                    preco_unitario=item.preco_unitario,
+                )
+                for item in carrinho.itens
+            ],
+        )
+
+    async def get_total(self, id_usuario: int) -> models.TotalCarrinho:
+        statement = select(Carrinho.preco_total, Carrinho.quantidade_de_produtos).where(
+            Carrinho.usuario_id == id_usuario
+        )
+        linha = (await self.session.execute(statement)).one()
+        return models.TotalCarrinho(**linha._mapping)
+
+    async def delete(self, id_usuario: int):
+        # os itens saem junto pelo ON DELETE CASCADE
+        statement = (
+            delete(Carrinho)
+            .where(Carrinho.usuario_id == id_usuario)
+            .returning(Carrinho.id)
+        )
+        (await self.session.execute(statement)).one()
+        await self.session.commit()
+
+
+# Reserva numa fatia só: a fatia é sorteada entre as que têm quantidade, e
+# SKIP LOCKED pula as que outra reserva está baixando neste instante. Se
+# nenhuma estiver livre, _reservar_juntando decide com as fatias travadas.
+RESERVAR_UMA_FATIA = text(
+    """
+    WITH alvo AS (
+        SELECT fatia FROM estoque
+        WHERE produto_id = :produto_id AND quantidade >= :quantidade
+        ORDER BY random()
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ), baixa AS (
+        UPDATE estoque e SET quantidade = e.quantidade - :quantidade
+        FROM alvo
+        WHERE e.produto_id = :produto_id AND e.fatia = alvo.fatia
+        RETURNING e.fatia
+    )
+    INSERT INTO reserva (produto_id, fatia, quantidade, usuario_id, expira_em)
+    SELECT CAST(:produto_id AS integer), fatia, CAST(:quantidade AS integer),
+           CAST(:usuario_id AS integer), now() + make_interval(secs => :ttl)
+    FROM baixa
+    RETURNING id, produto_id, fatia, quantidade, usuario_id, expira_em
+    """
+)
+
+LIBERAR_RESERVA = text(
+    """
+    WITH liberada AS (
+        DELETE FROM reserva WHERE id = :id
+        RETURNING produto_id, fatia, quantidade
+    )
+    UPDATE estoque e SET quantidade = e.quantidade + l.quantidade
+    FROM liberada l
+    WHERE e.produto_id = l.produto_id AND e.fatia = l.fatia
+    RETURNING e.produto_id
+    """
+)
+
+# As fatias são travadas em ordem antes da devolução, a mesma ordem do
+# _reservar_juntando, para duas varreduras não se travarem em ciclo.
+LIBERAR_EXPIRADAS = text(
+    """
+    WITH expiradas AS (
+        DELETE FROM reserva WHERE id IN (
+            SELECT id FROM reserva WHERE expira_em <= now()
+            ORDER BY expira_em
+            LIMIT :lote
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING produto_id, fatia, quantidade
+    ), devolver AS (
+        SELECT produto_id, fatia, sum(quantidade) AS quantidade
+        FROM expiradas GROUP BY produto_id, fatia
+    ), travadas AS (
+        SELECT e.produto_id, e.fatia FROM estoque e
+        JOIN devolver d USING (produto_id, fatia)
+        ORDER BY e.produto_id, e.fatia
+        FOR UPDATE OF e
+    ), devolvidas AS (
+        UPDATE estoque e SET quantidade = e.quantidade + d.quantidade
+        FROM devolver d JOIN travadas t USING (produto_id, fatia)
+        WHERE e.produto_id = d.produto_id AND e.fatia = d.fatia
+        RETURNING 1
+    )
+    SELECT count(*) FROM expiradas
+    """
+)
+
+
+class StockAdapter(PostgresBaseAdapter):
+    def __init__(self, session):
+        self.session = session
+        self.type = Estoque
+
+    async def definir(self, id_produto: int, quantidade: int, fatias: int = 1) -> models.Estoque:
+        """Reparte `quantidade` disponível em `fatias` linhas.
+
+        UPDATE nas fatias que já existem (quem espera por elas vê o valor
+        novo) e as reservas em aberto de fatias removidas passam a devolver
+        para fatia % fatias.
+        """
+        base, resto = divmod(quantidade, fatias)
+        statement = insert(Estoque).values(
+            [
+                {"produto_id": id_produto, "fatia": fatia, "quantidade": base + (fatia < resto)}
+                for fatia in range(fatias)
+            ]
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[Estoque.produto_id, Estoque.fatia],
+            set_={"quantidade": statement.excluded.quantidade},
+        )
+        await self.session.execute(statement)
+        await self.session.execute(
+            delete(Estoque).where(Estoque.produto_id == id_produto, Estoque.fatia >= fatias)
+        )
+        await self.session.execute(
+            update(Reserva)
+            .where(Reserva.produto_id == id_produto, Reserva.fatia >= fatias)
+            .values(fatia=Reserva.fatia % fatias)
+        )
+        await self.session.commit()
+        return await self.get(id_produto)
+
+    async def get(self, id_produto: int) -> models.Estoque:
+        disponivel, fatias = (
+            await self.session.execute(
+                select(func.sum(Estoque.quantidade), func.count()).where(
+                    Estoque.produto_id == id_produto
+                )
+            )
+        ).one()
+        if not fatias:
+            raise NoResultFound
+        reservado = (
+            await self.session.execute(
+                select(func.coalesce(func.sum(Reserva.quantidade), 0)).where(
+                    Reserva.produto_id == id_produto
+                )
+            )
+        ).scalar_one()
+        return models.Estoque(
+            produto_id=id_produto, disponivel=disponivel, reservado=reservado, fatias=fatias
+        )
+
+    async def reservar(
+        self,
+        id_produto: int,
+        quantidade: int,
+        id_usuario: Optional[int] = None,
+        chave_idempotencia: Optional[str] = None,
+    ) -> Reserva:
+        escopo = f"estoque.reservar.{id_produto}"
+        pedido = {"quantidade": quantidade, "usuario_id": id_usuario}
+        return await idempotencia.executar(
+            escopo,
+            chave_idempotencia,
+            lambda: self._escrever(
+                _idempotente(
+                    escopo,
+                    chave_idempotencia,
+                    Reserva,
+                    lambda session: self._reservar(id_produto, quantidade, id_usuario),
+                    pedido,
+                )
+            ),
+            pedido,
+        )
+
+    async def _reservar(self, id_produto: int, quantidade: int, id_usuario: Optional[int]) -> Reserva:
+        linha = (
+            await self.session.execute(
+                RESERVAR_UMA_FATIA,
+                {
+                    "produto_id": id_produto,
+                    "quantidade": quantidade,
+                    "usuario_id": id_usuario,
+                    "ttl": RESERVA_TTL,
+                },
+            )
+        ).first()
+        if linha is None:
+            reserva = await self._reservar_juntando(id_produto, quantidade, id_usuario)
+        else:
+            reserva = Reserva(**linha._mapping)
+        return reserva
+
+    async def _reservar_juntando(
+        self, id_produto: int, quantidade: int, id_usuario: Optional[int]
+    ) -> Reserva:
+        # caminho lento: todas as fatias ocupadas, ou nenhuma com a
+        # quantidade inteira. Trava todas (em ordem) e baixa de várias.
+        fatias = (
+            await self.session.execute(
+                select(Estoque)
+                .where(Estoque.produto_id == id_produto)
+                .order_by(Estoque.fatia)
+                .with_for_update()
+            )
+        ).scalars().all()
+        if not fatias:
+            raise NoResultFound
+        if sum(fatia.quantidade for fatia in fatias) < quantidade:
+            await self.session.rollback()
+            raise EstoqueInsuficiente
+        falta = quantidade
+        for fatia in sorted(fatias, key=lambda fatia: -fatia.quantidade):
+            baixa = min(falta, fatia.quantidade)
+            fatia.quantidade -= baixa
+            falta -= baixa
+            if not falta:
+                break
+        # as unidades são iguais: ao liberar, voltam todas para a maior fatia
+        reserva = Reserva(
+            produto_id=id_produto,
+            fatia=max(fatias, key=lambda fatia: fatia.quantidade).fatia,
+            quantidade=quantidade,
+            usuario_id=id_usuario,
+            expira_em=datetime.now(timezone.utc) + timedelta(seconds=RESERVA_TTL),
+        )
+        self.session.add(reserva)
+        await self.session.flush()
+        return reserva
+
+    async def confirmar(self, id_reserva: int):
+        # confirmar e vencer apagam a mesma linha: só um dos dois acontece
+        apagada = (
+            await self.session.execute(
+                delete(Reserva)
+                .where(Reserva.id == id_reserva, Reserva.expira_em > func.now())
+                .returning(Reserva.id)
+            )
+        ).first()
+        if apagada is None:
+            raise NoResultFound("Reserva não encontrada ou vencida")
+        await self.session.commit()
+
+    async def liberar(self, id_reserva: int):
+        if (await self.session.execute(LIBERAR_RESERVA, {"id": id_reserva})).first() is None:
+            raise NoResultFound("Reserva não encontrada")
+        await self.session.commit()
+
+
+async def liberar_expiradas(lote: int) -> int:
+    # sessão própria: roda no varredor, fora de qualquer requisição
+    async with async_session() as session:
+        liberadas = (await session.execute(LIBERAR_EXPIRADAS, {"lote": lote})).scalar_one()
+        await session.commit()
+    return liberadas
+
+
+varredor = varredor_de_reservas(liberar_expiradas)
+
+
+async def get_user_adapter(session: AsyncSession = Depends(get_session)) -> UserAdapter:
     user_adapter = UserAdapter(session)
     return user_adapter
 
 
 async def get_address_adapter(
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
 ) -> AddressAdapter:
     address_adapter = AddressAdapter(session)
     return address_adapter
 
 
 async def get_product_adapter(
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
 ) -> ProductAdapter:
-    product_adapter = ProductAdapter(session)
-    return product_adapter
\ No newline at end of file
+    product_adapter = ProductAdapter(session, product_cache, agrupador, carregador)
+    return product_adapter
+
+
+async def get_cart_adapter(
+    session: AsyncSession = Depends(get_session),
+) -> CartAdapter:
+    cart_adapter = CartAdapter(session, agrupador)
+    return cart_adapter
+
+
+async def get_stock_adapter(
+    session: AsyncSession = Depends(get_session),
+) -> StockAdapter:
+    stock_adapter = StockAdapter(session)
+    return stock_adapter
@@ -1,15 +1,371 @@
+import asyncio
+import logging
+import time
+from itertools import count
 from os import environ
 
-from sqlmodel import Session, SQLModel, create_engine
+from sqlalchemy import event, text
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.ext.asyncio.engine import _get_sync_engine_or_connection
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlmodel.orm.session import Session
+from starlette.requests import Request
+
+from carrinho.db.dsn import async_url
+from carrinho.db.escritas import AgrupadorEscritas
+from carrinho.metrics import registrar_coletor, registrar_query
+
+logger = logging.getLogger(__name__)
+
+
+class EstatisticasPool:
+    def __init__(self):
+        self.checkouts = 0
+        self.esperas = 0  # checkouts que não acharam conexão livre
+        self.tempo_espera_total = 0.0
+        self.tempo_espera_max = 0.0
+        self.timeouts = 0
+        # média móvel da espera por conexão, para o controle de admissão
+        self.espera_media = 0.0
+        self.ultima_espera_em = 0.0
+
+    def registrar_espera(self, espera: float):
+        self.espera_media = 0.8 * self.espera_media + 0.2 * espera
+        self.ultima_espera_em = time.monotonic()
+
+    def espera_recente(self) -> float:
+        # sem checkouts no último segundo a média não diz mais nada
+        if time.monotonic() - self.ultima_espera_em > 1.0:
+            return 0.0
+        return self.espera_media
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    # fica na classe porque o SQLAlchemy recria o pool com self.__class__
+    # (ex.: depois de dispose()) e os contadores não devem zerar
+    estatisticas = EstatisticasPool()
+
+    def _do_get(self):
+        stats = self.estatisticas
+        # só espera quem não acha conexão ociosa nem pode abrir uma nova
+        # (max_overflow -1: overflow sem limite, sempre pode abrir)
+        livre = (
+            self.checkedin() > 0
+            or self._max_overflow == -1
+            or self.overflow() < self._max_overflow
+        )
+        inicio = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeout:
+            # só o pool_timeout; falha ao conectar (auth, DNS, recusada) não é espera
+            stats.timeouts += 1
+            raise
+        finally:
+            espera = time.perf_counter() - inicio
+            stats.checkouts += 1
+            stats.registrar_espera(0.0 if livre else espera)
+            if not livre:
+                stats.esperas += 1
+                stats.tempo_espera_total += espera
+                stats.tempo_espera_max = max(stats.tempo_espera_max, espera)
+
+
+def _env_bool(nome: str, padrao: bool) -> bool:
+    return environ.get(nome, str(padrao)).lower() in ("1", "true", "yes", "sim")
+
 
 db_url = environ.get("DATABASE_URI")
-engine = create_engine(db_url)
+pool_size = int(environ.get("DB_POOL_SIZE", 10))
+max_overflow = int(environ.get("DB_MAX_OVERFLOW", 10))
+pool_timeout = float(environ.get("DB_POOL_TIMEOUT", 30))
+pool_recycle = int(environ.get("DB_POOL_RECYCLE", 1800))
+pool_pre_ping = _env_bool("DB_POOL_PRE_PING", True)
+statement_timeout_ms = int(environ.get("DB_STATEMENT_TIMEOUT_MS", 0))
+
+connect_args = {}
+if statement_timeout_ms:
+    connect_args["server_settings"] = {"statement_timeout": str(statement_timeout_ms)}
+
+engine = create_async_engine(
+    async_url(db_url),
+    poolclass=InstrumentedPool,
+    pool_size=pool_size,
+    max_overflow=max_overflow,
+    pool_timeout=pool_timeout,
+    pool_recycle=pool_recycle,
+    pool_pre_ping=pool_pre_ping,
+    connect_args=connect_args,
+)
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _antes_do_comando(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("inicio_comando", []).append(time.perf_counter())
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _depois_do_comando(conn, cursor, statement, parameters, context, executemany):
+    duracao = time.perf_counter() - conn.info["inicio_comando"].pop()
+    operacao = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "?"
+    registrar_query("postgres", operacao, duracao, statement)
+
+
+@registrar_coletor
+def _metricas_pool():
+    status = pool_status()
+    return [
+        (f"db_pool_{nome}", "counter" if nome in CONTADORES_POOL else "gauge",
+         f"Pool do Postgres: {nome}", [({}, valor)])
+        for nome, valor in status.items()
+    ]
+
+
+# Réplicas de leitura (DATABASE_REPLICA_URIS, separadas por vírgula). Só as
+# leituras que os adapters marcam (session.info["replica"]) vão para elas.
+ATRASO_REPLICA = text(
+    """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        -- tudo que chegou já foi aplicado: o primário só está sem escritas
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+    END
+    """
+)
+
+
+# depois de uma escrita o cliente lê do primário por REPLICA_STICKY_S
+# segundos (cookie), ou sempre que mandar o header
+COOKIE_PRIMARIO = "ler_primario"
+HEADER_PRIMARIO = "x-read-primary"
+REPLICA_STICKY_S = int(environ.get("REPLICA_STICKY_S", 5))
+
+
+class Replicas:
+    """Réplicas em rodízio, só entre as que passaram na última verificação.
+
+    A verificação tira da rotação a réplica que não responde ou que está
+    mais de `max_atraso` segundos atrás do primário, e devolve quando ela
+    se recupera.
+    """
+
+    def __init__(self, engines: list, intervalo: float, max_atraso: float):
+        self.engines = engines
+        self.intervalo = intervalo
+        self.max_atraso = max_atraso
+        self.saudaveis = list(engines)
+        self.leituras = {self._nome(e): 0 for e in engines}
+        self._rodizio = count()
+        self._tarefa = None
+
+    @staticmethod
+    def _nome(engine) -> str:
+        return f"{engine.url.host}:{engine.url.port or 5432}"
+
+    def escolher(self):
+        saudaveis = self.saudaveis
+        if not saudaveis:
+            return None
+        escolhida = saudaveis[next(self._rodizio) % len(saudaveis)]
+        self.leituras[self._nome(escolhida)] += 1
+        return escolhida
+
+    def fixar_primario(self, response):
+        response.set_cookie(
+            COOKIE_PRIMARIO, "1", max_age=REPLICA_STICKY_S, httponly=True, samesite="lax"
+        )
+
+    async def _atraso(self, engine) -> float:
+        async with engine.connect() as conn:
+            return (await conn.execute(ATRASO_REPLICA)).scalar() or 0
+
+    async def verificar(self):
+        resultados = await asyncio.gather(
+            *(asyncio.wait_for(self._atraso(e), self.intervalo) for e in self.engines),
+            return_exceptions=True,
+        )
+        saudaveis = []
+        for engine, atraso in zip(self.engines, resultados):
+            if isinstance(atraso, BaseException):
+                logger.warning("réplica %s fora: %r", self._nome(engine), atraso)
+            elif atraso > self.max_atraso:
+                logger.warning("réplica %s atrasada %.1fs", self._nome(engine), atraso)
+            else:
+                saudaveis.append(engine)
+        self.saudaveis = saudaveis
+
+    async def _verificar_sempre(self):
+        while True:
+            try:
+                await self.verificar()
+            except Exception as e:
+                logger.error(e)
+            await asyncio.sleep(self.intervalo)
+
+    async def start(self):
+        if self._tarefa is None:
+            self._tarefa = asyncio.create_task(self._verificar_sempre())
+
+    async def stop(self):
+        if self._tarefa is not None:
+            self._tarefa.cancel()
+            await asyncio.gather(self._tarefa, return_exceptions=True)
+            self._tarefa = None
+        for replica in self.engines:
+            await replica.dispose()
+
+
+replicas = None
+replica_urls = [
+    url.strip() for url in environ.get("DATABASE_REPLICA_URIS", "").split(",") if url.strip()
+]
+if replica_urls:
+    replicas = Replicas(
+        [
+            create_async_engine(
+                async_url(url),
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_timeout=pool_timeout,
+                pool_recycle=pool_recycle,
+                pool_pre_ping=pool_pre_ping,
+                connect_args=connect_args,
+            )
+            for url in replica_urls
+        ],
+        intervalo=float(environ.get("REPLICA_HEALTH_INTERVAL_S", 2)),
+        max_atraso=float(environ.get("REPLICA_MAX_LAG_S", 5)),
+    )
+
+    for replica in replicas.engines:
+        event.listen(replica.sync_engine, "before_cursor_execute", _antes_do_comando)
+        event.listen(replica.sync_engine, "after_cursor_execute", _depois_do_comando)
+
+
+class SessaoRoteada(Session):
+    """Session que manda para uma réplica as leituras marcadas.
+
+    Marcadas são as que rodam com info["replica"]. A réplica é escolhida
+    uma vez por sessão. Depois de qualquer escrita na sessão, ou com
+    info["primario"], tudo vai para o primário.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info["primario"] = True
+        elif self.info.get("replica") and not self.info.get("primario"):
+            replica = self.info.get("engine_replica") or replicas.escolher()
+            if replica is not None:
+                self.info["engine_replica"] = replica
+                return replica.sync_engine
+        return super().get_bind(mapper, clause, **kw)
+
+
+class AsyncSessionRoteada(AsyncSession):
+    # o AsyncSession do sqlmodel sempre cria o Session dele; aqui, o roteado
+    def __init__(self, bind=None, **kw):
+        kw["future"] = True
+        self.bind = bind
+        self.sync_session = self._proxied = self._assign_proxied(
+            SessaoRoteada(bind=_get_sync_engine_or_connection(bind), **kw)
+        )
+
+
+def ler_do_primario(request: Request) -> bool:
+    return (
+        request.method not in ("GET", "HEAD")
+        or request.headers.get(HEADER_PRIMARIO) == "1"
+        or COOKIE_PRIMARIO in request.cookies
+    )
+
+
+@registrar_coletor
+def _metricas_replicas():
+    if replicas is None:
+        return []
+    return [
+        ("db_replicas_healthy", "gauge", "Réplicas na rotação de leitura",
+         [({}, len(replicas.saudaveis))]),
+        ("db_replica_reads_total", "counter", "Sessões de leitura por réplica",
+         [({"replica": nome}, valor) for nome, valor in replicas.leituras.items()]),
+    ]
+
+
+# expire_on_commit=False: depois do commit os objetos continuam legíveis
+# sem um novo SELECT implícito (lazy load não funciona em sessão async)
+async_session = sessionmaker(
+    engine,
+    class_=AsyncSessionRoteada if replicas is not None else AsyncSession,
+    expire_on_commit=False,
+)
+
+
+# modo opcional (WRITE_BATCHING=1): updates de produto e de carrinho de várias
+# requisições entram na mesma transação, com um commit por lote
+agrupador = None
+if _env_bool("WRITE_BATCHING", False):
+    agrupador = AgrupadorEscritas(
+        async_session,
+        janela=float(environ.get("WRITE_BATCH_WINDOW_MS", 2)) / 1000,
+        max_lote=int(environ.get("WRITE_BATCH_MAX", 64)),
+        # transações de lote abertas ao mesmo tempo; cada uma usa uma conexão do pool
+        concorrencia=int(environ.get("WRITE_BATCH_CONCURRENCY", 2)),
+    )
+
+
+@registrar_coletor
+def _metricas_agrupador():
+    if agrupador is None:
+        return []
+    return [
+        (f"write_batch_{nome}", "gauge" if nome == "na_fila" else "counter",
+         f"Escritas agrupadas: {nome}", [({}, valor)])
+        for nome, valor in agrupador.stats().items()
+    ]
+
+
+async def aplicar_migracoes():
+    # em vez do create_all a cada boot: só as migrações pendentes, e com o
+    # banco em dia é um SELECT só (ver carrinho/db/migrations)
+    from carrinho.db.migrations import migrar
+
+    await migrar(engine)
+
+
+async def warm_up_pool():
+    # abre pool_size conexões de uma vez para o primeiro pico não pagar o connect
+    conexoes = await asyncio.gather(*(engine.connect() for _ in range(pool_size)))
+    for conn in conexoes:
+        await conn.close()
+
+
+CONTADORES_POOL = {"checkouts", "esperas", "tempo_espera_total_s", "timeouts"}
 
 
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+def pool_status() -> dict:
+    pool = engine.pool
+    stats = InstrumentedPool.estatisticas
+    return {
+        "tamanho": pool.size(),
+        "em_uso": pool.checkedout(),
+        "livres": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": max_overflow,
+        "checkouts": stats.checkouts,
+        "esperas": stats.esperas,
+        "tempo_espera_total_s": round(stats.tempo_espera_total, 6),
+        "tempo_espera_max_s": round(stats.tempo_espera_max, 6),
+        "timeouts": stats.timeouts,
+    }
 
 
-def get_session():
-    with Session(engine) as session:
+async def get_session(request: Request):
+    async with async_session() as session:
+        if replicas is not None and ler_do_primario(request):
+            session.info["primario"] = True
         yield session
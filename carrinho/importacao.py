@@ -0,0 +1,90 @@
+import csv
+import json
+from typing import AsyncIterator, Optional
+
+from pydantic import ValidationError
+
+from carrinho import models
+
+TAMANHO_LOTE = 1000
+
+
+async def ler_linhas(corpo: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    # junta os pedaços do corpo e devolve uma linha por vez, sem ler tudo;
+    # decodificar fica com quem lê, para UTF-8 inválido virar erro da linha
+    resto = b""
+    async for pedaco in corpo:
+        resto += pedaco
+        *linhas, resto = resto.split(b"\n")
+        for linha in linhas:
+            yield linha
+    if resto:
+        yield resto
+
+
+async def ler_registros(
+    corpo: AsyncIterator[bytes], formato: str
+) -> AsyncIterator[tuple[int, Optional[dict], Optional[str]]]:
+    """Devolve (número da linha, registro, erro de parse).
+
+    No CSV a primeira linha é o cabeçalho e um campo não pode conter quebra
+    de linha.
+    """
+    cabecalho = None
+    numero = 0
+    async for bruta in ler_linhas(corpo):
+        numero += 1
+        try:
+            linha = bruta.decode()
+        except UnicodeDecodeError:
+            yield numero, None, "linha não está em UTF-8"
+            continue
+        if not linha.strip():
+            continue
+        if formato == "csv":
+            campos = next(csv.reader([linha]))
+            if cabecalho is None:
+                cabecalho = [campo.strip() for campo in campos]
+                continue
+            if len(campos) != len(cabecalho):
+                yield numero, None, "número de colunas diferente do cabeçalho"
+                continue
+            yield numero, {k: v for k, v in zip(cabecalho, campos) if v != ""}, None
+        else:
+            try:
+                yield numero, json.loads(linha), None
+            except ValueError as e:
+                yield numero, None, str(e)
+
+
+async def importar_produtos(
+    corpo: AsyncIterator[bytes], formato: str, adapter, upsert: bool = False
+) -> models.ResultadoImportacao:
+    resultado = models.ResultadoImportacao()
+    lote: list[tuple[int, dict]] = []
+
+    async def gravar():
+        gravados, erros = await adapter.bulk_create(lote, upsert=upsert)
+        resultado.gravados += gravados
+        resultado.erros.extend(
+            models.ErroImportacao(linha=linha, erro=erro) for linha, erro in erros
+        )
+        lote.clear()
+
+    async for numero, registro, erro in ler_registros(corpo, formato):
+        if erro is None:
+            try:
+                produto = models.Produto.parse_obj(registro)
+                if produto.id is not None and not upsert:
+                    erro = "id só é aceito com modo=upsert"
+            except ValidationError as e:
+                erro = str(e)
+        if erro is not None:
+            resultado.erros.append(models.ErroImportacao(linha=numero, erro=erro))
+            continue
+        lote.append((numero, produto.dict(exclude_none=True)))
+        if len(lote) >= TAMANHO_LOTE:
+            await gravar()
+    if lote:
+        await gravar()
+    return resultado
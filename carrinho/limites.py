@@ -0,0 +1,255 @@
+import logging
+import math
+import time
+from collections import OrderedDict
+from os import environ
+from typing import Callable, Optional
+
+from starlette.requests import Request
+
+from carrinho.db.backend import espera_pool
+from carrinho.db.dsn import dsn_asyncpg
+from carrinho.db.escritas import Varredura
+from carrinho.metrics import Counter, registrar_coletor
+
+logger = logging.getLogger(__name__)
+
+rejeicoes = Counter(
+    "http_rejected_total",
+    "Requisições recusadas pelo rate limit (429) ou pela admissão (503)",
+    ("motivo",),
+)
+
+
+class Limite:
+    """Token bucket: `taxa` fichas por segundo, acumulando até `rajada`."""
+
+    def __init__(self, taxa: float, rajada: float):
+        self.taxa = taxa
+        self.rajada = rajada
+
+    @classmethod
+    def do_ambiente(cls, prefixo: str, taxa: float, rajada: float) -> Optional["Limite"]:
+        taxa = float(environ.get(f"{prefixo}_TAXA", taxa))
+        if taxa <= 0:
+            return None
+        return cls(taxa, float(environ.get(f"{prefixo}_RAJADA", rajada)))
+
+
+class MemoriaStore:
+    """Buckets no próprio processo (cada worker conta separado)."""
+
+    def __init__(self, max_chaves: int = 100_000):
+        self.max_chaves = max_chaves
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def consumir(self, chave: str, limite: Limite, custo: float = 1.0) -> float:
+        """Gasta `custo` fichas; devolve 0 ou quantos segundos esperar."""
+        agora = time.monotonic()
+        bucket = self._buckets.get(chave)
+        if bucket is None:
+            bucket = self._buckets[chave] = [limite.rajada, agora]
+            while len(self._buckets) > self.max_chaves:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(chave)
+        tokens = min(limite.rajada, bucket[0] + (agora - bucket[1]) * limite.taxa)
+        bucket[1] = agora
+        if tokens >= custo:
+            bucket[0] = tokens - custo
+            return 0.0
+        bucket[0] = tokens
+        return (custo - tokens) / limite.taxa
+
+
+class PostgresStore:
+    """Buckets compartilhados entre workers/instâncias, na tabela rate_limit.
+
+    Um único INSERT ... ON CONFLICT por requisição, num pool asyncpg próprio
+    para não disputar conexões com as rotas. Se o banco falhar, deixa passar.
+
+    Chave parada há mais de `ttl` segundos é apagada em segundo plano; o
+    `ttl` deve passar de rajada/taxa, o tempo para o bucket encher de novo,
+    e então apagar a linha equivale a deixá-la cheia.
+    """
+
+    SQL = """
+        INSERT INTO rate_limit AS r (chave, tokens, atualizado, permitido)
+        VALUES ($1, $3::float8 - $4::float8, now(), true)
+        ON CONFLICT (chave) DO UPDATE SET
+            tokens = least($3::float8, r.tokens
+                     + extract(epoch FROM now() - r.atualizado)::float8 * $2::float8)
+                   - CASE WHEN least($3::float8, r.tokens
+                          + extract(epoch FROM now() - r.atualizado)::float8 * $2::float8)
+                          >= $4::float8 THEN $4::float8 ELSE 0 END,
+            atualizado = now(),
+            permitido = least($3::float8, r.tokens
+                        + extract(epoch FROM now() - r.atualizado)::float8 * $2::float8)
+                        >= $4::float8
+        RETURNING permitido, tokens
+    """
+
+    APAGAR_PARADAS = """
+        DELETE FROM rate_limit WHERE ctid IN (
+            SELECT ctid FROM rate_limit
+            WHERE atualizado < now() - make_interval(secs => $1::float8)
+            LIMIT $2
+        )
+    """
+
+    def __init__(
+        self,
+        dsn: str,
+        tamanho_pool: int = 4,
+        ttl: float = 3600,
+        intervalo_limpeza: float = 60,
+    ):
+        self.dsn = dsn_asyncpg(dsn)
+        self.tamanho_pool = tamanho_pool
+        self.ttl = ttl
+        self.pool = None
+        self.limpeza = Varredura("rate_limit", self._apagar_paradas, intervalo_limpeza, 1000)
+
+    async def start(self):
+        import asyncpg
+
+        self.pool = await asyncpg.create_pool(
+            self.dsn, min_size=1, max_size=self.tamanho_pool
+        )
+        await self.limpeza.start()
+
+    async def stop(self):
+        await self.limpeza.stop()
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def consumir(self, chave: str, limite: Limite, custo: float = 1.0) -> float:
+        try:
+            permitido, tokens = await self.pool.fetchrow(
+                self.SQL, chave, limite.taxa, limite.rajada, custo
+            )
+        except Exception as e:
+            logger.error(e)
+            return 0.0
+        return 0.0 if permitido else (custo - tokens) / limite.taxa
+
+    async def _apagar_paradas(self, lote: int) -> int:
+        status = await self.pool.execute(self.APAGAR_PARADAS, self.ttl, lote)
+        return int(status.split()[-1])  # "DELETE n"
+
+
+class Limitador:
+    """Rate limit por cliente: a X-API-Key, se for uma das `chaves_api`; senão o IP.
+
+    Chave desconhecida conta no IP: com um bucket por chave qualquer, quem
+    manda uma chave aleatória por requisição escaparia do limite (e encheria
+    o MemoriaStore de buckets inúteis).
+    """
+
+    def __init__(
+        self,
+        store,
+        escrita: Optional[Limite],
+        leitura: Optional[Limite],
+        chaves_api: frozenset = frozenset(),
+    ):
+        self.store = store
+        self.escrita = escrita
+        self.leitura = leitura
+        self.chaves_api = chaves_api
+
+    def chave(self, request: Request) -> str:
+        api_key = request.headers.get("x-api-key")
+        if api_key and api_key in self.chaves_api:
+            return f"key:{api_key}"
+        return f"ip:{request.client.host if request.client else '?'}"
+
+    async def verificar(self, request: Request) -> float:
+        if request.method in ("GET", "HEAD"):
+            limite, classe = self.leitura, "leitura"
+        else:
+            limite, classe = self.escrita, "escrita"
+        if limite is None:
+            return 0.0
+        return await self.store.consumir(f"{classe}:{self.chave(request)}", limite)
+
+
+class Admissao:
+    """Recusa logo (503) quando o worker já está saturado.
+
+    Melhor responder rápido a parte das requisições do que aceitar todas e
+    deixar todas estourarem o timeout juntas na fila do pool.
+    """
+
+    def __init__(
+        self,
+        max_em_andamento: int,
+        max_espera_pool: float,
+        espera_pool: Optional[Callable[[], float]],
+    ):
+        self.max_em_andamento = max_em_andamento
+        self.max_espera_pool = max_espera_pool
+        self.espera_pool = espera_pool
+        self.em_andamento = 0
+
+    def motivo_para_recusar(self) -> Optional[str]:
+        if self.max_em_andamento and self.em_andamento >= self.max_em_andamento:
+            return "em_andamento"
+        if (
+            self.max_espera_pool
+            and self.espera_pool is not None
+            and self.espera_pool() >= self.max_espera_pool
+        ):
+            return "espera_pool"
+        return None
+
+
+# rotas que nunca são limitadas: monitoramento precisa responder sob carga
+ISENTAS = ("/metrics",)
+
+
+def retry_after(segundos: float) -> str:
+    return str(max(1, math.ceil(segundos)))
+
+
+def _criar_store():
+    if environ.get("RATE_LIMIT_STORE") == "postgres":
+        return PostgresStore(
+            environ.get("DATABASE_URI"),
+            int(environ.get("RATE_LIMIT_PG_POOL", 4)),
+            ttl=float(environ.get("RATE_LIMIT_PG_TTL_S", 3600)),
+            intervalo_limpeza=float(environ.get("RATE_LIMIT_PG_LIMPEZA_S", 60)),
+        )
+    return MemoriaStore(int(environ.get("RATE_LIMIT_MAX_CHAVES", 100_000)))
+
+
+# taxas 0 (padrão) desligam; ex.: RATE_LIMIT_ESCRITA_TAXA=5 RATE_LIMIT_ESCRITA_RAJADA=20
+limitador = Limitador(
+    _criar_store(),
+    escrita=Limite.do_ambiente("RATE_LIMIT_ESCRITA", 0, 20),
+    leitura=Limite.do_ambiente("RATE_LIMIT_LEITURA", 0, 200),
+    # chaves com bucket próprio, separadas por vírgula
+    chaves_api=frozenset(
+        chave for chave in environ.get("RATE_LIMIT_API_KEYS", "").split(",") if chave
+    ),
+)
+admissao = Admissao(
+    int(environ.get("ADMISSAO_MAX_EM_ANDAMENTO", 0)),
+    float(environ.get("ADMISSAO_MAX_ESPERA_POOL_MS", 0)) / 1000,
+    espera_pool,
+)
+
+
+@registrar_coletor
+def _metricas_admissao():
+    return [
+        ("http_requests_in_flight", "gauge", "Requisições em andamento neste worker",
+         [({}, admissao.em_andamento)]),
+    ]
@@ -1,50 +1,218 @@
-from fastapi import Depends, FastAPI, HTTPException
+from decimal import Decimal
+from typing import Literal, Optional
+
+from fastapi import (Depends, FastAPI, Header, HTTPException, Query, Request,
+                     Response)
 from pydantic import EmailStr
 from sqlalchemy.exc import IntegrityError, NoResultFound
 from fastapi.encoders import jsonable_encoder
-from carrinho import models
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from carrinho import importacao, metrics, models, streaming
+from carrinho.senhas import SobrecargaSenha, hasher
+from carrinho.cache import product_cache
+from carrinho.perfil import PerfilMiddleware, perfilador
+from carrinho.limites import (ISENTAS, admissao, limitador, rejeicoes,
+                              retry_after)
+from carrinho.db import backend
+from carrinho.db.base import MAX_FILTRO
+from carrinho.db.backend import (AddressAdapter, CartAdapter, ProductAdapter,
+                                 StockAdapter, UserAdapter,
+                                 get_address_adapter, get_cart_adapter,
+                                 get_product_adapter, get_stock_adapter,
+                                 get_user_adapter)
+from carrinho.db.exception import (ChaveReutilizada, CursorInvalido,
+                                   EstoqueInsuficiente, ObjetoDuplicado,
+                                   ObjetoNaoEncontrado, VersaoConflitante)
+from carrinho.respostas import (CACHE_CONTROL_PRODUTO, CACHE_CONTROL_USUARIO,
+                                FAST_JSON, RespostaJSONRapida, etag,
+                                nao_modificado, responder)
 import logging
-from carrinho.db.postgres_adapter import (AddressAdapter, ProductAdapter,
-                                          UserAdapter, get_address_adapter,
-                                          get_product_adapter,
-                                          get_user_adapter)
-from carrinho.db.postgres_db import create_db_and_tables
+import time
 from carrinho.schemas import Endereco, Produto, Usuario
 
-app = FastAPI()
+app = FastAPI(default_response_class=RespostaJSONRapida if FAST_JSON else JSONResponse)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-@app.post("/usuario/", status_code=201, response_model=Usuario)
+# primeiro registrado, então o mais de dentro: roda na mesma task da rota,
+# que é a que o amostrador acompanha
+app.add_middleware(PerfilMiddleware)
+
+
+@app.middleware("http")
+async def medir_latencia(request: Request, call_next):
+    inicio = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # o template da rota (ex.: /produto/{id_produto}/) e não o path, para
+        # não criar uma série por id
+        rota = request.scope.get("route")
+        metrics.http_latencia.observe(
+            time.perf_counter() - inicio,
+            request.method,
+            rota.path if rota else "desconhecida",
+            status,
+        )
+
+
+# registrado depois de medir_latencia, então roda por fora dele: as recusas
+# saem prontas, sem tocar no banco, e são contadas em http_rejected_total
+@app.middleware("http")
+async def limitar(request: Request, call_next):
+    if request.url.path == "/" or request.url.path.startswith(ISENTAS):
+        return await call_next(request)
+    motivo = admissao.motivo_para_recusar()
+    if motivo is not None:
+        rejeicoes.inc(motivo)
+        return JSONResponse(
+            {"detail": "Servidor ocupado"}, status_code=503, headers={"Retry-After": "1"}
+        )
+    espera = await limitador.verificar(request)
+    if espera:
+        rejeicoes.inc("rate_limit")
+        return JSONResponse(
+            {"detail": "Muitas requisições"},
+            status_code=429,
+            headers={"Retry-After": retry_after(espera)},
+        )
+    admissao.em_andamento += 1
+    try:
+        return await call_next(request)
+    finally:
+        admissao.em_andamento -= 1
+
+
+# Com réplicas de leitura: quem acabou de escrever lê do primário pelos
+# próximos segundos, para não ver a réplica ainda sem a própria escrita
+@app.middleware("http")
+async def ler_o_que_escreveu(request: Request, call_next):
+    response = await call_next(request)
+    if (
+        backend.replicas is not None
+        and request.method not in ("GET", "HEAD")
+        and response.status_code < 400
+    ):
+        backend.replicas.fixar_primario(response)
+    return response
+
+
+# os adapters do Postgres levantam NoResultFound, os do Mongo ObjetoNaoEncontrado
+NAO_ENCONTRADO = (NoResultFound, ObjetoNaoEncontrado)
+DUPLICADO = (IntegrityError, ObjetoDuplicado)
+
+def _sobrecarga():
+    return HTTPException(
+        status_code=503, detail="Servidor ocupado", headers={"Retry-After": "1"}
+    )
+
+
+@app.post("/usuario/", status_code=201, response_model=models.UsuarioResposta)
 async def criar_usuário(
     usuario: Usuario,
     adapter: UserAdapter = Depends(get_user_adapter),
 ):
     logger.info("Tentando criar cliente")
     try:
+        # o scrypt roda no pool do hasher, não no event loop
+        usuario.senha = await hasher.gerar_hash(usuario.senha)
         return await adapter.create(usuario)
-    except IntegrityError:
+    except SobrecargaSenha:
+        raise _sobrecarga()
+    except DUPLICADO:
         raise HTTPException(status_code=409, detail="Usuário já existe")
 
     except Exception:
         raise HTTPException(status_code=400, detail="Falha ao inserir")
 
 
-@app.get("/usuario/{email}/", response_model=Usuario)
+@app.post("/login/", status_code=204)
+async def login(
+    credenciais: models.Login,
+    adapter: UserAdapter = Depends(get_user_adapter),
+):
+    try:
+        try:
+            guardada = await adapter.get_senha(credenciais.email)
+        except NAO_ENCONTRADO:
+            # o mesmo scrypt de um email cadastrado: o tempo não revela a conta
+            await hasher.verificar_ficticio(credenciais.senha)
+            raise HTTPException(status_code=401, detail="Email ou senha inválidos")
+        ok, novo_hash = await hasher.verificar(credenciais.senha, guardada)
+    except SobrecargaSenha:
+        raise _sobrecarga()
+    if not ok:
+        raise HTTPException(status_code=401, detail="Email ou senha inválidos")
+    if novo_hash:
+        # custo do hash mudou desde o cadastro: regrava com os parâmetros atuais
+        await adapter.atualizar_senha(credenciais.email, novo_hash)
+
+
+def _condicional(
+    response: Response, obj, if_none_match: Optional[str], cache_control: str
+) -> tuple[Optional[Response], dict]:
+    """Devolve (304 pronto ou None, headers de cache da resposta)."""
+    headers = {"Cache-Control": cache_control}
+    atual = etag(obj)
+    if atual is not None:
+        headers["ETag"] = atual
+    if nao_modificado(if_none_match, atual):
+        return Response(status_code=304, headers=headers), headers
+    response.headers.update(headers)
+    return None, headers
+
+
+@app.get("/usuario/{email}/", response_model=models.UsuarioResposta)
 async def retornar_usuario(
     email: EmailStr,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
     adapter: UserAdapter = Depends(get_user_adapter),
 ):
     try:
-        return await adapter.get(email)
-
-    except NoResultFound:
+        usuario = await adapter.get(email)
+        resposta_304, headers = _condicional(
+            response, usuario, if_none_match, CACHE_CONTROL_USUARIO
+        )
+        if resposta_304:
+            return resposta_304
+        return responder(usuario, models.UsuarioResposta, headers=headers)
+
+    except NAO_ENCONTRADO:
         raise HTTPException(status_code=404, detail="Usuário não encontado")
     except Exception:
         raise HTTPException(status_code=400, detail="Falha ao inserir")
 
 
+@app.get("/usuarios/", response_model=models.PaginaUsuarios)
+async def listar_usuarios(
+    limite: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    adapter: UserAdapter = Depends(get_user_adapter),
+):
+    if stream:
+        return StreamingResponse(
+            streaming.json_array(adapter.stream_all(), exclude={"senha"}),
+            media_type="application/json",
+        )
+    try:
+        itens, proximo = await adapter.get_all(limit=limite, cursor=cursor)
+        if FAST_JSON:
+            return responder(
+                {"itens": itens, "proximo_cursor": proximo}, models.PaginaUsuarios
+            )
+        return models.PaginaUsuarios(itens=itens, proximo_cursor=proximo)
+    except CursorInvalido:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Falha ao buscar")
+
+
 @app.delete("/usuario/", status_code=204)
 async def deletar_usuario(
     email: EmailStr,
@@ -52,8 +220,9 @@ async def deletar_usuario(
 ):
     try:
         await adapter.delete(email)
-    except Exception as e:
-        breakpoint()
+    except NAO_ENCONTRADO:
+        raise HTTPException(status_code=404, detail="Usuário não encontado")
+    except Exception:
         raise HTTPException(status_code=400, detail="Falha ao deletar")
 
 
@@ -66,7 +235,7 @@ async def criar_endereco(
     try:
         return await adapter.create(email, endereco)
 
-    except NoResultFound:
+    except NAO_ENCONTRADO:
         raise HTTPException(status_code=404, detail="Usuário não encontado")
     except Exception:
         raise HTTPException(status_code=400, detail="Falha ao inserir")
@@ -80,7 +249,7 @@ async def deletar_endereco(
 ):
     try:
         await adapter.delete(email, endereco)
-    except NoResultFound:
+    except NAO_ENCONTRADO:
         raise HTTPException(status_code=404, detail="Endereço não encontado")
     except Exception:
         raise HTTPException(status_code=400, detail="Falha ao deletar")
@@ -102,28 +271,141 @@ async def criar_produto(
 @app.get("/produto/{id_produto}/", response_model=Produto)
 async def retornar_produto(
     id_produto: int,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
     adapter: ProductAdapter = Depends(get_product_adapter),
 ):
     try:
-        return await adapter.get(id_produto)
-
-    except NoResultFound:
+        produto = await adapter.get(id_produto)
+        resposta_304, headers = _condicional(
+            response, produto, if_none_match, CACHE_CONTROL_PRODUTO
+        )
+        if resposta_304:
+            return resposta_304
+        return responder(produto, Produto, headers=headers)
+
+    except NAO_ENCONTRADO:
         raise HTTPException(status_code=404, detail="Produto não encontado")
     except Exception:
         raise HTTPException(status_code=400, detail="Falha ao buscar")
 
 
-@app.get("/produto/", response_model=Produto)
+MAX_IDS_LOTE = 100
+
+
+@app.get("/produtos/lote", response_model=models.LoteProdutos)
+async def retornar_produtos(
+    ids: list[int] = Query(...),
+    adapter: ProductAdapter = Depends(get_product_adapter),
+):
+    # ?ids=1&ids=2...: um SELECT ... IN no lugar de um GET por item
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > MAX_IDS_LOTE:
+        raise HTTPException(status_code=400, detail=f"No máximo {MAX_IDS_LOTE} ids")
+    try:
+        encontrados = await adapter.get_many(ids)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Falha ao buscar")
+    lote = {
+        "itens": [encontrados[id] for id in ids if id in encontrados],
+        "nao_encontrados": [id for id in ids if id not in encontrados],
+    }
+    if FAST_JSON:
+        return responder(lote, models.LoteProdutos)
+    return models.LoteProdutos(**lote)
+
+
+@app.get("/produto/", response_model=list[Produto])
 async def filtrar_produto(
     produto: models.ProdutoFilter,
+    response: Response,
     adapter: ProductAdapter = Depends(get_product_adapter),
 ):
+    # sem paginação: no máximo MAX_FILTRO produtos, e o corte é avisado nos
+    # headers (o resto sai por GET /produtos/ com cursor)
     try:
-        return await adapter.filter(**produto.dict(exclude_none=True))
-    except NoResultFound:
+        produtos = await adapter.filter(**produto.dict(exclude_none=True))
+    except NAO_ENCONTRADO:
         raise HTTPException(status_code=404, detail="Produto não encontado")
     except Exception:
         raise HTTPException(status_code=400, detail="Falha ao buscar")
+    headers = {"X-Result-Limit": str(MAX_FILTRO)}
+    if len(produtos) > MAX_FILTRO:
+        produtos = produtos[:MAX_FILTRO]
+        headers["X-Result-Truncated"] = "true"
+    response.headers.update(headers)
+    return responder(produtos, Produto, headers=headers)
+
+
+@app.get("/produtos/", response_model=models.PaginaProdutos)
+async def buscar_produtos(
+    nome: Optional[str] = None,
+    marca: Optional[str] = None,
+    descricao: Optional[str] = None,
+    preco_min: Optional[Decimal] = None,
+    preco_max: Optional[Decimal] = None,
+    ordem: Literal["id", "-id", "preco", "-preco", "nome", "-nome"] = "id",
+    limite: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    adapter: ProductAdapter = Depends(get_product_adapter),
+):
+    if stream:
+        # todas as linhas que casam com o filtro, num array JSON enviado aos pedaços
+        produtos = adapter.stream_search(
+            nome=nome,
+            marca=marca,
+            descricao=descricao,
+            preco_min=preco_min,
+            preco_max=preco_max,
+            ordem=ordem,
+        )
+        return StreamingResponse(
+            streaming.json_array(produtos), media_type="application/json"
+        )
+    try:
+        itens, proximo = await adapter.search(
+            nome=nome,
+            marca=marca,
+            descricao=descricao,
+            preco_min=preco_min,
+            preco_max=preco_max,
+            ordem=ordem,
+            limite=limite,
+            cursor=cursor,
+        )
+        if FAST_JSON:
+            return responder(
+                {"itens": itens, "proximo_cursor": proximo}, models.PaginaProdutos
+            )
+        return models.PaginaProdutos(itens=itens, proximo_cursor=proximo)
+    except CursorInvalido:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Falha ao buscar")
+
+
+@app.post("/produtos/importar", response_model=models.ResultadoImportacao)
+async def importar_produtos(
+    request: Request,
+    modo: Literal["insert", "upsert"] = "insert",
+    adapter: ProductAdapter = Depends(get_product_adapter),
+):
+    # corpo em NDJSON (padrão) ou CSV com cabeçalho, lido em streaming
+    formato = "csv" if "csv" in request.headers.get("content-type", "") else "ndjson"
+    return await importacao.importar_produtos(
+        request.stream(), formato, adapter, upsert=modo == "upsert"
+    )
+
+
+@app.get("/produtos/exportar")
+async def exportar_produtos(
+    adapter: ProductAdapter = Depends(get_product_adapter),
+):
+    return StreamingResponse(
+        streaming.ndjson(adapter.stream_all()),
+        media_type="application/x-ndjson",
+    )
 
 
 @app.delete("/produto/{id_produto}/")
@@ -133,80 +415,214 @@ async def deletar_produto(
 ):
     try:
         await adapter.delete(id_produto)
-    except NoResultFound:
+    except NAO_ENCONTRADO:
         raise HTTPException(status_code=404, detail="Produto não encontado")
     except Exception:
         raise HTTPException(status_code=400, detail="Falha ao deletar")
 
 
+def _versao_do_if_match(if_match: Optional[str]) -> Optional[int]:
+    # aceita 3, "3" e W/"3" (o ETag de GET /produto/{id}/)
+    if if_match is None:
+        return None
+    try:
+        return int(if_match.strip().removeprefix("W/").strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="If-Match inválido")
+
+
 @app.patch("/produto/{produto_id}", response_model=Produto)   
-async def update(produto_id: int, produto: models.ProdutoFilter, adapter: ProductAdapter = Depends(get_product_adapter)
+async def update(produto_id: int, produto: models.ProdutoFilter, response: Response, adapter: ProductAdapter = Depends(get_product_adapter),
+    idempotency_key: Optional[str] = Header(None),
+    if_match: Optional[str] = Header(None),
 ):
+    versao = _versao_do_if_match(if_match)
     try:
-        return await adapter.update(produto_id, produto)
-    except NoResultFound:
+        atualizado = await adapter.update(
+            produto_id, produto, chave_idempotencia=idempotency_key, versao=versao
+        )
+        # o ETag novo serve de If-Match para o próximo PATCH
+        headers = {"ETag": etag(atualizado)} if etag(atualizado) else {}
+        response.headers.update(headers)
+        return responder(atualizado, Produto, headers=headers)
+    except ChaveReutilizada:
+        raise HTTPException(status_code=422, detail="Idempotency-Key já usada com outro pedido")
+    except VersaoConflitante:
+        raise HTTPException(status_code=412, detail="Produto alterado por outra requisição")
+    except NAO_ENCONTRADO:
         raise HTTPException(status_code=404, detail="Produto não encontado")
     except Exception:
         raise HTTPException(status_code=400, detail="Falha ao atualizar")
     
 
 
-# # Se não existir usuário com o id_usuario ou id_produto retornar falha,
-# # se não existir um carrinho vinculado ao usuário, crie o carrinho
-# # e retornar OK
-# # senão adiciona produto ao carrinho e retornar OK
-# @app.post("/carrinho/{id_usuario}/{id_produto}/")
-# async def adicionar_carrinho(id_usuario: int, id_produto: int):
-#     if id_usuario not in db_usuarios:
-#         return FALHA
-#     if id_produto not in db_produtos:
-#         return FALHA
-
-#     if id_usuario not in db_carrinhos:
-#         carrinho_compras = models.CarrinhoDeCompras(
-#             id_usuario=id_usuario,
-#             id_produtos=[db_produtos[id_produto]],
-#             preco_total=db_produtos[id_produto].preco,
-#             quantidade_de_produtos=1,
-#         )
-#         db_carrinhos[id_usuario] = carrinho_compras
-#     else:
-#         db_carrinhos[id_usuario].id_produtos.append(db_produtos[id_produto])
-#         db_carrinhos[id_usuario].preco_total += db_produtos[id_produto].preco
-#         db_carrinhos[id_usuario].quantidade_de_produtos += 1
-#     return OK
-
-
-# # Se não existir carrinho com o id_usuario retornar falha,
-# # senão retorna o carrinho de compras.
-# @app.get("/carrinho/{id_usuario}/")
-# async def retornar_carrinho(id_usuario: int):
-#     if id_usuario not in db_carrinhos:
-#         return FALHA
-#     return db_carrinhos[id_usuario]
-
-
-# # Se não existir carrinho com o id_usuario retornar falha,
-# # senão retorna o o número de itens e o valor total do carrinho de compras.
-# @app.get("/carrinho/{id_usuario}/total")
-# async def retornar_total_carrinho(id_usuario: int):
-#     if id_usuario not in db_carrinhos:
-#         return FALHA
-
-#     return (
-#         db_carrinhos[id_usuario].preco_total,
-#         db_carrinhos[id_usuario].quantidade_de_produtos,
-#     )
-
-
-# # Se não existir usuário com o id_usuario retornar falha,
-# # senão deleta o carrinho correspondente ao id_usuario e retornar OK
-# @app.delete("/carrinho/{id_usuario}/")
-# async def deletar_carrinho(id_usuario: int):
-#     if id_usuario not in db_usuarios:
-#         return FALHA
-#     del db_carrinhos[id_usuario]
-#     return OK
+# Se não existir usuário com o id_usuario ou id_produto retornar falha,
+# se não existir um carrinho vinculado ao usuário, crie o carrinho,
+# senão adiciona produto ao carrinho. Retorna os totais atualizados.
+@app.post("/carrinho/{id_usuario}/{id_produto}/", response_model=models.TotalCarrinho)
+async def adicionar_carrinho(
+    id_usuario: int,
+    id_produto: int,
+    adapter: CartAdapter = Depends(get_cart_adapter),
+    idempotency_key: Optional[str] = Header(None),
+):
+    try:
+        return await adapter.add_item(
+            id_usuario, id_produto, chave_idempotencia=idempotency_key
+        )
+    except ChaveReutilizada:
+        raise HTTPException(status_code=422, detail="Idempotency-Key já usada com outro pedido")
+    except (IntegrityError, *NAO_ENCONTRADO):
+        raise HTTPException(status_code=404, detail="Usuário ou produto não encontado")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Falha ao inserir")
+
+
+# Remove uma unidade do produto do carrinho e retorna os totais atualizados.
+@app.delete(
+    "/carrinho/{id_usuario}/{id_produto}/", response_model=models.TotalCarrinho
+)
+async def remover_do_carrinho(
+    id_usuario: int,
+    id_produto: int,
+    adapter: CartAdapter = Depends(get_cart_adapter),
+    idempotency_key: Optional[str] = Header(None),
+):
+    try:
+        return await adapter.remove_item(
+            id_usuario, id_produto, chave_idempotencia=idempotency_key
+        )
+    except ChaveReutilizada:
+        raise HTTPException(status_code=422, detail="Idempotency-Key já usada com outro pedido")
+    except NAO_ENCONTRADO:
+        raise HTTPException(status_code=404, detail="Item não encontado")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Falha ao remover")
+
+
+# Se não existir carrinho com o id_usuario retornar falha,
+# senão retorna o carrinho de compras.
+@app.get("/carrinho/{id_usuario}/", response_model=models.CarrinhoDeCompras)
+async def retornar_carrinho(
+    id_usuario: int,
+    adapter: CartAdapter = Depends(get_cart_adapter),
+):
+    try:
+        return await adapter.get(id_usuario)
+    except NAO_ENCONTRADO:
+        raise HTTPException(status_code=404, detail="Carrinho não encontado")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Falha ao buscar")
+
+
+# Se não existir carrinho com o id_usuario retornar falha,
+# senão retorna o o número de itens e o valor total do carrinho de compras.
+@app.get("/carrinho/{id_usuario}/total", response_model=models.TotalCarrinho)
+async def retornar_total_carrinho(
+    id_usuario: int,
+    adapter: CartAdapter = Depends(get_cart_adapter),
+):
+    try:
+        return responder(await adapter.get_total(id_usuario), models.TotalCarrinho)
+    except NAO_ENCONTRADO:
+        raise HTTPException(status_code=404, detail="Carrinho não encontado")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Falha ao buscar")
+
+
+# Se não existir carrinho do id_usuario retornar falha,
+# senão deleta o carrinho correspondente ao id_usuario.
+@app.delete("/carrinho/{id_usuario}/", status_code=204)
+async def deletar_carrinho(
+    id_usuario: int,
+    adapter: CartAdapter = Depends(get_cart_adapter),
+):
+    try:
+        await adapter.delete(id_usuario)
+    except NAO_ENCONTRADO:
+        raise HTTPException(status_code=404, detail="Carrinho não encontado")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Falha ao deletar")
+
+
+# Estoque em fatias: mais de uma para SKUs disputados, em que muitas reservas
+# simultâneas fariam fila no lock de uma linha só.
+@app.put("/estoque/{id_produto}/", response_model=models.Estoque)
+async def definir_estoque(
+    id_produto: int,
+    estoque: models.DefinirEstoque,
+    adapter: StockAdapter = Depends(get_stock_adapter),
+):
+    try:
+        return await adapter.definir(id_produto, estoque.quantidade, estoque.fatias)
+    except NAO_ENCONTRADO + (IntegrityError,):
+        raise HTTPException(status_code=404, detail="Produto não encontado")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Falha ao definir estoque")
+
+
+@app.get("/estoque/{id_produto}/", response_model=models.Estoque)
+async def retornar_estoque(
+    id_produto: int,
+    adapter: StockAdapter = Depends(get_stock_adapter),
+):
+    try:
+        return await adapter.get(id_produto)
+    except NAO_ENCONTRADO:
+        raise HTTPException(status_code=404, detail="Estoque não encontado")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Falha ao buscar")
+
+
+# A reserva baixa o estoque na hora e vale por RESERVA_TTL segundos: se não
+# for confirmada nem liberada, o varredor devolve as unidades.
+@app.post("/reserva/", status_code=201, response_model=models.Reserva)
+async def reservar(
+    pedido: models.PedidoReserva,
+    idempotency_key: Optional[str] = Header(None),
+    adapter: StockAdapter = Depends(get_stock_adapter),
+):
+    try:
+        return await adapter.reservar(
+            pedido.produto_id,
+            pedido.quantidade,
+            pedido.usuario_id,
+            chave_idempotencia=idempotency_key,
+        )
+    except ChaveReutilizada:
+        raise HTTPException(status_code=422, detail="Idempotency-Key já usada com outro pedido")
+    except EstoqueInsuficiente:
+        raise HTTPException(status_code=409, detail="Estoque insuficiente")
+    except NAO_ENCONTRADO:
+        raise HTTPException(status_code=404, detail="Estoque não encontado")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Falha ao reservar")
+
+
+@app.post("/reserva/{id_reserva}/confirmar", status_code=204)
+async def confirmar_reserva(
+    id_reserva: int,
+    adapter: StockAdapter = Depends(get_stock_adapter),
+):
+    try:
+        await adapter.confirmar(id_reserva)
+    except NAO_ENCONTRADO:
+        raise HTTPException(status_code=404, detail="Reserva não encontrada ou vencida")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Falha ao confirmar")
+
+
+@app.delete("/reserva/{id_reserva}/", status_code=204)
+async def liberar_reserva(
+    id_reserva: int,
+    adapter: StockAdapter = Depends(get_stock_adapter),
+):
+    try:
+        await adapter.liberar(id_reserva)
+    except NAO_ENCONTRADO:
+        raise HTTPException(status_code=404, detail="Reserva não encontrada")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Falha ao liberar")
 
 
 @app.get("/")
@@ -215,6 +631,59 @@ async def bem_vinda():
     return site.replace("\n", "")
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metricas():
+    return metrics.render()
+
+
+@app.get("/metrics/pool")
+async def metricas_pool():
+    if backend.pool_status is None:
+        raise HTTPException(status_code=404, detail="Backend sem métricas de pool")
+    return backend.pool_status()
+
+
+@app.get("/metrics/cache")
+async def metricas_cache():
+    return product_cache.stats()
+
+
+def _autorizar_perfil(x_profile_token: Optional[str] = Header(None)):
+    # sem PROFILE_TOKEN os perfis não são expostos; token errado também dá 404
+    if not perfilador.autorizado(x_profile_token):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+
+@app.get("/debug/perfis", dependencies=[Depends(_autorizar_perfil)])
+async def listar_perfis():
+    return [perfil.resumo() for perfil in reversed(perfilador.perfis)]
+
+
+@app.get("/debug/perfis/{id_perfil}", dependencies=[Depends(_autorizar_perfil)])
+async def buscar_perfil(
+    id_perfil: str, formato: Literal["collapsed", "speedscope"] = "collapsed"
+):
+    perfil = perfilador.buscar(id_perfil)
+    if perfil is None:
+        raise HTTPException(status_code=404, detail="Perfil não encontrado (ou de outro worker)")
+    if formato == "speedscope":
+        return JSONResponse(
+            perfil.speedscope(),
+            headers={"Content-Disposition": f'attachment; filename="{id_perfil}.speedscope.json"'},
+        )
+    return PlainTextResponse(perfil.collapsed())
+
+
 @app.on_event("startup")
-def on_startup():
-    create_db_and_tables()
+async def on_startup():
+    await backend.on_startup()
+    await product_cache.start()
+    await limitador.store.start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await product_cache.stop()
+    await limitador.store.stop()
+    await backend.on_shutdown()
+    hasher.fechar()
@@ -0,0 +1,147 @@
+import bisect
+import functools
+import logging
+import time
+from os import environ
+from typing import Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+# acima disso (em ms) a query / método do adapter é logada como lenta
+SLOW_QUERY_MS = float(environ.get("SLOW_QUERY_MS", 200))
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(nomes: tuple, valores: tuple) -> str:
+    if not nomes:
+        return ""
+    pares = ",".join(
+        '{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for n, v in zip(nomes, valores)
+    )
+    return "{" + pares + "}"
+
+
+class Counter:
+    def __init__(self, nome: str, ajuda: str, labels: tuple = ()):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.labels = labels
+        self.valores: dict[tuple, float] = {}
+        registry.append(self)
+
+    def inc(self, *labels, valor: float = 1):
+        self.valores[labels] = self.valores.get(labels, 0) + valor
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.nome} {self.ajuda}"
+        yield f"# TYPE {self.nome} counter"
+        for labels, valor in self.valores.items():
+            yield f"{self.nome}{_labels(self.labels, labels)} {valor}"
+
+
+class Histogram:
+    def __init__(self, nome: str, ajuda: str, labels: tuple = (), buckets: tuple = BUCKETS):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [contagem por bucket..., soma, total]
+        self.series: dict[tuple, list] = {}
+        registry.append(self)
+
+    def observe(self, valor: float, *labels):
+        serie = self.series.get(labels)
+        if serie is None:
+            serie = self.series[labels] = [0] * len(self.buckets) + [0.0, 0]
+        indice = bisect.bisect_left(self.buckets, valor)
+        if indice < len(self.buckets):
+            serie[indice] += 1
+        serie[-2] += valor
+        serie[-1] += 1
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.nome} {self.ajuda}"
+        yield f"# TYPE {self.nome} histogram"
+        nomes_le = self.labels + ("le",)
+        for labels, serie in self.series.items():
+            acumulado = 0
+            for limite, contagem in zip(self.buckets, serie):
+                acumulado += contagem
+                yield f"{self.nome}_bucket{_labels(nomes_le, labels + (limite,))} {acumulado}"
+            yield f"{self.nome}_bucket{_labels(nomes_le, labels + ('+Inf',))} {serie[-1]}"
+            yield f"{self.nome}_sum{_labels(self.labels, labels)} {serie[-2]}"
+            yield f"{self.nome}_count{_labels(self.labels, labels)} {serie[-1]}"
+
+
+registry: list = []
+# funções que devolvem métricas calculadas na hora (pool, cache...):
+# cada uma gera (nome, tipo, ajuda, [(labels dict, valor)])
+coletores: list[Callable] = []
+
+
+def registrar_coletor(coletor: Callable):
+    coletores.append(coletor)
+    return coletor
+
+
+def render() -> str:
+    linhas = []
+    for metrica in registry:
+        linhas.extend(metrica.render())
+    for coletor in coletores:
+        for nome, tipo, ajuda, amostras in coletor():
+            linhas.append(f"# HELP {nome} {ajuda}")
+            linhas.append(f"# TYPE {nome} {tipo}")
+            for labels, valor in amostras:
+                linhas.append(
+                    f"{nome}{_labels(tuple(labels), tuple(labels.values()))} {valor}"
+                )
+    return "\n".join(linhas) + "\n"
+
+
+http_latencia = Histogram(
+    "http_request_duration_seconds",
+    "Latência das requisições HTTP",
+    ("method", "route", "status"),
+)
+adapter_latencia = Histogram(
+    "adapter_call_duration_seconds",
+    "Latência dos métodos dos adapters",
+    ("backend", "adapter", "method"),
+)
+db_latencia = Histogram(
+    "db_query_duration_seconds",
+    "Latência de cada comando enviado ao banco",
+    ("backend", "operation"),
+)
+queries_lentas = Counter(
+    "db_slow_queries_total",
+    "Comandos acima de SLOW_QUERY_MS",
+    ("backend", "operation"),
+)
+
+
+def registrar_query(backend: str, operacao: str, duracao: float, comando: str = ""):
+    db_latencia.observe(duracao, backend, operacao)
+    if duracao * 1000 >= SLOW_QUERY_MS:
+        queries_lentas.inc(backend, operacao)
+        logger.warning("query lenta (%.1f ms) [%s] %s", duracao * 1000, backend, comando)
+
+
+def cronometrar(backend: str, adapter: str, metodo: Callable) -> Callable:
+    @functools.wraps(metodo)
+    async def cronometrado(*args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return await metodo(*args, **kwargs)
+        finally:
+            duracao = time.perf_counter() - inicio
+            adapter_latencia.observe(duracao, backend, adapter, metodo.__name__)
+            if duracao * 1000 >= SLOW_QUERY_MS:
+                logger.warning(
+                    "adapter lento (%.1f ms) %s.%s", duracao * 1000, adapter, metodo.__name__
+                )
+
+    return cronometrado
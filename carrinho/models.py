@@ -1,7 +1,10 @@
+from datetime import datetime
 from typing import List, Optional
 
 from pydantic import BaseModel, EmailStr, Field, condecimal
 
+from carrinho import schemas
+
 
 # Classe representando os dados do endereço do cliente
 class Endereco(BaseModel):
@@ -10,6 +13,9 @@ class Endereco(BaseModel):
     cidade: str
     estado: str
 
+    class Config:
+        orm_mode = True
+
 
 # Classe representando os dados do cliente
 class Usuario(BaseModel):
@@ -19,7 +25,22 @@ class Usuario(BaseModel):
     senha: str = Field(min_length=3)
 
 
+class Login(BaseModel):
+    email: EmailStr
+    senha: str
+
+
 # Classe representando os dados do produto
+class Produto(BaseModel):
+    id: Optional[int] = None
+    nome: str
+    descricao: str
+    marca: str
+    tamanho: int
+    cor: str
+    preco: condecimal(max_digits=10, decimal_places=2)
+
+
 class ProdutoFilter(BaseModel):
     nome: Optional[str] = None
     descricao: Optional[str] = None
@@ -27,3 +48,84 @@ class ProdutoFilter(BaseModel):
     tamanho: Optional[int] = None
     cor: Optional[str] = None
     preco: Optional[condecimal(max_digits=10, decimal_places=2)] = None
+
+
+# Uma página da busca de produtos; proximo_cursor é None na última página
+class PaginaProdutos(BaseModel):
+    itens: List[schemas.Produto]
+    proximo_cursor: Optional[str] = None
+
+
+# Vários produtos por id: os ausentes vêm listados, sem falhar o lote
+class LoteProdutos(BaseModel):
+    itens: List[schemas.Produto]
+    nao_encontrados: List[int] = Field(default_factory=list)
+
+
+# Usuário como é devolvido nas leituras, já com os endereços carregados
+class UsuarioResposta(BaseModel):
+    id: Optional[int] = None
+    nome: str
+    email: EmailStr
+    enderecos: List[Endereco] = Field(default_factory=list)
+
+    class Config:
+        orm_mode = True
+
+
+class PaginaUsuarios(BaseModel):
+    itens: List[UsuarioResposta]
+    proximo_cursor: Optional[str] = None
+
+
+class ItemCarrinho(BaseModel):
+    id_produto: int
+    quantidade: int
+    preco_unitario: condecimal(max_digits=10, decimal_places=2)
+
+
+class TotalCarrinho(BaseModel):
+    preco_total: condecimal(max_digits=12, decimal_places=2)
+    quantidade_de_produtos: int
+
+
+class CarrinhoDeCompras(TotalCarrinho):
+    id_usuario: int
+    itens: List[ItemCarrinho] = Field(default_factory=list)
+
+
+class ErroImportacao(BaseModel):
+    linha: int
+    erro: str
+
+
+class ResultadoImportacao(BaseModel):
+    gravados: int = 0
+    erros: List[ErroImportacao] = Field(default_factory=list)
+
+
+class DefinirEstoque(BaseModel):
+    quantidade: int = Field(ge=0)
+    # mais de uma fatia para SKUs disputados (ex.: promoção relâmpago)
+    fatias: int = Field(1, ge=1, le=64)
+
+
+class Estoque(BaseModel):
+    produto_id: int
+    disponivel: int
+    reservado: int
+    fatias: int
+
+
+class PedidoReserva(BaseModel):
+    produto_id: int
+    quantidade: int = Field(1, ge=1)
+    usuario_id: Optional[int] = None
+
+
+class Reserva(BaseModel):
+    id: int
+    produto_id: int
+    quantidade: int
+    usuario_id: Optional[int] = None
+    expira_em: datetime
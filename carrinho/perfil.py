@@ -0,0 +1,268 @@
+"""Perfil de uma requisição sob demanda.
+
+Liga por requisição com o header X-Profile-Token (igual a PROFILE_TOKEN) ou
+por amostragem (PROFILE_SAMPLE_RATE, fração das requisições). Desligado, o
+custo é um `if` por requisição.
+
+Uma thread amostra a pilha do event loop a cada PROFILE_INTERVAL_MS. Quando
+a task da requisição é a que está rodando, a amostra é a pilha da thread
+(tempo de CPU: validação do pydantic, jsonable_encoder, compilação do
+SQLAlchemy...); quando não, é a cadeia de awaits da corrotina, com a folha
+"[aguardando]" (banco, rede ou fila do event loop). Cada amostra pesa o
+tempo real desde a anterior, então a soma é o tempo de parede.
+
+Os últimos PROFILE_BUFFER perfis ficam em memória, por worker, e saem em
+/debug/perfis no formato collapsed (flamegraph.pl, inferno) ou speedscope.
+"""
+import asyncio
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from itertools import count
+from os import environ
+from typing import Optional
+
+from carrinho.metrics import registrar_coletor
+
+AGUARDANDO = "[aguardando]"
+
+
+def _rotulo(code, cache: dict = {}) -> str:
+    rotulo = cache.get(code)
+    if rotulo is None:
+        arquivo = code.co_filename
+        for marcador in ("site-packages" + os.sep, os.sep + "carrinho" + os.sep):
+            if marcador in arquivo:
+                arquivo = arquivo.rsplit(marcador, 1)[1]
+                break
+        rotulo = cache[code] = f"{code.co_name} ({arquivo}:{code.co_firstlineno})"
+    return rotulo
+
+
+def _pilha_da_thread(frame) -> list:
+    pilha = []
+    while frame is not None:
+        pilha.append(frame.f_code)
+        frame = frame.f_back
+    pilha.reverse()
+    return pilha
+
+
+def _pilha_da_corrotina(coro) -> list:
+    # segue cr_await até o ponto em que a task está parada
+    pilha = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        pilha.append(frame.f_code)
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return pilha
+
+
+class Perfil:
+    def __init__(self, id: str, metodo: str, caminho: str, loop, tarefa, thread: int):
+        self.id = id
+        self.metodo = metodo
+        self.caminho = caminho
+        self.rota = None
+        self.status = None
+        self.loop = loop
+        self.tarefa = tarefa
+        self.thread = thread
+        self.inicio = time.time()
+        self.duracao = 0.0
+        # pilha (tupla de rótulos) -> segundos
+        self.amostras: Counter = Counter()
+
+    def amostrar(self, frame, peso: float):
+        if asyncio.current_task(self.loop) is self.tarefa and frame is not None:
+            pilha, folha = _pilha_da_thread(frame), ()
+        else:
+            pilha, folha = _pilha_da_corrotina(self.tarefa.get_coro()), (AGUARDANDO,)
+        # a raiz é o middleware: o que vem antes dele (loop, anyio) é igual em todas
+        if PerfilMiddleware.__call__.__code__ in pilha:
+            pilha = pilha[pilha.index(PerfilMiddleware.__call__.__code__):]
+        self.amostras[tuple(_rotulo(code) for code in pilha) + folha] += peso
+
+    def resumo(self) -> dict:
+        return {
+            "id": self.id,
+            "metodo": self.metodo,
+            "caminho": self.caminho,
+            "rota": self.rota,
+            "status": self.status,
+            "inicio": self.inicio,
+            "duracao_ms": round(self.duracao * 1000, 3),
+            "amostrado_ms": round(sum(self.amostras.values()) * 1000, 3),
+        }
+
+    def collapsed(self) -> str:
+        # um peso inteiro por linha: microssegundos
+        return "".join(
+            f"{';'.join(pilha)} {round(segundos * 1_000_000)}\n"
+            for pilha, segundos in self.amostras.most_common()
+        )
+
+    def speedscope(self) -> dict:
+        indices: dict = {}
+        frames, amostras, pesos = [], [], []
+        for pilha, segundos in self.amostras.items():
+            amostra = []
+            for rotulo in pilha:
+                if rotulo not in indices:
+                    indices[rotulo] = len(frames)
+                    frames.append({"name": rotulo})
+                amostra.append(indices[rotulo])
+            amostras.append(amostra)
+            pesos.append(segundos * 1000)
+        nome = f"{self.metodo} {self.caminho}"
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": nome,
+            "exporter": "carrinho.perfil",
+            "shared": {"frames": frames},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": nome,
+                    "unit": "milliseconds",
+                    "startValue": 0,
+                    "endValue": sum(pesos),
+                    "samples": amostras,
+                    "weights": pesos,
+                }
+            ],
+        }
+
+
+class Perfilador:
+    def __init__(self, token: str, taxa: float, intervalo: float, max_perfis: int):
+        self.token = token
+        self.taxa = taxa
+        self.intervalo = intervalo
+        self.ligado = bool(token) or taxa > 0
+        self.perfis = deque(maxlen=max_perfis)
+        self._ativos: dict = {}
+        self._trava = threading.Lock()
+        self._acordar = threading.Event()
+        self._thread = None
+        self._ids = count(1)
+        self.capturados = 0
+
+    def autorizado(self, token: Optional[str]) -> bool:
+        return bool(self.token) and token is not None and hmac.compare_digest(token, self.token)
+
+    def deve_perfilar(self, scope) -> bool:
+        if scope["path"].startswith("/debug/"):
+            return False
+        if self.token:
+            for nome, valor in scope["headers"]:
+                if nome == b"x-profile-token":
+                    return self.autorizado(valor.decode("latin-1"))
+        return self.taxa > 0 and random.random() < self.taxa
+
+    def iniciar(self, scope) -> Perfil:
+        perfil = Perfil(
+            f"{os.getpid()}-{next(self._ids)}",
+            scope["method"],
+            scope["path"],
+            asyncio.get_running_loop(),
+            asyncio.current_task(),
+            threading.get_ident(),
+        )
+        with self._trava:
+            self._ativos[perfil.id] = perfil
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._amostrar, name="perfil", daemon=True)
+            self._thread.start()
+        self._acordar.set()
+        return perfil
+
+    def terminar(self, perfil: Perfil):
+        with self._trava:
+            self._ativos.pop(perfil.id, None)
+        perfil.duracao = time.time() - perfil.inicio
+        self.perfis.append(perfil)
+        self.capturados += 1
+
+    def buscar(self, id: str) -> Optional[Perfil]:
+        for perfil in self.perfis:
+            if perfil.id == id:
+                return perfil
+        return None
+
+    def _amostrar(self):
+        anterior = time.perf_counter()
+        while True:
+            if not self._ativos:
+                # parada enquanto não há requisição sendo perfilada
+                self._acordar.wait()
+                self._acordar.clear()
+                anterior = time.perf_counter()
+                continue
+            time.sleep(self.intervalo)
+            agora = time.perf_counter()
+            peso, anterior = agora - anterior, agora
+            frames = sys._current_frames()
+            with self._trava:
+                for perfil in self._ativos.values():
+                    try:
+                        perfil.amostrar(frames.get(perfil.thread), peso)
+                    except Exception:
+                        # a pilha mudou enquanto era lida; perde só esta amostra
+                        pass
+
+
+class PerfilMiddleware:
+    """Middleware ASGI; registrado antes dos outros para ficar por dentro
+    deles e rodar na mesma task da rota."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not perfilador.ligado or scope["type"] != "http" or not perfilador.deve_perfilar(scope):
+            return await self.app(scope, receive, send)
+
+        perfil = perfilador.iniciar(scope)
+
+        async def enviar(mensagem):
+            if mensagem["type"] == "http.response.start":
+                perfil.status = mensagem["status"]
+                mensagem["headers"] = [
+                    *mensagem.get("headers", []),
+                    (b"x-profile-id", perfil.id.encode()),
+                ]
+            await send(mensagem)
+
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            rota = scope.get("route")
+            perfil.rota = rota.path if rota else None
+            perfilador.terminar(perfil)
+
+
+perfilador = Perfilador(
+    token=environ.get("PROFILE_TOKEN", ""),
+    taxa=float(environ.get("PROFILE_SAMPLE_RATE", 0)),
+    intervalo=float(environ.get("PROFILE_INTERVAL_MS", 1)) / 1000,
+    max_perfis=int(environ.get("PROFILE_BUFFER", 50)),
+)
+
+
+@registrar_coletor
+def _metricas_perfil():
+    if not perfilador.ligado:
+        return []
+    return [
+        ("profiles_captured_total", "counter", "Requisições perfiladas",
+         [({}, perfilador.capturados)]),
+        ("profiles_active", "gauge", "Requisições sendo perfiladas agora",
+         [({}, len(perfilador._ativos))]),
+    ]
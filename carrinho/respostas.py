@@ -0,0 +1,85 @@
+from decimal import Decimal
+from os import environ
+from typing import Any, Optional, Type
+
+import orjson
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+# Modo opcional de serialização rápida (FAST_JSON=1): as rotas de leitura
+# devolvem a resposta já pronta em orjson e o FastAPI deixa de validar o
+# retorno contra o response_model e de passar por jsonable_encoder.
+FAST_JSON = environ.get("FAST_JSON", "0").lower() in ("1", "true", "yes", "sim")
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, Decimal):
+        # preco é condecimal(max_digits<=12): cabe num double sem perda e o
+        # JSON sai igual ao do jsonable_encoder, que também usa float
+        return float(obj)
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    raise TypeError
+
+
+class RespostaJSONRapida(JSONResponse):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def projetar(obj: Any, modelo: Type[BaseModel]) -> Any:
+    """Lê de `obj` (ORM, dict ou pydantic) só os campos de `modelo`, sem validar.
+
+    Os objetos que chegam aqui vêm do banco e já são válidos; o response_model
+    serviria apenas para escolher os campos.
+    """
+    if obj is None:
+        return None
+    if isinstance(obj, (list, tuple)):
+        return [projetar(item, modelo) for item in obj]
+    resultado = {}
+    for nome, campo in modelo.__fields__.items():
+        valor = obj.get(nome) if isinstance(obj, dict) else getattr(obj, nome, None)
+        if isinstance(campo.type_, type) and issubclass(campo.type_, BaseModel):
+            valor = projetar(valor, campo.type_)
+        resultado[nome] = valor
+    return resultado
+
+
+def responder(
+    obj: Any,
+    modelo: Type[BaseModel],
+    status_code: int = 200,
+    headers: Optional[dict] = None,
+) -> Any:
+    # sem FAST_JSON os headers vão pelo `response: Response` da rota
+    if not FAST_JSON:
+        return obj
+    return RespostaJSONRapida(projetar(obj, modelo), status_code=status_code, headers=headers)
+
+
+# Leituras condicionais: o ETag vem da coluna versao, então responder 304
+# não exige serializar (nem reler) nada além da linha que já está em cache.
+# Produto é público e pode ficar num CDN; usuário é privado.
+CACHE_CONTROL_PRODUTO = environ.get(
+    "CACHE_CONTROL_PRODUTO", "public, max-age=5, stale-while-revalidate=30"
+)
+CACHE_CONTROL_USUARIO = environ.get("CACHE_CONTROL_USUARIO", "private, no-cache")
+
+
+def etag(obj: Any) -> Optional[str]:
+    versao = obj.get("versao") if isinstance(obj, dict) else getattr(obj, "versao", None)
+    return None if versao is None else f'"{versao}"'
+
+
+def nao_modificado(if_none_match: Optional[str], atual: Optional[str]) -> bool:
+    # comparação fraca (RFC 9110): W/"3" casa com "3"
+    if not if_none_match or atual is None:
+        return False
+    for candidato in if_none_match.split(","):
+        candidato = candidato.strip()
+        if candidato == "*" or candidato.removeprefix("W/") == atual:
+            return True
+    return False
@@ -1,6 +1,12 @@
+from datetime import datetime
+from decimal import Decimal
 from typing import Optional
 
 from pydantic import EmailStr, condecimal
+from sqlalchemy import (BigInteger, CheckConstraint, Column, DateTime,
+                        ForeignKey, Index, Integer, SmallInteger, Text,
+                        UniqueConstraint, func)
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlmodel import Field, Relationship, SQLModel
 
 
@@ -10,8 +16,13 @@ class Usuario(SQLModel, table=True):
     nome: str
     email: EmailStr = Field(unique=True)
     senha: str = Field(min_length=3)
+    # muda junto com os endereços; vira o ETag de GET /usuario/{email}/
+    versao: int = Field(default=1, sa_column_kwargs={"server_default": "1"})
 
-    enderecos: list["Endereco"] = Relationship(back_populates="usuario")
+    # passive_deletes: quem apaga os endereços é o ON DELETE CASCADE do banco
+    enderecos: list["Endereco"] = Relationship(
+        back_populates="usuario", sa_relationship_kwargs={"passive_deletes": True}
+    )
 
 
 class Endereco(SQLModel, table=True):
@@ -21,11 +32,43 @@ class Endereco(SQLModel, table=True):
     cidade: str
     estado: str
 
-    usuario_id: int = Field(foreign_key="usuario.id")
+    usuario_id: int = Field(
+        sa_column=Column(
+            Integer,
+            ForeignKey("usuario.id", ondelete="CASCADE"),
+            nullable=False,
+            index=True,
+        )
+    )
     usuario: Optional[Usuario] = Relationship(back_populates="enderecos")
 
 
 class Produto(SQLModel, table=True):
+    # (coluna de ordenação, id) atende a paginação por cursor; os GIN de
+    # trigrama atendem ILIKE '%termo%' sem varrer a tabela (extensão pg_trgm)
+    __table_args__ = (
+        Index("ix_produto_preco_id", "preco", "id"),
+        Index("ix_produto_nome_id", "nome", "id"),
+        Index(
+            "ix_produto_nome_trgm",
+            "nome",
+            postgresql_using="gin",
+            postgresql_ops={"nome": "gin_trgm_ops"},
+        ),
+        Index(
+            "ix_produto_marca_trgm",
+            "marca",
+            postgresql_using="gin",
+            postgresql_ops={"marca": "gin_trgm_ops"},
+        ),
+        Index(
+            "ix_produto_descricao_trgm",
+            "descricao",
+            postgresql_using="gin",
+            postgresql_ops={"descricao": "gin_trgm_ops"},
+        ),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     nome: str
     descricao: str
@@ -33,3 +76,101 @@ class Produto(SQLModel, table=True):
     tamanho: int
     cor: str
     preco: condecimal(max_digits=10, decimal_places=2)
+    # incrementada a cada update; com If-Match o PATCH só grava se ninguém
+    # tiver alterado o produto desde a leitura (concorrência otimista). É
+    # também o ETag de GET /produto/{id}/
+    versao: int = Field(default=1, sa_column_kwargs={"server_default": "1"})
+
+
+# Os totais do carrinho são mantidos a cada inclusão/remoção de item, então
+# ler o total é uma busca pelo índice único de usuario_id.
+class Carrinho(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    usuario_id: int = Field(
+        sa_column=Column(
+            Integer,
+            ForeignKey("usuario.id", ondelete="CASCADE"),
+            nullable=False,
+            unique=True,
+        )
+    )
+    quantidade_de_produtos: int = 0
+    preco_total: condecimal(max_digits=12, decimal_places=2) = Decimal(0)
+
+    itens: list["ItemCarrinho"] = Relationship(back_populates="carrinho")
+
+
+class ItemCarrinho(SQLModel, table=True):
+    __table_args__ = (UniqueConstraint("carrinho_id", "produto_id"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    carrinho_id: int = Field(
+        sa_column=Column(
+            Integer,
+            ForeignKey("carrinho.id", ondelete="CASCADE"),
+            nullable=False,
+        )
+    )
+    produto_id: int = Field(foreign_key="produto.id", index=True)
+    quantidade: int
+    # preço do produto na primeira inclusão; as remoções subtraem esse valor
+    preco_unitario: condecimal(max_digits=10, decimal_places=2)
+
+    carrinho: Optional[Carrinho] = Relationship(back_populates="itens")
+
+
+# Estoque em fatias (ver carrinho/db/estoque.py): a soma das fatias é o que
+# está disponível; um SKU comum tem uma fatia só.
+class Estoque(SQLModel, table=True):
+    __table_args__ = (CheckConstraint("quantidade >= 0", name="ck_estoque_quantidade"),)
+
+    produto_id: int = Field(
+        sa_column=Column(
+            Integer,
+            ForeignKey("produto.id", ondelete="CASCADE"),
+            primary_key=True,
+        )
+    )
+    fatia: int = Field(sa_column=Column(SmallInteger, primary_key=True))
+    quantidade: int
+
+
+class Reserva(SQLModel, table=True):
+    # expira_em: a varredura das vencidas; produto_id: o total reservado
+    __table_args__ = (
+        Index("ix_reserva_expira_em", "expira_em"),
+        Index("ix_reserva_produto_id", "produto_id"),
+    )
+
+    id: Optional[int] = Field(default=None, sa_column=Column(BigInteger, primary_key=True))
+    produto_id: int = Field(
+        sa_column=Column(
+            Integer,
+            ForeignKey("produto.id", ondelete="CASCADE"),
+            nullable=False,
+        )
+    )
+    # para onde as unidades voltam se a reserva for liberada
+    fatia: int = Field(sa_column=Column(SmallInteger, nullable=False))
+    quantidade: int
+    usuario_id: Optional[int] = None
+    expira_em: datetime = Field(sa_column=Column(DateTime(timezone=True), nullable=False))
+
+
+# Eventos gravados junto com as escritas (ver carrinho/db/outbox.py)
+class Outbox(SQLModel, table=True):
+    __table_args__ = (Index("ix_outbox_disponivel_em", "disponivel_em", "id"),)
+
+    id: Optional[int] = Field(default=None, sa_column=Column(BigInteger, primary_key=True))
+    topico: str
+    carga: dict = Field(sa_column=Column(JSONB, nullable=False))
+    criado_em: Optional[datetime] = Field(
+        default=None,
+        sa_column=Column(DateTime(timezone=True), nullable=False, server_default=func.now()),
+    )
+    disponivel_em: Optional[datetime] = Field(
+        default=None,
+        sa_column=Column(DateTime(timezone=True), nullable=False, server_default=func.now()),
+    )
+    tentativas: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
+    erro: Optional[str] = Field(default=None, sa_column=Column(Text))
@@ -0,0 +1,163 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+from typing import Optional, Tuple
+
+from carrinho.metrics import registrar_coletor
+
+PREFIXO = "scrypt"
+
+
+class SobrecargaSenha(Exception):
+    """A fila de hashing está cheia; a rota responde 503 em vez de acumular."""
+
+
+def _b64(dados: bytes) -> str:
+    return base64.b64encode(dados).decode().rstrip("=")
+
+
+def _de_b64(texto: str) -> bytes:
+    return base64.b64decode(texto + "=" * (-len(texto) % 4))
+
+
+def _scrypt(senha: str, sal: bytes, n: int, r: int, p: int) -> bytes:
+    # o hashlib solta o GIL durante o scrypt, então as threads rodam em paralelo
+    return hashlib.scrypt(
+        senha.encode(),
+        salt=sal,
+        n=n,
+        r=r,
+        p=p,
+        maxmem=128 * r * (n + p + 2) + (1 << 20),
+        dklen=32,
+    )
+
+
+class HasherSenhas:
+    """Hash e verificação de senhas (scrypt) fora do event loop.
+
+    O hash fica no formato "scrypt$n$r$p$sal$hash", então mudar o custo
+    (SENHA_SCRYPT_N...) não invalida as senhas antigas: elas são verificadas
+    com os parâmetros com que foram gravadas e refeitas no próximo login.
+    """
+
+    def __init__(self, n: int, r: int, p: int, workers: int, fila: int, espera: float):
+        self.n = n
+        self.r = r
+        self.p = p
+        self.workers = workers
+        self.fila = fila
+        self.espera = espera
+        self._executor = None
+        # workers rodando + fila esperando; criado no primeiro uso, já dentro do loop
+        self._vagas = None
+        # hash de uma senha aleatória, para o login de email inexistente
+        self._ficticio = None
+        self.em_andamento = 0
+        self.hashes = 0
+        self.verificacoes = 0
+        self.rejeitadas = 0
+
+    async def _rodar(self, funcao, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="senha")
+            self._vagas = asyncio.Semaphore(self.workers + self.fila)
+        try:
+            await asyncio.wait_for(self._vagas.acquire(), self.espera)
+        except asyncio.TimeoutError:
+            self.rejeitadas += 1
+            raise SobrecargaSenha
+        self.em_andamento += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, funcao, *args)
+        finally:
+            self.em_andamento -= 1
+            self._vagas.release()
+
+    def _gerar(self, senha: str) -> str:
+        sal = os.urandom(16)
+        chave = _scrypt(senha, sal, self.n, self.r, self.p)
+        return f"{PREFIXO}${self.n}${self.r}${self.p}${_b64(sal)}${_b64(chave)}"
+
+    def _conferir(self, senha: str, guardada: str) -> bool:
+        try:
+            prefixo, n, r, p, sal, chave = guardada.split("$")
+            if prefixo != PREFIXO:
+                return False
+            calculada = _scrypt(senha, _de_b64(sal), int(n), int(r), int(p))
+            return hmac.compare_digest(calculada, _de_b64(chave))
+        except ValueError:
+            # hash guardado malformado: não confere, em vez de virar 500
+            return False
+
+    def precisa_refazer(self, guardada: str) -> bool:
+        if not guardada.startswith(PREFIXO + "$"):
+            return True
+        _, n, r, p, _, _ = guardada.split("$")
+        return (int(n), int(r), int(p)) != (self.n, self.r, self.p)
+
+    async def gerar_hash(self, senha: str) -> str:
+        self.hashes += 1
+        return await self._rodar(self._gerar, senha)
+
+    async def verificar(self, senha: str, guardada: str) -> Tuple[bool, Optional[str]]:
+        """Confere a senha; se os parâmetros mudaram, devolve também o novo hash."""
+        self.verificacoes += 1
+        if guardada.startswith(PREFIXO + "$"):
+            ok = await self._rodar(self._conferir, senha, guardada)
+        else:
+            # senha gravada antes do hashing, em texto puro
+            ok = hmac.compare_digest(senha.encode(), guardada.encode())
+        novo = None
+        if ok and self.precisa_refazer(guardada):
+            novo = await self.gerar_hash(senha)
+        return ok, novo
+
+    async def verificar_ficticio(self, senha: str):
+        """Custa o mesmo que `verificar`, contra um hash que nunca confere.
+
+        Para o login de email inexistente levar o mesmo tempo do de email
+        cadastrado e o tempo de resposta não revelar quais contas existem.
+        """
+        if self._ficticio is None:
+            self._ficticio = await self._rodar(self._gerar, _b64(os.urandom(16)))
+        await self._rodar(self._conferir, senha, self._ficticio)
+
+    def fechar(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "em_andamento": self.em_andamento,
+            "hashes": self.hashes,
+            "verificacoes": self.verificacoes,
+            "rejeitadas": self.rejeitadas,
+        }
+
+
+hasher = HasherSenhas(
+    n=int(environ.get("SENHA_SCRYPT_N", 2**14)),
+    r=int(environ.get("SENHA_SCRYPT_R", 8)),
+    p=int(environ.get("SENHA_SCRYPT_P", 1)),
+    workers=int(environ.get("SENHA_WORKERS", os.cpu_count() or 1)),
+    fila=int(environ.get("SENHA_FILA", 64)),
+    espera=float(environ.get("SENHA_ESPERA", 2)),
+)
+
+
+@registrar_coletor
+def _metricas_senhas():
+    stats = hasher.stats()
+    return [
+        (f"password_hash_{nome}", "gauge" if nome in ("workers", "em_andamento") else "counter",
+         f"Hashing de senhas: {nome}", [({}, valor)])
+        for nome, valor in stats.items()
+    ]
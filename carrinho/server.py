@@ -0,0 +1,71 @@
+"""Ponto de entrada de produção: `python -m carrinho.server`.
+
+O processo principal prepara o banco uma vez (tabelas/índices) e sobe
+WEB_CONCURRENCY workers do uvicorn (padrão: um por CPU), cada um com uvloop e
+httptools. Os workers não rodam DDL no startup (DB_SETUP_ON_STARTUP=0).
+
+Cada worker abre o próprio pool: o total de conexões com o Postgres é
+WEB_CONCURRENCY * (DB_POOL_SIZE + DB_MAX_OVERFLOW), que precisa caber no
+max_connections do banco.
+
+No SIGTERM o uvicorn para de aceitar conexões, termina as requisições em
+andamento e roda os handlers de shutdown (agrupador, cache, hasher) antes
+de sair.
+
+Para desenvolvimento, `--reload` volta ao modo antigo: um worker que
+reinicia a cada alteração e prepara o banco no próprio startup.
+"""
+import argparse
+import asyncio
+import logging
+import os
+from os import environ
+
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+
+def _workers() -> int:
+    return int(environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(environ.get("PORT", 8000)))
+    parser.add_argument("--workers", type=int, default=_workers())
+    parser.add_argument("--reload", action="store_true")
+    args = parser.parse_args()
+
+    if args.reload:
+        uvicorn.run("carrinho.main:app", host=args.host, port=args.port, reload=True)
+        return
+
+    # importado só aqui: os workers sobem por spawn e importam o app sozinhos
+    from carrinho.db import backend
+
+    asyncio.run(backend.preparar())
+    # herdada pelos workers
+    environ["DB_SETUP_ON_STARTUP"] = "0"
+
+    logger.info("subindo %s workers", args.workers)
+    uvicorn.run(
+        "carrinho.main:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop="uvloop",
+        http="httptools",
+        lifespan="on",
+        # um log por requisição custa caro; as latências já vão para /metrics
+        access_log=environ.get("ACCESS_LOG", "0") == "1",
+        backlog=int(environ.get("SERVER_BACKLOG", 2048)),
+        timeout_keep_alive=int(environ.get("SERVER_KEEP_ALIVE", 5)),
+        proxy_headers=True,
+        forwarded_allow_ips=environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+    )
+
+
+if __name__ == "__main__":
+    main()
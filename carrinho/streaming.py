@@ -0,0 +1,25 @@
+from typing import AsyncIterator, Optional
+
+from pydantic import BaseModel
+
+
+# Geradores para StreamingResponse: cada item é serializado e enviado assim
+# que chega do cursor do banco, sem montar a lista inteira em memória.
+async def ndjson(
+    itens: AsyncIterator[BaseModel], exclude: Optional[set] = None
+) -> AsyncIterator[bytes]:
+    async for item in itens:
+        yield item.json(exclude=exclude).encode() + b"\n"
+
+
+async def json_array(
+    itens: AsyncIterator[BaseModel], exclude: Optional[set] = None
+) -> AsyncIterator[bytes]:
+    yield b"["
+    primeiro = True
+    async for item in itens:
+        if not primeiro:
+            yield b","
+        primeiro = False
+        yield item.json(exclude=exclude).encode()
+    yield b"]"